@@ -4,8 +4,16 @@
 .open() 
 .close() 
 .set_timing() ; which also sets trigger mode etc. """
-from pymba import * 
+try:
+    from pymba import * 
+except (ImportError, AssertionError), e:
+    #Vimba not installed, only simulated camera available (see pseudovimba)
+    print "pymba not available:", e
+    Vimba = object
 import numpy as np
+import threading
+from collections import deque
+from camera import CamTimeoutError
 
 
 # from contextlib import closing ## pretty sure we don't need this, because already imported in acquire.
@@ -36,7 +44,135 @@ class VimbAcq(Vimba):  # this class only defines open / close methods to use ' w
 			pass
 		return id[0]
 
+class FrameView(np.ndarray):
+    """Image acquired into a L{FrameRing}: numpy view of the memory
+    of a Vimba frame, no copy. Valid until L{release} is called, which
+    requeues the frame for capturing. Arrays derived from it (copies,
+    results of arithmetic) don't refer to the frame.
+
+    @ivar frameID: frame number assigned by Vimba
+    @ivar timestamp: timestamp of data transfer (camera ticks)"""
+    ring = None
+    frame = None
+    frameID = 0
+    timestamp = 0
+
+    def __array_wrap__(self, obj, context = None):
+        #results of ufuncs are plain arrays
+        return obj.view(np.ndarray)
+
+    def release(self):
+        ring, frame = self.ring, self.frame
+        self.ring = self.frame = None
+        if ring is not None:
+            ring.requeue(frame)
+
+class FrameRing(object):
+    """Pool of Vimba frames for continuous acquisition. The frames are
+    announced once and queued for capturing; filled frames are handed
+    out as L{FrameView} in the order they were queued, and requeued
+    when released by the consumer. If all frames are held by
+    consumers, the camera can't deliver images.
+
+    Filled frames are either fetched with L{wait}, or, if a callback
+    is given, delivered by frame-done callbacks of the Vimba DLL: the
+    callback is called from a Vimba thread with the L{FrameView} and
+    must not block."""
+
+    def __init__(self, camera, nframes, dtype, callback = None):
+        self.camera = camera
+        self.callback = callback
+        self.closed = False
+        self.frames = []
+        self._views = {}
+        self._queued = deque()
+        self._released = threading.Condition()
+
+        for k in range(nframes):
+            frame = camera.getFrame()
+            frame.announceFrame()
+            self.frames.append(frame)
+            self._views[frame] = np.ndarray(buffer = frame.getBufferByteData(),
+                                            dtype = dtype,
+                                            shape = (frame.height, frame.width))
+        camera.startCapture()
+        for frame in self.frames:
+            self.requeue(frame)
+
+    def requeue(self, frame):
+        """queue frame for capturing"""
+        with self._released:
+            if self.closed:
+                return
+            if self.callback is None:
+                frame.queueFrameCapture()
+            else:
+                frame.queueFrameCapture(self._frame_done)
+            self._queued.append(frame)
+            self._released.notify()
+
+    def wait(self, timeout = 2000):
+        """wait for next filled frame. Incomplete frames are requeued
+        and skipped.
+
+        @param timeout: timeout in ms
+        @rtype: L{FrameView}
+        @raise CamTimeoutError: no frame filled within timeout, or all
+        frames held by consumers"""
+        while True:
+            with self._released:
+                if not self._queued:
+                    self._released.wait(timeout/1000.0)
+                if not self._queued or self.closed:
+                    raise CamTimeoutError()
+                frame = self._queued[0]
+
+            if frame.waitFrameCapture(timeout) != 0:
+                raise CamTimeoutError()
+            with self._released:
+                self._queued.popleft()
+
+            if frame._frame.receiveStatus == 0:
+                break
+            self.requeue(frame)
+
+        return self._view(frame)
+
+    def _frame_done(self, frame):
+        #frame-done callback, called from Vimba thread
+        with self._released:
+            if self.closed:
+                return
+            self._queued.remove(frame)
+
+        if frame._frame.receiveStatus != 0:
+            #incomplete frame
+            self.requeue(frame)
+        else:
+            self.callback(self._view(frame))
+
+    def _view(self, frame):
+        img = self._views[frame].view(FrameView)
+        img.ring, img.frame = self, frame
+        img.frameID = frame._frame.frameID
+        img.timestamp = frame._frame.timestamp
+        return img
+
+    def close(self):
+        """end capturing and revoke frames. Outstanding images stay
+        valid (memory is kept alive), releasing them has no effect."""
+        with self._released:
+            self.closed = True
+            self._queued.clear()
+            self._released.notifyAll()
+        self.camera.endCapture()
+        self.camera.flushCaptureQueue()
+        self.camera.revokeAllFrames()
+
 class AVTcam(object):
+    #: frame ring buffer of continuous acquisition, see StartContinuousAcquisition
+    ring = None
+
     def __init__(self, cameraID, vimba):
         self.camera0 = vimba.getCamera(cameraID)
 
@@ -139,7 +275,39 @@ class AVTcam(object):
         newImage = np.copy(imgData)
         return newImage
         
+    def StartContinuousAcquisition(self, nframes = 8, callback = None):
+        """start continuous acquisition into a ring of nframes
+        frames, which are announced only once. Get images with
+        L{NextImage}, or, if callback is given, callback(image) is
+        called from a Vimba thread for each image (see L{FrameRing})."""
+        self.camera0.AcquisitionMode = 'Continuous'
+        self.ring = FrameRing(self.camera0, nframes, self.getImageDepth(), callback)
+        self.camera0.runFeatureCommand('AcquisitionStart')
+
+    def NextImage(self, wait = 2000):
+        """get next image of continuous acquisition, without copying.
+        Call release() of image when done with it.
+
+        @param wait: timeout in ms
+        @rtype: L{FrameView}
+        @raise CamTimeoutError: no image within timeout"""
+        ring = self.ring
+        if ring is None:
+            #stopped
+            raise CamTimeoutError()
+        return ring.wait(wait)
+
+    def StopContinuousAcquisition(self):
+        ring, self.ring = self.ring, None
+        if ring is not None:
+            self.camera0.runFeatureCommand('AcquisitionStop')
+            ring.close()
+            print 'AVTcam: continuous acquisition stopped'
+
     def StopImageAcquisition(self,mode):
+        if self.ring is not None:
+            self.StopContinuousAcquisition()
+            return
         if mode == 'fluorescence' or mode == 'absorption':
             try:
                 self.camera0.flushCaptureQueue()
@@ -25,6 +25,7 @@ import os.path
 
 from observer import Subject, changes_state
 import imagefile
+from imagerender import TileRenderer
 
 from time import clock as time
 
@@ -132,6 +133,46 @@ class BitmapDisplayOverlay(BitmapDisplay):
         super(BitmapDisplayOverlay, self).do_paint(dc)
         for paint_hook in self.paint_hooks:
             paint_hook(dc)
+
+class TiledBitmapDisplay(BitmapDisplayOverlay):
+    """Display image rendered in tiles by L{imagerender.TileRenderer},
+    with overlays. Only tiles in the region to repaint are rendered
+    (and cached by the tile renderer), there is no bitmap of the
+    complete scaled image."""
+
+    def __init__(self, parent, tiles, *args, **kwargs):
+        super(TiledBitmapDisplay, self).__init__(parent, *args, **kwargs)
+        self.tiles = tiles
+        tiles.convert = self.tile_bitmap
+
+    def tile_bitmap(self, rgb):
+        return wx.BitmapFromBuffer(rgb.shape[1], rgb.shape[0], rgb.data)
+
+    def DoGetBestSize(self):
+        w, h = self.tiles.size
+        return wx.Size(w + 4, h + 4)
+
+    def update_tiles(self):
+        """size of scaled image or content changed"""
+        w, h = self.tiles.size
+        self.SetInitialSize((w + 4, h + 4))
+        self.Refresh()
+
+    def OnPaint(self, event):
+        #tiles cover update region, no buffer of full size needed
+        dc = wx.PaintDC(self)
+        self.do_paint(dc)
+        del dc
+
+    def do_paint(self, dc):
+        if self.tiles.image is not None:
+            r = wx.RegionIterator(self.UpdateRegion)
+            while r.HaveRects():
+                for left, top, bitmap in self.tiles.visible(r.X, r.Y, r.W, r.H):
+                    dc.DrawBitmap(bitmap, left, top)
+                r.Next()
+        for paint_hook in self.paint_hooks:
+            paint_hook(dc)
             
 
 class ImageDisplay(wx.PyControl):
@@ -151,8 +192,11 @@ class ImageDisplay(wx.PyControl):
             self._image = image
         self.image_scaled = self.EmptyImage
         self._bitmap = self.EmptyBitmap
-        self.imgview = BitmapDisplayOverlay(self)
+        self.imgview = self.create_bitmapdisplay()
         self.set_scale(scale)
+
+    def create_bitmapdisplay(self):
+        return BitmapDisplayOverlay(self)
         
     def AcceptsFocus(self):
         return False
@@ -196,6 +240,16 @@ class ImageDisplay(wx.PyControl):
 
     scale = property(get_scale, set_scale)
 
+    @property
+    def image_size(self):
+        """@return: width and height of (unscaled) image"""
+        return self._image.Width, self._image.Height
+
+    @property
+    def scaled_size(self):
+        """@return: width and height of displayed (scaled) image"""
+        return self._bitmap.Width, self._bitmap.Height
+
     def draw(self):
         if self.image_scaled.Ok():
             self._bitmap = wx.BitmapFromImage(self.image_scaled)
@@ -519,8 +573,7 @@ class ImageDisplayWithMarkersOverlayed(ImageDisplay):
         the window or even recreating the whole bitmap and drawing the
         markers.
         """
-        size = (self._bitmap.Width, self._bitmap.Height)
-        regions = marker.get_invalidate_regions(self._scale, size)
+        regions = marker.get_invalidate_regions(self._scale, self.scaled_size)
         for rect in regions:
             self.RefreshRect(rect)
                 
@@ -529,7 +582,7 @@ class ImageDisplayWithMarkersOverlayed(ImageDisplay):
         called in OnPaint handler of L{BitmapDisplayOverlay}"""
         
         for marker in self._markers:
-            marker.draw(dc, self._scale, (self._bitmap.Width, self._bitmap.Height))
+            marker.draw(dc, self._scale, self.scaled_size)
             
     def add_marker(self, marker):
         self._markers.add(marker)
@@ -542,7 +595,9 @@ class ImageDisplayWithMarkersOverlayed(ImageDisplay):
 
 class CamImageDisplay(ImageDisplayWithMarkersOverlayed):
     """Displays Camera Image. Provides application of colormap, color
-    scaling. (Image size scaling inherited.)
+    scaling. (Image size scaling inherited.) Only the visible part of
+    the image is colormapped and scaled, in tiles (see
+    L{TiledBitmapDisplay}).
     """
     def __init__(self, parent, camimage = None,
                  scale = 1,
@@ -550,6 +605,7 @@ class CamImageDisplay(ImageDisplayWithMarkersOverlayed):
                  vmin = -0.1,
                  vmax = 1.5):
         
+        self._tiles = TileRenderer(colormap, vmin, vmax)
         super(CamImageDisplay, self).__init__(parent)
         self._colormap = colormap
         self.vmin = vmin
@@ -559,11 +615,17 @@ class CamImageDisplay(ImageDisplayWithMarkersOverlayed):
         #self.do_scale()
         #self.draw()
 
+    def create_bitmapdisplay(self):
+        return TiledBitmapDisplay(self, self._tiles)
+
     def set_camimage(self, camimg, scale = None):
-        """sets camimage. Convert camimage to wxImage by applying colormap"""
+        """sets camimage. Colormap is applied when drawn"""
         self._camimg = camimg
         if camimg is None:
             return
+        self._tiles.set_image(camimg)
+        if scale is not None:
+            self.set_scale(scale)
         self.render()
 
     set_image = set_camimage
@@ -590,42 +652,29 @@ class CamImageDisplay(ImageDisplayWithMarkersOverlayed):
         if camimg is None:
             return
 
-        #tic = time()
-        #color scaling
-        scale = (255.0/(self.vmax - self.vmin))
-        ci = numpy.empty_like(camimg)
-        numpy.subtract(camimg, self.vmin, ci)
-        #ci = (camimg - self.vmin)
-        numpy.multiply(ci, scale, ci)
-        #print "render scale: ", time()-tic #180ms
-
-        #tic = time()
-        #convert to color image, apply colormap
-        ci.clip(0, 255, ci)
-        #print "render clip:", time()-tic #40ms
-
-        #tic = time()
-        ci = ci.astype(numpy.uint8)
-        #print "render convert to uint8:", time()-tic #15ms
-
-        #tic = time()
-        lut = self._colormap(numpy.arange(256), bytes = True)
-        lut = lut[:, :-1]
-        imgrgb = lut.take(ci, axis = 0)
-        #print "apply colormap: ", time()-tic #21ms
-
-        #tic = time()
-        wximg = wx.ImageFromBuffer(imgrgb.shape[1],
-                                   imgrgb.shape[0],
-                                   imgrgb.data)
-        self._image = wximg
-        #print "convert to wximg", time()-tic #0ms
-        
-        #tic = time()
-        self.do_scale()
-        #print "scale: ", time()-tic
+        #settings for tiles rendered when painted
+        self._tiles.colormap = self._colormap
+        self._tiles.vmin = self.vmin
+        self._tiles.vmax = self.vmax
         self.draw()
 
+    def do_scale(self):
+        self._tiles.zoom = self._scale
+
+    def draw(self):
+        self.imgview.update_tiles()
+
+    @property
+    def image_size(self):
+        if self._camimg is None:
+            return 0, 0
+        h, w = self._camimg.shape
+        return w, h
+
+    @property
+    def scaled_size(self):
+        return self._tiles.size
+
     def get_value(self, x, y):
         try:
             return self._camimg[y, x]
@@ -965,10 +1014,10 @@ class CamImageMarkersPanel(CamImagePanel):
             elif self.marker_hit is not None:
                 #drag marker
                 px = max(0, px)
-                px = min(self.imgview._image.Width-1, px)
+                px = min(self.imgview.image_size[0]-1, px)
 
                 py = max(0, py)
-                py = min(self.imgview._image.Height-1, py)
+                py = min(self.imgview.image_size[1]-1, py)
 
                 self.marker_hit.change(px, py, self.marker_hit_kind)
 
@@ -8,6 +8,8 @@ import re
 from os import listdir, stat, walk
 from os.path import join, isdir, basename
 
+import shotarchive
+
 import wx
 from wx.lib.mixins import treemixin
 
@@ -22,10 +24,12 @@ class LabeledList(list):
 
 class DirListEntry(object):
     """stores data for tree entries (nodes and leaves)"""
-    def __init__(self, name = "", path = ""):
+    def __init__(self, name = "", path = "", mtime = None):
         self._name = name
         self._path = path
-        if path:
+        if mtime is not None:
+            self._mtime = mtime
+        elif path:
             self._mtime = stat(path).st_mtime
         else:
             self._mtime = None
@@ -52,6 +56,8 @@ class TreeModel(object):
 
     def __init__(self, root):
         self.root = root
+        #: (mtime, size) of shot archives, by day directory
+        self.archives = {}
         self.createfiletree()
 
     def getitem(self, indices):
@@ -81,6 +87,7 @@ class TreeModel(object):
         return len(item)
 
     imagefilematch = re.compile(r'\d{8}-(?P<name>.*)-(?P<nr>\d{4})\.(?P<ext>(sis|SIS|png|PNG))')
+    archivematch = re.compile(r'\d{8}-(?P<name>.*)\.shots$')
     dirmatch = re.compile(r'\d{4}-\d{2}-\d{2}')
 
     def createfiletree(self):
@@ -118,10 +125,33 @@ class TreeModel(object):
 
         #loop over all image files in day dir, sort into corresponding list
         measdict = {}
+        archives = self.archives[daydir] = {}
         for filename in names:
             m = self.imagefilematch.match(filename)
-            if m is None:
-                continue #file is not an image file, continue with next iteration
+            if m is not None:
+                entries = [(m.group('nr') + " (%s)"%m.group('ext').lower(),
+                            join(dayimgdir, filename), None)]
+            else:
+                m = self.archivematch.match(filename)
+                if m is None:
+                    continue #file is not an image file, continue with next iteration
+
+                #archive of measurement: one entry per shot. Close
+                #archive after reading index, don't keep files of all
+                #measurements open
+                path = join(dayimgdir, filename)
+                try:
+                    st = stat(path)
+                    shots = shotarchive.open_archive(path).shots
+                except Exception, e:
+                    print 'cannot read archive "%s": %s'%(path, e)
+                    continue
+                finally:
+                    shotarchive.close_archive(path)
+                mtime = st.st_mtime
+                archives[path] = (st.st_mtime, st.st_size)
+                entries = [("%04d (shots)"%nr, shotarchive.shot_path(path, nr), mtime)
+                           for nr in shots]
 
             #found imagefile, get corresponding measurement name
             measname = m.group('name')
@@ -136,10 +166,8 @@ class TreeModel(object):
                 imagelist = LabeledList([], label)
                 measdict[measname] = imagelist
 
-            
-            imagelist.append(DirListEntry(name = m.group('nr') + " (%s)"%m.group('ext').lower(),
-                                          path = join(dayimgdir, filename))
-                                          )
+            for name, path, mtime in entries:
+                imagelist.append(DirListEntry(name = name, path = path, mtime = mtime))
             
         for imagelist in measdict.itervalues():
             imagelist.sort(key = lambda x: x.name)
@@ -168,17 +196,29 @@ class TreeModelSync(TreeModel):
         #super(TreeModel, self).__init__(root)
         TreeModel.__init__(self, root)
 
+    def archives_changed(self, daydir):
+        """test if shot archives in daydir have changed, i.e. shots
+        have been appended (doesn't change directory)"""
+        for path, mtime in self.archives.get(daydir, {}).iteritems():
+            try:
+                st = stat(path)
+            except EnvironmentError:
+                return True
+            if (st.st_mtime, st.st_size) != mtime:
+                return True
+        return False
+
     def check_day(self, index):
         
-        """test if modify time of image directory has changed. Reload
-        if necessary"""
+        """test if modify time of image directory or of shot archives
+        has changed. Reload if necessary"""
 
         day = self.tree[index]
         daydir = day.label.path
         dirmtime = day.label.mtime
         actdirmtime = stat(daydir).st_mtime
 
-        if actdirmtime > dirmtime:
+        if actdirmtime > dirmtime or self.archives_changed(daydir):
             print "directory %s has changed, reloading"%daydir
 
             #recreate data structure day
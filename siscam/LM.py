@@ -97,6 +97,22 @@ def fJr(pars, x, y = 0, calcJ = True):
 
     return r, Jr
 
+def inner64(a, b, blocksize = 262144):
+    """inner product over last axis (like numpy.inner), accumulated
+    in double precision also for single precision arguments. Long
+    axes are processed in blocks to avoid converting whole arrays."""
+    a = numpy.asarray(a)
+    b = numpy.asarray(b)
+    if a.dtype == numpy.float64 and b.dtype == numpy.float64:
+        return inner(a, b)
+
+    n = a.shape[-1]
+    result = 0
+    for k in range(0, n, blocksize):
+        result = result + inner(a[..., k:k+blocksize].astype(numpy.float64),
+                                b[..., k:k+blocksize].astype(numpy.float64))
+    return result
+
 def fitparerror(fitpar, J, res):
     """
     fitpar: fit parameters
@@ -110,7 +126,7 @@ def fitparerror(fitpar, J, res):
     N = max(J.shape) #number of points
     m = len(fitpar) #number of parameters
 
-    rnorm = sum(res*res) #norm residuum
+    rnorm = numpy.sum(res*res) #norm residuum
   
     sigma = numpy.sqrt(rnorm/(N - m)) # estimated standard deviation
     
@@ -125,15 +141,36 @@ def fitparerror(fitpar, J, res):
 
     return parerr, sigma
 
+def fitparerror_normal(fitpar, A, F, N):
+    """same as L{fitparerror}, from normal matrix A = J J^T and squared
+    norm of residuum F, as returned by L{LM_batch_normal}
+
+    @param N: number of data points
+    """
+    import scipy.stats
+
+    alpha = 0.05
+    m = len(fitpar)
+    sigma = numpy.sqrt(F/(N - m))
+    diagonale = numpy.diagonal(numpy.linalg.inv(A))
+    parerr = numpy.sqrt(diagonale) * sigma * scipy.stats.t.ppf(1-alpha/2, N-m)
+    return parerr, sigma
+
     
 def LM(fun, pars, args,
        tau = 1e-2, eps1 = 1e-6, eps2 = 1e-6, kmax = 20,
        verbose = False,
-       full_output = False):
+       full_output = False,
+       info = None):
     """Implementation of the Levenberg-Marquardt algorithm in pure
-    Python. Solves the normal equations."""
+    Python. Solves the normal equations.
+
+    @param info: if a dict is given, number of iterations and function
+    evaluations and reason for stopping are stored with keys
+    'iterations', 'evaluations', 'reason'"""
     p = pars
     f, J = fun(p, *args)
+    nfev = 1
 
     A = inner(J,J)
     g = inner(J,f)
@@ -162,6 +199,7 @@ def LM(fun, pars, args,
         pnew = p + d
 
         fnew, Jnew = fun(pnew, *args)
+        nfev += 1
         #rho = (norm(f) - norm(fnew))/inner(d, mu*d - g)  # /2????
         rho = (norm(f)**2 - norm(fnew)**2)/inner(d, mu*d - g)
         
@@ -189,12 +227,183 @@ def LM(fun, pars, args,
 
     if verbose:
         print reason
+
+    if info is not None:
+        info.update(iterations = k, evaluations = nfev, reason = reason)
     
     if not full_output:
         return p
     else:
         return p, J, f #fitparerror(p, J, f)
 
+def batch_function(fun):
+    """Create function suitable for L{LM_batch} from function fun(p,
+    *args) as used by L{LM}. Members of the batch are evaluated one
+    after another."""
+    def batchfun(pars, index, *args):
+        fJ = [fun(p, *args) for p in pars]
+        f = numpy.array([fk for fk, Jk in fJ])
+        J = numpy.array([Jk for fk, Jk in fJ])
+        return f, J
+    return batchfun
+
+def LM_batch(fun, pars, args,
+             tau = 1e-2, eps1 = 1e-6, eps2 = 1e-6, kmax = 20,
+             verbose = False,
+             full_output = False,
+             info = None):
+    """Levenberg-Marquardt algorithm for a batch of N independent
+    problems which are advanced simultaneously. Each member has its
+    own damping and stopping criteria like in L{LM}, the normal
+    equations of all members are solved at once.
+
+    @param fun: function fun(pars, index, *args) returning residua f
+    (n x M) and Jacobians J (n x P x M) for the members given by index
+    (n member numbers), with parameters pars (n x P). Only members
+    which have not yet stopped are evaluated. See also
+    L{batch_function}.
+
+    @param pars: start parameters, one row for each member
+    @type pars: ndarray (N x P)
+
+    @param info: if a dict is given, number of iterations and member
+    evaluations (summed over members) and reasons for stopping (one
+    per member) are stored, see L{LM}
+
+    @return: fit parameters (N x P), or, if full_output, list of
+    (p, J, f) for each member, as returned by L{LM}.
+    """
+    def normal(p, index, *args):
+        fs, Js = fun(p, index, *args)
+        A = numpy.matmul(Js, Js.swapaxes(1, 2))
+        g = numpy.matmul(Js, fs[:, :, numpy.newaxis])[:, :, 0]
+        F = (fs*fs).sum(1)
+        #keep residua and Jacobians of members as views, avoid copying
+        return A, g, F, zip(Js, fs)
+
+    results = LM_batch_normal(normal, pars, args,
+                              tau = tau, eps1 = eps1, eps2 = eps2, kmax = kmax,
+                              verbose = verbose,
+                              full_output = full_output,
+                              info = info)
+    if not full_output:
+        return results
+    else:
+        return [(p, J, f) for p, A, F, (J, f) in results]
+
+def LM_batch_normal(fun, pars, args,
+                    tau = 1e-2, eps1 = 1e-6, eps2 = 1e-6, kmax = 20,
+                    verbose = False,
+                    full_output = False,
+                    info = None):
+    """Levenberg-Marquardt algorithm for a batch of N independent
+    problems, see L{LM_batch}, for functions which provide the normal
+    equations directly instead of residua and Jacobians, e.g., if they
+    can be calculated without evaluating the Jacobian for every data
+    point.
+
+    @param fun: function fun(pars, index, *args) returning, for the
+    members given by index with parameters pars (n x P), the normal
+    matrices A = J J^T (n x P x P), gradients g = J f (n x P), squared
+    norms of residua F = f f (n) and a sequence of n objects (or None)
+    which is returned for each member with the final parameters.
+
+    @return: fit parameters (N x P), or, if full_output, list of (p,
+    A, F, object) for each member. See L{fitparerror_normal}.
+    """
+    p = numpy.array(pars, dtype = numpy.float_, ndmin = 2)
+    N, m = p.shape
+
+    A, g, F, state = fun(p, numpy.arange(N), *args)
+    A = numpy.array(A, dtype = numpy.float_)
+    g = numpy.array(g, dtype = numpy.float_)
+    F = numpy.array(F, dtype = numpy.float_)
+    state = list(state) if state is not None else [None]*N
+    nfev = N
+
+    I = eye(m)
+
+    k = 0
+    nu = numpy.ones(N)*2
+    mu = tau * A.diagonal(0, 1, 2).max(1)
+    active = abs(g).max(1) >= eps1
+    reason = numpy.array(['small gradient']*N, dtype = object)
+
+    while active.any() and k < kmax:
+        k += 1
+        ia = numpy.flatnonzero(active)
+
+        M = A[ia] + mu[ia, numpy.newaxis, numpy.newaxis]*I
+        try:
+            d = solve(M, -g[ia, :, numpy.newaxis])[:, :, 0]
+        except numpy.linalg.LinAlgError:
+            #find singular members
+            d = numpy.zeros(shape = (len(ia), m))
+            for j, i in enumerate(ia):
+                try:
+                    d[j] = solve(M[j], -g[i])
+                except numpy.linalg.LinAlgError:
+                    print "Singular matrix encountered in LM_batch, member", i
+                    active[i] = False
+                    reason[i] = 'singular matrix'
+
+        #small step, singular members (already stopped) keep their reason
+        dnorm = numpy.sqrt((d*d).sum(1))
+        pnorm = numpy.sqrt((p[ia]*p[ia]).sum(1))
+        small = (dnorm < eps2*(pnorm + eps2)) & active[ia]
+        active[ia[small]] = False
+        reason[ia[small]] = 'small step'
+
+        take = active[ia]
+        ia, d = ia[take], d[take]
+        if len(ia) == 0:
+            break
+
+        pnew = p[ia] + d
+        Anew, gnew, Fnew, statenew = fun(pnew, ia, *args)
+        nfev += len(ia)
+
+        rho = (F[ia] - Fnew) / (d*(mu[ia, numpy.newaxis]*d - g[ia])).sum(1)
+
+        accept = rho > 0
+        if accept.any():
+            iacc = ia[accept]
+            p[iacc] = pnew[accept]
+            A[iacc] = Anew[accept]
+            g[iacc] = gnew[accept]
+            F[iacc] = Fnew[accept]
+            if statenew is not None:
+                for j in numpy.flatnonzero(accept):
+                    state[ia[j]] = statenew[j]
+
+            r = rho[accept]
+            mu[iacc] *= numpy.maximum(1.0/3, 1.0 - (2*r - 1)**3)
+            nu[iacc] = 2.0
+
+            small = abs(g[iacc]).max(1) < eps1
+            active[iacc[small]] = False
+            reason[iacc[small]] = 'small gradient'
+
+        irej = ia[~accept]
+        mu[irej] *= nu[irej]
+        nu[irej] *= 2
+
+        if verbose:
+            print "step %2d: %d active, |f|: %s"%(k, active.sum(), numpy.sqrt(F))
+
+    reason[active] = 'max iter reached'
+
+    if verbose:
+        print reason
+
+    if info is not None:
+        info.update(iterations = k, evaluations = nfev, reason = list(reason))
+
+    if not full_output:
+        return p
+    else:
+        return [(p[i], A[i], F[i], state[i]) for i in range(N)]
+
 def LMqr(fun, pars, args,
          tau = 1e-3, eps1 = 1e-8, eps2 = 1e-8, kmax = 100,
          verbose = False):
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+#-*- coding: latin-1 -*-
+"""Optical density of absorption images, shared by acquisition
+(L{acquire}), image files (L{imagefile}) and image analysis
+(L{reanalysis.prepare_image}, used by L{cam}).
+
+The images are processed in blocks of rows, so that temporaries stay
+in the cache and no full size temporaries are allocated. Invalid
+pixels are set to NaN."""
+
+from __future__ import with_statement
+
+import numpy as np
+
+#: number of pixels processed at once
+blocksize = 32768
+
+def _flat(a):
+    return np.asarray(a).reshape(-1)
+
+def _output(out, shape, dtype):
+    """flat view of output array, or temporary if output is not contiguous"""
+    if out is None:
+        out = np.empty(shape, dtype)
+    if out.shape != shape:
+        raise ValueError("output array has shape %s, expected %s"%(out.shape, shape))
+    if out.flags.c_contiguous:
+        return out, out.reshape(-1)
+    return out, np.empty(out.size, out.dtype)
+
+def optical_density(atoms, light, dark, ODmax = 0, minlight = 0, out = None, mask = None):
+    """optical density log((light - dark)/(atoms - dark)) of
+    absorption image, in one pass into float32 output.
+
+    Pixels with atoms - dark <= 0 or light - dark <= minlight are
+    invalid. For ODmax > 0 the optical density is corrected for the
+    finite maximum optical density (see L{saturation_corrected});
+    pixels with measured optical density at or above ODmax are
+    saturated and invalid, too. Invalid pixels are set to NaN.
+
+    @param atoms: image with atoms
+    @param light: image without atoms
+    @param dark: image without light
+    @param ODmax: maximum optical density, 0: no correction
+    @param minlight: minimum intensity of light image (after
+    subtracting dark image) for valid pixels
+    @param out: output array (float32), same shape as images
+    @param mask: boolean output array, set True for invalid pixels
+    @return: optical density
+    @rtype: ndarray (float32)
+    """
+    shape = np.shape(atoms)
+    out, o = _output(out, shape, np.float32)
+    if mask is not None:
+        mask, m = _output(mask, shape, np.bool_)
+    atoms, light, dark = _flat(atoms), _flat(light), _flat(dark)
+
+    n = max(1, min(blocksize, o.size))
+    ta = np.empty(n, np.float32)
+    tl = np.empty(n, np.float32)
+    inv = np.empty(n, np.bool_)
+    tinv = np.empty(n, np.bool_)
+    if ODmax > 0:
+        Tmin = np.float32(np.exp(-ODmax))
+        c = np.float32(1 - Tmin)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        for start in xrange(0, o.size, n):
+            s = slice(start, start + n)
+            k = len(o[s])
+            a, l, ob, i, ti = ta[:k], tl[:k], o[s], inv[:k], tinv[:k]
+
+            np.subtract(atoms[s], dark[s], a, dtype = np.float32)
+            np.subtract(light[s], dark[s], l, dtype = np.float32)
+            np.less_equal(a, 0, i)
+            np.less_equal(l, minlight, ti)
+            np.logical_or(i, ti, i)
+
+            if ODmax > 0:
+                #measured transmission minus minimum transmission
+                np.divide(a, l, a)
+                a -= Tmin
+                np.less_equal(a, 0, ti)
+                np.logical_or(i, ti, i)
+                np.divide(c, a, ob)
+            else:
+                np.divide(l, a, ob)
+            np.log(ob, ob)
+            ob[i] = np.nan
+            if mask is not None:
+                m[s] = i
+
+    if not out.flags.c_contiguous:
+        out[...] = o.reshape(shape)
+    if mask is not None and not mask.flags.c_contiguous:
+        mask[...] = m.reshape(shape)
+    return out
+
+def saturation_corrected(od, ODmax, out = None):
+    """correct measured optical density for finite maximum optical
+    density ODmax: log((1 - exp(-ODmax))/(exp(-od) - exp(-ODmax))).
+    Saturated pixels (od >= ODmax) and invalid pixels are set to NaN.
+
+    @param od: measured optical density (float)
+    @param out: output array, same shape and float type as od
+    @rtype: ndarray (float type of od, at least float32)
+    """
+    od = np.asarray(od)
+    dtype = np.result_type(od.dtype, np.float32)
+    out, o = _output(out, od.shape, dtype)
+    od = _flat(od)
+
+    n = max(1, min(blocksize, o.size))
+    t = np.empty(n, dtype)
+    Tmin = dtype.type(np.exp(-ODmax))
+    c = dtype.type(1 - Tmin)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+        for start in xrange(0, o.size, n):
+            s = slice(start, start + n)
+            tb, ob = t[:len(o[s])], o[s]
+            np.negative(od[s], tb)
+            np.exp(tb, tb)
+            tb -= Tmin
+            np.divide(c, tb, ob)
+            np.log(ob, ob)
+            #log of negative or infinite values for saturated pixels
+            ob[tb <= 0] = np.nan
+
+    if not out.flags.c_contiguous:
+        out[...] = o.reshape(out.shape)
+    return out
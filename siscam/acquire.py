@@ -58,6 +58,7 @@ import numpy as np
 
 import os, os.path
 import threading, Queue
+import multiprocessing
 from contextlib import closing
 
 import time
@@ -66,6 +67,9 @@ import settings
 import ImagePanel
 import readsis
 from png_writer import PngWriter
+from imagewriter import ImageWriter
+from framequeue import FrameQueue, SetAssembler
+from absorption import optical_density
 
 reload(settings)
 reload(ImagePanel)
@@ -75,58 +79,81 @@ import sys
 #take over settings
 from settings import useTheta, useBluefox, useSony, useAVT
 usePseudoTheta = settings.usePseudoCam
-imgFile = open(os.getcwd()+'imgValues.txt','w+')
-if useAVT:
-    try:
-        import AVTcam
-        reload(AVTcam)
-        useAVT = True
-        # Guppy = AVTcam.AVTcam() ### might be better this way. right now implemented in if __name__ = __main__ block.
-        VimbAcq = AVTcam.VimbAcq()	
-    except ImportError:
-        useAVT = False
-        print "AVT not available"
-
-        # configfile_theta = settings.configfile ### What to do here?
-    
 
-if useTheta:
-    try:
-        import SIS
-        reload(SIS)
-        useTheta = True
-        
-    except ImportError:
-        useTheta = False
-        print "Theta not available"
+#cameras and camera libraries, set up by init_cameras
+imgFile = None
+VimbAcq = None
+camtheta = None
+cam_sony = None
+
+def init_cameras():
+    """set up cameras and camera libraries selected in settings.
+    Called by main program only, not at import: on Windows, worker
+    processes of the image writer import this module again, they
+    must not open the cameras."""
+    global imgFile, VimbAcq, camtheta, cam_sony
+    global configfile_theta, configfiles_sony
+    global useAVT, useTheta, useBluefox, useSony
+    global AVTcam, pseudovimba, SIS, IMPACT, VCam
+    imgFile = open(os.getcwd()+'imgValues.txt','w+')
+    if useAVT:
+        try:
+            import AVTcam
+            reload(AVTcam)
+            useAVT = True
+            # Guppy = AVTcam.AVTcam() ### might be better this way. right now implemented in if __name__ = __main__ block.
+            if settings.usePseudoAVT:
+                import pseudovimba
+                VimbAcq = pseudovimba.PseudoVimba()
+            elif AVTcam.Vimba is object:
+                raise ImportError("Vimba not available")
+            else:
+                VimbAcq = AVTcam.VimbAcq()	
+        except ImportError:
+            useAVT = False
+            print "AVT not available"
+
+            # configfile_theta = settings.configfile ### What to do here?
+
+
+    if useTheta:
+        try:
+            import SIS
+            reload(SIS)
+            useTheta = True
+
+        except ImportError:
+            useTheta = False
+            print "Theta not available"
+
+        if not usePseudoTheta:
+            configfile_theta = settings.configfile
+            camtheta = SIS.Cam(config=configfile_theta)
+        else:
+            camtheta = SIS.PseudoCam()
+            useTheta = True
+
+    if useBluefox:
+        try:
+            import IMPACT
+            reload(IMPACT)
+            useBluefox = True
+        except ImportError:
+            useBluefox = False
+            print "Bluefox not available!"
+
+    if useSony:
+        try:
+            import VCam
+            reload(VCam)
+            useSony = True
+            configfiles_sony = settings.configfiles_sony
+            cam_sony = VCam.VCam()
+        except ImportError:
+            useSony = False
+            print "Sony not available"
+
 
-    if not usePseudoTheta:
-        configfile_theta = settings.configfile
-        camtheta = SIS.Cam(config=configfile_theta)
-    else:
-        camtheta = SIS.PseudoCam()
-        useTheta = True
-
-if useBluefox:
-    try:
-        import IMPACT
-        reload(IMPACT)
-        useBluefox = True
-    except ImportError:
-        useBluefox = False
-        print "Bluefox not available!"
-
-if useSony:
-    try:
-        import VCam
-        reload(VCam)
-        useSony = True
-        configfiles_sony = settings.configfiles_sony
-        cam_sony = VCam.VCam()
-    except ImportError:
-        useSony = False
-        print "Sony not available"
-        
 (AVTSingleImageAcquiredEvent, EVT_IMAGE_ACQUIRE_SINGLE_AVT) = wx.lib.newevent.NewEvent() ####AVT
 (AVTTripleImageAcquiredEvent, EVT_IMAGE_ACQUIRE_TRIPLE_AVT) = wx.lib.newevent.NewEvent() ####AVT
 (AVTDoubleImageAcquiredEvent,EVT_IMAGE_ACQUIRE_DOUBLE_AVT) = wx.lib.newevent.NewEvent()
@@ -139,6 +166,41 @@ if useSony:
 
 AVTTriggerGivenEvent = threading.Event() ####AVT
 
+def release_images(*images):
+    """release images acquired into the frame ring buffer of the AVT
+    camera (see L{AVTcam.FrameRing}), so that the frames can be
+    filled again. Other images are ignored."""
+    for img in images:
+        release = getattr(img, 'release', None)
+        if release is not None:
+            release()
+
+def release_queued(item):
+    """release image of queue item (nr, img, ...) dropped from
+    acquisition queue"""
+    release_images(*item[1:2])
+
+def prepare_queue(queue, live, setsize = 1):
+    """empty acquisition queue and set its policy for new acquisition
+
+    @type queue: L{FrameQueue}
+    @param live: live imaging, else triggered sets of images
+    @param setsize: number of images per set for triggered imaging"""
+    queue.clear()
+    queue.reset_counters()
+    if live:
+        queue.set_policy(settings.queuepolicy_live)
+    else:
+        queue.set_policy(settings.queuepolicy_triggered, setsize)
+
+def detach_image(img):
+    """@return: copy of image acquired into frame ring buffer, to be
+    kept after release (e.g. for display). Other images are returned
+    unchanged."""
+    if getattr(img, 'ring', None) is None:
+        return img
+    return np.array(img)
+
 (StatusMessageEvent, EVT_STATUS_MESSAGE) = wx.lib.newevent.NewEvent()
 
 class CamTiming(object):
@@ -216,6 +278,7 @@ class AcquireThreadTheta(AcquireThread):
                                     repetition=self.app.timing_theta.repetition)
 
             self.cam.start_live_acquisition()
+            time0 = time.time()
 
             while self.running:
                 try:
@@ -227,10 +290,10 @@ class AcquireThreadTheta(AcquireThread):
                 else:
                     img = self.cam.roidata
                     self.nr += 1
-                    self.queue.put((self.nr, img.astype(np.float32))) #TODO: ????
+                    self.queue.put((self.nr, img.astype(np.float32), time.time() - time0)) #TODO: ????
 
             #put empty image to queue
-            self.queue.put((- 1, None))
+            self.queue.put((- 1, None, 0))
 
         print "SISImageProducerThread exiting"
 
@@ -242,36 +305,100 @@ class AcquireThreadTheta(AcquireThread):
             print e
 ######AVT ----------- New AVT-section -------- added 15012015
 class AcquireThreadAVT(AcquireThread): #To be used with app=ImgAcqApp (self), cam=Guppy, queue...
+    #: size of frame ring buffer for continuous acquisition, 0: single frames
+    ring_frames = settings.AVTringframes
+
+    def setup_camera(self):
+        """set timing of opened camera for imaging mode
+
+        @return: timeout for waiting for image (ms)"""
+        ## TODO set_timing stuff
+        if self.app.imaging_mode_AVT == 'live':
+            self.cam.set_AutoMode(exposure = self.app.timing_AVT.get_exposure(), repetition=self.app.timing_AVT.get_repetition())
+            return self.app.timing_AVT.get_repetition()
+        else:
+            self.cam.set_TriggerMode(gated=True)
+            return 10000000
 
     def run(self):
         self.running = True
         print self.app.imaging_mode_AVT
         with closing(self.cam.open(mode = self.app.imaging_mode_AVT,pixel = self.app.pixelformat_AVT)):
-            ## TODO set_timing stuff
-            if self.app.imaging_mode_AVT == 'live':
-                self.cam.set_AutoMode(exposure = self.app.timing_AVT.get_exposure(), repetition=self.app.timing_AVT.get_repetition())
-                wait = self.app.timing_AVT.get_repetition()
-            else:
-                self.cam.set_TriggerMode(gated=True)
-                wait = 10000000
+            wait = self.setup_camera()
+            if self.ring_frames > 0:
+                #frames announced once, images are views of frame
+                #memory, released by consumer
+                self.cam.StartContinuousAcquisition(self.ring_frames)
+                wait = min(wait, 1000)
             time0 =time.time()
             while self.running:
                 try:
-
-                    img = self.cam.SingleImage(wait)
+                    if self.ring_frames > 0:
+                        img = self.cam.NextImage(wait)
+                    else:
+                        img = self.cam.SingleImage(wait).astype(self.app.pixelformat_AVT, copy=False)
                     imTime = time.time()-time0
                     self.nr += 1
-                    self.queue.put((self.nr, img.astype(self.app.pixelformat_AVT),imTime))
+                    self.queue.put((self.nr, img, imTime))
+                except CamTimeoutError:
+                    pass
                 except:
                     self.cam.StopImageAcquisition(self.app.imaging_mode_AVT)
                     self.running = False
                     raise Exception("Image not acquired. Closing Camera")
+            self.cam.StopContinuousAcquisition()
             #self.queue.put((-1, None,0))
         print '------------ AcquireThreadAVT finished --------- '
         self.running = False
     def stop(self):
+        self.running = False
         self.cam.StopImageAcquisition(self.app.imaging_mode_AVT)
+
+class AcquireThreadAVTCallback(AcquireThreadAVT):
+    """Acquisition with frame-done callbacks of Vimba instead of
+    waiting for frames: images are put into the queue from the Vimba
+    thread, no Python thread blocks on the camera. If the queue is
+    full, the image is dropped according to the policy of the queue
+    (L{FrameQueue}; for policy 'block' here, counted in dropped) and
+    its frame requeued, so the camera never stalls on a slow
+    consumer."""
+
+    def __init__(self, app, cam, queue):
+        AcquireThreadAVT.__init__(self, app, cam, queue)
+        self._stopped = threading.Event()
+        #: number of images dropped because queue was full
+        self.dropped = 0
+
+    def run(self):
+        self.running = True
+        print self.app.imaging_mode_AVT
+        with closing(self.cam.open(mode = self.app.imaging_mode_AVT,pixel = self.app.pixelformat_AVT)):
+            self.setup_camera()
+            self.time0 = time.time()
+            self.cam.StartContinuousAcquisition(max(self.ring_frames, 1),
+                                                callback = self.frame_done)
+            while self.running:
+                self._stopped.wait(1)
+            self.cam.StopContinuousAcquisition()
+        if self.dropped:
+            print "AcquireThreadAVTCallback: %d images dropped, queue full"%self.dropped
+        print '------------ AcquireThreadAVTCallback finished --------- '
+
+    def frame_done(self, img):
+        #called from Vimba thread, must not block
+        if not self.running:
+            img.release()
+            return
+        self.nr += 1
+        try:
+            self.queue.put_nowait((self.nr, img, time.time() - self.time0))
+        except Queue.Full:
+            self.dropped += 1
+            img.release()
+
+    def stop(self):
         self.running = False
+        self._stopped.set()
 
             ######## ---------------------- End new section ------------------
 class AcquireThreadBluefox(AcquireThread):
@@ -345,12 +472,33 @@ class ConsumerThread(threading.Thread):
     def run(self):
         pass
 
-    def get_image(self, timeout=1):
-        """get image from queue, skip empty images (nr<0)"""
-        nr = - 1
-        while nr < 0:
-            nr, img = self.queue.get(block=True, timeout=timeout)
-        return nr, img
+    def get_set(self, assembler, timeout=1, progress=False):
+        """get next complete set of images from queue (see
+        L{SetAssembler}), skip empty images (nr<0)
+
+        @param progress: show number of images of set received in status
+        @return: items (nr, img, time) of set
+        @raise Queue.Empty: no image within timeout, or thread stopped"""
+        while self.running:
+            try:
+                item = self.queue.get(block=True, timeout=timeout)
+            except Queue.Empty:
+                if assembler.expire():
+                    print "incomplete image set discarded (timeout)"
+                raise
+            self.queue.task_done()
+            if item[0] < 0:
+                continue
+
+            incomplete = assembler.incomplete
+            imgset = assembler.add(item)
+            if assembler.incomplete > incomplete:
+                print "incomplete image set discarded before image", item[0]
+            if progress:
+                self.message('%d'%(len(imgset) if imgset else len(assembler.pending)))
+            if imgset is not None:
+                return imgset
+        raise Queue.Empty()
 
     def message(self, msg):
         wx.PostEvent(self.app, StatusMessageEvent(data=msg))
@@ -364,14 +512,14 @@ class ConsumerThread(threading.Thread):
 
         # readsis.write_raw_image(filename, rawimg)
         # print 'DEBUG MODE! bitdepth before saving abs = ',rawimg.dtype.itemsize
-        PngWriter(filename, rawimg)
+        self.app.imagewriter.write(filename, rawimg)
         self.message('S')
 
     def save_raw_img(self, filename, img):
         rawimg = img.astype(np.uint16)
         # readsis.write_raw_image(filename, rawimg)
         # print 'DEBUG MODE! in save_raw_img, bitdepth before saving = ',rawimg.dtype.itemsize
-        PngWriter(filename, rawimg)
+        self.app.imagewriter.write(filename, rawimg)
         self.message('S')
     
     def stop(self):
@@ -385,7 +533,7 @@ class ConsumerThreadThetaSingleImage(ConsumerThread):
         self.running = True
         while self.running:
             try:
-                nr, img = self.queue.get(timeout=10)
+                nr, img = self.queue.get(timeout=10)[:2]
                 
             except Queue.Empty:
                 self.message('R')
@@ -416,11 +564,11 @@ class ConsumerThreadAVTSingleImage(ConsumerThread):
                 print "consumer: got image", nr
                
                 if nr > 0:
-                    wx.PostEvent(self.app, AVTSingleImageAcquiredEvent(imgnr=nr, img=img))
-                    
                     #if nr%100 == 0:
                     # print 'DEBUG MODE! bitdepth before saving = ',img.dtype.itemsize
                     self.save_abs_img(settings.testfile, img)
+                    #frame released by GUI after display
+                    wx.PostEvent(self.app, AVTSingleImageAcquiredEvent(imgnr=nr, img=img))
                     self.queue.task_done()
         self.message('E')
     def stop(self):
@@ -458,19 +606,11 @@ class ConsumerThreadThetaTripleImage(ConsumerThread):
 
     def run(self):
         self.running = True
+        assembler = SetAssembler(3, settings.settimeout)
         while self.running:
             try:
-                nr1, img1 = self.get_image(timeout=5)
-                self.message('1')
-                if not self.running: break
-
-                nr2, img2 = self.get_image(timeout=2)
-                self.message('2')
-                if not self.running: break
-
-                nr3, img3 = self.get_image(timeout=2)
-                self.message('3')
-                if not self.running: break
+                (nr1, img1, time1), (nr2, img2, time2), (nr3, img3, time3) = \
+                    self.get_set(assembler, timeout=2, progress=True)
 
             except Queue.Empty:
                 self.message(None)
@@ -478,7 +618,7 @@ class ConsumerThreadThetaTripleImage(ConsumerThread):
 
             else:
                 #calculate absorption image
-                img = - (np.log(img1 - img3) - np.log(img2 - img3))
+                img = optical_density(img1, img2, img3)
                 imga,  imgb  = self.app.imagesplit(img)
                 img2a, img2b = self.app.imagesplit(img2)
 
@@ -513,31 +653,26 @@ class ConsumerThreadThetaTripleImage(ConsumerThread):
 ######AVT ----------- New AVT-section -------- added 19022015
 class ConsumerThreadAVTTripleImage(ConsumerThread):
     def stop(self):
-        with Queue.mutex:
-            Queue.clear()
+        self.queue.clear()
         self.running = False
     def run(self):
         self.running = True
         print 'Consumer Thread started (Absorption)'
+        assembler = SetAssembler(3, settings.settimeout, discard=release_queued)
         while self.running:
             try:
-                
-                nr1, img1, time1 = self.queue.get(timeout=None)
-
-                nr2, img2, time2 = self.queue.get(timeout=None)
-
-                nr3, img3, time3 = self.queue.get(timeout=None)
+                (nr1, img1, time1), (nr2, img2, time2), (nr3, img3, time3) = \
+                    self.get_set(assembler)
 
             except Queue.Empty:
-                print "Still waiting to acquire images"
-                #This doesn't actually reset it. If empty, we should wait for the next image
+                #no complete set yet
                 pass
 
             else:
                 print "consumer: got image", nr1, nr2, nr3
                 print "image times: ", time1, time2, time3
 				#calculate absorption image
-                img = - (np.log(img1 - img3) - np.log(img2 - img3))
+                img = optical_density(img1, img2, img3)
 
                 data = {'image1': img1,
                         'image2': img2,
@@ -549,6 +684,7 @@ class ConsumerThreadAVTTripleImage(ConsumerThread):
                 self.save_abs_img(settings.testfile, img)
                 # PngWriter(settings.testfile, img, bitdepth=8)
                 # print 'Consumer: queue size', self.queue.qsize()
+        assembler.drop_pending()
         print "ImageConsumerThread exiting!"
         self.message('E')
 class ConsumerThreadAVTDoubleImage(ConsumerThread):
@@ -561,13 +697,13 @@ class ConsumerThreadAVTDoubleImage(ConsumerThread):
     def run(self):
         self.running = True
         print 'Consumer Thread started (Fluorescence)'
+        assembler = SetAssembler(2, settings.settimeout, discard=release_queued)
         while self.running:
-            if not self.queue.empty():
-                
-                nr1, img1, time1 = self.queue.get(timeout=None)
-
-                nr2, img2, time2 = self.queue.get(timeout=None)
-                
+            try:
+                (nr1, img1, time1), (nr2, img2, time2) = self.get_set(assembler)
+            except Queue.Empty:
+                pass
+            else:
                 #calculate absorption image
                 img = img1.astype(np.int16)-img2.astype(np.int16)
 
@@ -578,12 +714,9 @@ class ConsumerThreadAVTDoubleImage(ConsumerThread):
                         'image_numbers': (nr1, nr2),
                         'fluorescence_image': img}
                 wx.PostEvent(self.app, AVTDoubleImageAcquiredEvent(data=data))
-                #Indicate that the queued tasks have been completed
-                self.queue.task_done()
-                self.queue.task_done()
                 self.save_abs_img(settings.testfile, img)
 
-
+        assembler.drop_pending()
         print "ImageConsumerThread exiting!"
         self.message('E')   
 ######## ---------------------- End new section ------------------        
@@ -604,7 +737,7 @@ class ConsumerThreadSony(ConsumerThread):
                     self.message('I')
                 elif nr>0 and len(imgs)==3:
                     #got three images
-                    img =   np.log(imgs[1] - imgs[2]) - np.log(imgs[0] - imgs[2])
+                    img = optical_density(imgs[0], imgs[1], imgs[2])
                     
                     data = {'image1': imgs[0],
                             'image2': imgs[1],
@@ -685,11 +818,14 @@ class ImgAcquireApp(wx.App):
         self.ID_HelpMenu = wx.NewId()
         self.ID_AboutMenu = wx.NewId()
 
-        #Queues for image acquisition
-        self.imagequeue_AVT = Queue.Queue(3)  ####AVT ; ATTENTION Argument of .queue() not clear
-        self.imagequeue_theta = Queue.Queue(3)
-        self.imagequeue_bluefox = Queue.Queue(2)
-        self.imagequeue_sony = Queue.Queue(2)
+        #Queues for image acquisition, policy set on start of acquisition
+        self.imagequeue_AVT = FrameQueue(settings.acquirequeuesize, discard = release_queued)  ####AVT
+        self.imagequeue_theta = FrameQueue(settings.acquirequeuesize)
+        self.imagequeue_bluefox = FrameQueue(settings.acquirequeuesize)
+        self.imagequeue_sony = FrameQueue(settings.acquirequeuesize)
+
+        #images saved by consumer threads are written in background
+        self.imagewriter = ImageWriter(settings.writerprocesses, settings.writerqueuesize)
 
         #splash screen
         splash = AcquireSplashScreen()
@@ -1443,7 +1579,8 @@ class ImgAcquireApp(wx.App):
 ######AVT ----------- New AVT-section -------- added 15012015            
     def OnSingleImageAcquiredAVT(self, event):
         if not self.Pending():
-            self.imageAVT.show_image(event.img, description="image #%d" % event.imgnr) ### CRASH at this point
+            self.imageAVT.show_image(detach_image(event.img), description="image #%d" % event.imgnr) ### CRASH at this point
+        release_images(event.img)
 ######## ---------------------- End new section ------------------
     def OnSingleImageAcquiredBluefox(self, event):
         """Display image if not too busy"""
@@ -1518,9 +1655,10 @@ class ImgAcquireApp(wx.App):
             # self.imageSony2.show_image(img2)
             # self.imageSony3.show_image(img3)
             self.imageAVT.show_image(imgA)
-            self.imageAVT_foreground.show_image(img1)
-            self.imageAVT_background.show_image(img2) 
-            self.imageAVT_dark.show_image(img3)       
+            self.imageAVT_foreground.show_image(detach_image(img1))
+            self.imageAVT_background.show_image(detach_image(img2)) 
+            self.imageAVT_dark.show_image(detach_image(img3))       
+        release_images(img1, img2, img3)
 
     def OnDoubleImageAcquiredAVT(self,event):
         img1 = event.data['image1']
@@ -1529,8 +1667,9 @@ class ImgAcquireApp(wx.App):
         
         if not self.Pending():
             self.imageAVT.show_image(imgF)
-            self.imageAVT_foreground.show_image(img1)
-            self.imageAVT_background.show_image(img2)        
+            self.imageAVT_foreground.show_image(detach_image(img1))
+            self.imageAVT_background.show_image(detach_image(img2))        
+        release_images(img1, img2)
 ##### ----------- End New Section ---------------- Added on 19022015
         
     def OnTripleImageAcquiredSony(self, event):
@@ -1606,7 +1745,14 @@ class ImgAcquireApp(wx.App):
 ######AVT ----------- New AVT-section -------- added 15012015
     def start_acquisition_AVT(self):
         self.acquiring_AVT = True
-        self.imgproducer_AVT = AcquireThreadAVT(self,
+        prepare_queue(self.imagequeue_AVT,
+                      live = self.imaging_mode_AVT == 'live',
+                      setsize = 2 if self.imaging_mode_AVT == 'fluorescence' else 3)
+        if settings.AVTcapturecallback:
+            producer = AcquireThreadAVTCallback
+        else:
+            producer = AcquireThreadAVT
+        self.imgproducer_AVT = producer(self,
 													cam=Guppy,
 													queue=self.imagequeue_AVT)
         if self.imaging_mode_AVT == 'live':
@@ -1630,6 +1776,8 @@ class ImgAcquireApp(wx.App):
             print "could not stop AVT producer thread."
         if self.imgconsumer_AVT.isAlive():
             print "could not stop AVT consumer threads!"
+        print "AVT image queue:", self.imagequeue_AVT.stats()
+        print "image writer:", self.imagewriter.stats()
 
         self.acquiring_AVT = False
 	
@@ -1637,6 +1785,9 @@ class ImgAcquireApp(wx.App):
     def start_acquisition_theta(self):
         self.acquiring_theta = True
         self.menu.EnableTop(self.ID_TimingTheta, False)
+        prepare_queue(self.imagequeue_theta,
+                      live = self.imaging_mode_theta == 'live',
+                      setsize = 3)
         
         self.imgproducer_theta = AcquireThreadTheta(self,
                                                        camtheta,
@@ -1653,6 +1804,7 @@ class ImgAcquireApp(wx.App):
 
     def start_acquisition_bluefox(self):
         self.acquiring_bluefox = True
+        prepare_queue(self.imagequeue_bluefox, live = True)
         self.imgproducer_bluefox = AcquireThreadBluefox(self,
                                                              cam=IMPACT.Cam(),
                                                              queue=self.imagequeue_bluefox)
@@ -1666,6 +1818,8 @@ class ImgAcquireApp(wx.App):
             nimg = 1
         elif self.imaging_mode_sony == 'absorption':
             nimg = 3
+        #all images of a set in one queue item
+        prepare_queue(self.imagequeue_sony, live = self.imaging_mode_sony == 'live')
             
         self.imgproducer_sony = AcquireThreadSony(self,
                                                   cam=VCam.VCam(),
@@ -1686,6 +1840,8 @@ class ImgAcquireApp(wx.App):
             
         if self.imgproducer_theta.isAlive() or self.imgconsumer_theta.isAlive():
             print "could not stop theta acquisition threads!", threading.enumerate()
+        print "Theta image queue:", self.imagequeue_theta.stats()
+        print "image writer:", self.imagewriter.stats()
 
         self.acquiring_theta = False
         self.menu.EnableTop(self.ID_TimingTheta, True)
@@ -1700,6 +1856,8 @@ class ImgAcquireApp(wx.App):
         if self.imgproducer_bluefox.isAlive() \
            or self.imgconsumer_bluefox.isAlive():
             print "could not stop bluefox acquisition threads!"
+        print "Bluefox image queue:", self.imagequeue_bluefox.stats()
+        print "image writer:", self.imagewriter.stats()
 		
         self.acquiring_bluefox = False
 
@@ -1712,6 +1870,8 @@ class ImgAcquireApp(wx.App):
         
         if self.imgproducer_sony.isAlive() or self.imgconsumer_sony.isAlive():
             print "could not stop sony acquisition threads!"
+        print "Sony image queue:", self.imagequeue_sony.stats()
+        print "image writer:", self.imagewriter.stats()
         
         self.acquiring_sony = False
         
@@ -1947,6 +2107,8 @@ class ImgAcquireApp(wx.App):
         self.stop_threads()
         #self.ToggleGoButton(False)
         print "threads stopped"
+        self.imagewriter.close()
+        print "image writer:", self.imagewriter.stats()
             
         #if event.CanVeto():
         #    print "you are not serious"
@@ -2049,6 +2211,8 @@ def run_acquire():
     return gui
 
 if __name__ == '__main__':
+	multiprocessing.freeze_support()
+	init_cameras()
 	VimbAcq.open()  ####AVT
 	Guppy = AVTcam.AVTcam(VimbAcq.ID(),VimbAcq) ###AVT
 	gui = run_acquire()
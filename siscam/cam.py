@@ -19,12 +19,14 @@ import wx.lib.delayedresult as delayedresult
 
 from matplotlib.widgets import Button#, Cursor 
 from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.backends.backend_wx import StatusBarWx
 
 from matplotlib.backends.backend_wx import NavigationToolbar2Wx
 #from toolbar import NavigationToolbar2Wx
 
 from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
 
 ##imports
 #from readsis import loadimg, loadimg3
@@ -43,6 +45,9 @@ from roi import ROI
 import imagingpars
 import ImageTree
 import ImagePanel
+import reanalysis
+import fitcontours
+import absorption
 from custom_events import *
 #from profiling import Tic
 
@@ -55,6 +60,7 @@ reload(filewatch)
 reload(ding)
 reload(ImagePanel)
 reload(ImageTree)
+reload(reanalysis)
 
 
 class CamCursor(object):
@@ -421,9 +427,17 @@ class ImgPanel(wx.Panel):
         #initialize profiles
         self.create_profiles()
 
-        #initialize contour handles
+        #initialize contour lines, see contour_line
         self.hcontours = []
 
+        #background for incremental redraw, see redraw. Connect before
+        #creating selectors, their cursors save their background on
+        #draw events too.
+        self._background = None
+        self._background_layout = None
+        self._drawing = False
+        self.fig.canvas.mpl_connect('draw_event', self.ondraw)
+
         #create borders ROI
         self.hrx = []
 
@@ -541,60 +555,37 @@ class ImgPanel(wx.Panel):
         
         self.aximg.set_autoscale_on(False)
 
+    def contour_line(self, k):
+        """@return: k-th line for contours, created on first use and
+        reused for following fit results"""
+        while len(self.hcontours) <= k:
+            line = Line2D([], [],
+                          color = 'w',
+                          alpha = 0.5,
+                          linewidth = 1.0,
+                          visible = False)
+            self.aximg.add_line(line)
+            self.hcontours.append(line)
+        return self.hcontours[k]
+
     def clear_contours(self):
-        """remove contour lines from image axis"""
-        self.aximg.collections = [h for h in self.aximg.collections if h not in self.hcontours]
-        self.hcontours = []
+        """hide contour lines in image axis"""
+        for line in self.hcontours:
+            line.set_visible(False)
 
     def update_contours(self):
         try:
             self.clear_contours()
             if self.show_contours:
-                xlim = numpy.copy(self.aximg.get_xlim())
-                ylim = numpy.copy(self.aximg.get_ylim())
-
-                if isinstance(self.fitpars, fitting.FitParsBimodal2d):
-                    imgfitgauss = (self.imgfit[1] - self.img_background)
-                    imgfitbec   = (self.imgfit[0] - self.imgfit[1])
-                    cs = self.aximg.contour(self.roi.xrange_clipped(self.img),
-                               self.roi.yrange_clipped(self.img),
-                               imgfitgauss,
-                               [numpy.exp(-2)*imgfitgauss.max(),],
-                               colors = 'w',
-                               alpha = 0.5,
-                               linewidths = 1.0,
-                               linestyle = 'dashed')
-
-                    cs2 = self.aximg.contour(self.roi.xrange_clipped(self.img),
-                               self.roi.yrange_clipped(self.img),
-                               imgfitbec,
-                               [0.05*imgfitbec.max(),],
-                               colors = 'w',
-                               alpha = 0.5,
-                               linewidths = 1.0)#
-                    cs2.collections[0].set_linestyle('dashed')
-                    self.hcontours = cs.collections + cs2.collections
-
-                elif isinstance(self.fitpars, fitting.FitParsGauss2d):
-                    cs = self.aximg.contour(self.roi.xrange_clipped(self.img),
-                               self.roi.yrange_clipped(self.img),
-                               self.imgfit[0],
-                               [0.37*self.fitpars.OD],
-                               colors = 'w',
-                               alpha = 0.5,
-                               linewidths = 1.0)#
-                    self.hcontours = cs.collections
-
-                    #ip = self.fitpars.imaging_pars
-                    #fac = 1e-12*ip.pixelsize**2/ip.sigma0
-                    #print "roisum g", ((self.imgfit[0] - self.img_background).sum() \
-                    #* fac)
-
-                self.aximg.set_xlim(xlim)
-                self.aximg.set_ylim(ylim)
-
-            else:
-                self.hcontours = []
+                contours = fitcontours.fit_contours(self.fitpars,
+                                                    self.imgfit,
+                                                    self.roi.xrange_clipped(self.img),
+                                                    self.roi.yrange_clipped(self.img))
+                for k, (x, y, linestyle) in enumerate(contours):
+                    line = self.contour_line(k)
+                    line.set_data(x, y)
+                    line.set_linestyle(linestyle)
+                    line.set_visible(True)
                 
         except Exception, e:
             print "Error in update contours: ", e
@@ -667,24 +658,69 @@ class ImgPanel(wx.Panel):
         """
         apply image filtering, create self.img, (don't update image display data)
         """
-        img = self.rawimg
-        
-        ##compensate for finite optical density
-        ODmax = self.fit.imaging_pars.ODmax #TODO: this might fail if
-                                            #fit class is changed.
-        if ODmax > 0:
-            img = numpy.log((1 - numpy.exp(- ODmax)) / (numpy.exp(- img) - numpy.exp(- ODmax)))
-            #TODO: remove invalid entries
-            #TODO: this should not happen here!
-        
-        self.img = ma.array(img, mask= ~ numpy.isfinite(img))
-        if ODmax > 0:
-            self.img.set_fill_value(ODmax)
+        #TODO: this might fail if fit class is changed.
+        self.img = reanalysis.prepare_image(self.rawimg, self.fit.imaging_pars)
+        
+    def dynamic_artists(self):
+        """artists which change with every image or fit: everything in
+        the image axes (drawn on top of the image), profiles and fit
+        results. All other artists are static and restored from the
+        cached background by L{redraw}."""
+        artists = self.aximg.images + self.aximg.lines + self.aximg.collections
+        artists += [self.hhprof, self.hvprof] + self.hhproffit + self.hvproffit
+        artists.append(self.htxt)
+        return artists
+
+    def layout(self):
+        """state of static artists: if it changes, the cached
+        background is invalid"""
+        return (tuple(self.fig.bbox.bounds),
+                tuple(self.aximg.get_xlim()) + tuple(self.aximg.get_ylim()),
+                tuple(self.axhprof.get_xlim()) + tuple(self.axhprof.get_ylim()),
+                tuple(self.axvprof.get_xlim()) + tuple(self.axvprof.get_ylim()),
+                tuple(self.himg.get_clim()))
+
+    def ondraw(self, event):
+        #figure redrawn by canvas (resize, toolbar, selectors):
+        #background has to be saved again
+        if not self._drawing:
+            self._background = None
+
+    def redraw(self, full=False):
+        """show changes of dynamic artists. Only these are rendered
+        again on top of the cached background of the figure, which is
+        blitted to the screen. The whole figure is drawn if full is
+        True or the layout changed (limits, contrast, size)."""
+        canvas = self.fig.canvas
+        if full or self._background is None or self.layout() != self._background_layout:
+            #draw static artists only and save them as background
+            artists = [a for a in self.dynamic_artists() if a.get_visible()]
+            for a in artists:
+                a.set_visible(False)
+            self._drawing = True
+            try:
+                FigureCanvasAgg.draw(canvas)
+            finally:
+                self._drawing = False
+                for a in artists:
+                    a.set_visible(True)
+            self._background = canvas.copy_from_bbox(self.fig.bbox)
+            self._background_layout = self.layout()
         else:
-            self.img.set_fill_value(3) #which to take?
-        
-    def redraw(self):
-        self.fig.canvas.draw()
+            canvas.restore_region(self._background)
+
+        for ax in [self.aximg, self.axhprof, self.axvprof, self.axtxt]:
+            artists = [a for a in self.dynamic_artists() if a.axes is ax]
+            artists.sort(key=lambda a: a.get_zorder())
+            for a in artists:
+                ax.draw_artist(a)
+        #text is larger than its axes, blit figure
+        canvas.blit()
+
+        #cursors of active selectors show current image
+        for selector in self.hrx + self.hry + self.markers:
+            if selector.cursor.visible:
+                selector.cursor.save_background()
         
     def invalidate_parameters(self):
         self.htxt.set_alpha(0.6)
@@ -803,7 +839,7 @@ class ImgPanel(wx.Panel):
         self.axhprof.set_xlim(self.roi.xmin - border, self.roi.xmax + border)
         self.axvprof.set_ylim(self.roi.ymax + border, self.roi.ymin - border)
         
-        self.redraw()
+        self.redraw(full=True)
     
 ##results name
 
@@ -825,6 +861,8 @@ class ImgAppAui(wx.App):
     ID_Reload = wx.NewId()
     
     ID_FitShowContours = wx.NewId()
+    ID_FitPyramid = wx.NewId()
+    ID_FitWarmStart = wx.NewId()
     
     ID_FitRbNone = wx.NewId()
     ID_FitRbGauss = wx.NewId()
@@ -1251,6 +1289,15 @@ class ImgAppAui(wx.App):
             self.Rb.update()
             self.K.update()
 
+        if id in [self.ID_FitPyramid]:
+            #applies to all fit routines, also to ones created later
+            fitting.Fitting.pyramid = event.IsChecked()
+            self.Rb.update()
+            self.K.update()
+
+        if id in [self.ID_FitWarmStart]:
+            fitting.Fitting.warm_start = event.IsChecked()
+
         if id in [self.ID_FitRbNone]:
             self.Rb.fit = fitting.NoFit(self.imaging_pars['Rb'])
             self.Rb.update()
@@ -1534,6 +1581,12 @@ class ImgAppAui(wx.App):
                         'Show Contours',
                         'Show Contour lines')
         sc.Check()
+        fit_menu.AppendCheckItem(self.ID_FitPyramid,
+                                 'Coarse-to-fine fitting',
+                                 'Fit binned image first, then refine on full resolution (faster for large ROIs)')
+        fit_menu.AppendCheckItem(self.ID_FitWarmStart,
+                                 'Warm start',
+                                 'Start fit from result of previous image')
         fit_menu.AppendSeparator()
         
         fit_menu.AppendRadioItem(
@@ -1637,6 +1690,12 @@ class ImgAppAui(wx.App):
         self.frame.Bind(wx.EVT_MENU,
                         self.OnMenuFit,
                         id=self.ID_FitShowContours)
+        self.frame.Bind(wx.EVT_MENU,
+                        self.OnMenuFit,
+                        id=self.ID_FitPyramid)
+        self.frame.Bind(wx.EVT_MENU,
+                        self.OnMenuFit,
+                        id=self.ID_FitWarmStart)
         self.frame.Bind(wx.EVT_MENU_RANGE,
                         self.OnMenuFit,
                         id=self.ID_FitRbNone,
@@ -2442,10 +2501,7 @@ def test_img_from_disk():
     bkg = d['img3']
     d.close()
 
-    img1 = (img1 - bkg).astype(Float)
-    img2 = (img2 - bkg).astype(Float)
-
-    den = - log(img1 / img2)
+    den = absorption.optical_density(img1, img2, bkg)
 
     imgK = den[0:1040, :]
     imgRb = den[1040:2080, :]
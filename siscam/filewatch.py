@@ -1,44 +1,216 @@
 #!/usr/bin/python
 #-*- coding: latin-1 -*-
-"""Watch if a file is changed. Used for automatic reloading."""
+"""Watch if a file is changed. Used for automatic reloading.
+
+On Linux the directory of the file is watched with inotify: the
+callback is called as soon as the file is closed after writing, or a
+completed file is renamed to it (as L{imagewriter} does). Elsewhere,
+or if inotify is not available, the file is polled."""
+
+from __future__ import with_statement
 
 import threading
 import os
 import time
 import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
 
 def dosomething():
     print "filechange!"
     sys.stdout.flush()
 
+#inotify constants, see <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+#: header of struct inotify_event: wd, mask, cookie, len
+inotify_event = struct.Struct('iIII')
+
+def _load_inotify():
+    """@return: libc with inotify functions, or None if not available"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+_libc = _load_inotify()
+
 class FileChangeNotifier(threading.Thread):
+    """Thread calling callback after file has been written. Changes
+    of the file while the callback runs are coalesced into one further
+    call, none is lost. Set keeprunning to False to stop thread.
 
-    def __init__(self, filename, callback = dosomething, delay = 0.1):
+    @ivar backend: 'inotify' or 'polling'
+    @ivar delivered: number of callbacks
+    @ivar coalesced: number of changes delivered together with others"""
+
+    def __init__(self, filename, callback = dosomething, delay = 0.1,
+                 interval = 0.2, backend = None):
+        """
+        @param delay: for polling: time the file must stay unchanged
+        before it is considered complete
+        @param interval: for polling: time between checks; for
+        inotify: maximum time until thread sees keeprunning = False
+        @param backend: 'inotify' or 'polling', default: inotify if
+        available
+        """
         threading.Thread.__init__(self)
         self.filename = filename
         self.callback = callback
         self.delay = delay
+        self.interval = interval
+        if backend is None:
+            backend = 'inotify' if _libc is not None else 'polling'
+        self.backend = backend
+        self.delivered = 0
+        self.coalesced = 0
 
-        self.s = os.stat(self.filename)
+        self.s = self._signature()
         self.keeprunning = True
 
+        self._fd = None
+        if self.backend == 'inotify':
+            try:
+                self._fd = self._add_watch()
+            except OSError, e:
+                print "inotify not available (%s), polling %s"%(e, filename)
+                self.backend = 'polling'
+
     def run(self):
+        try:
+            if self.backend == 'inotify':
+                self._run_inotify()
+            else:
+                self._run_polling()
+        finally:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _deliver(self, changes = 1):
+        self.delivered += 1
+        self.coalesced += changes - 1
+        self.callback()
+
+    def _add_watch(self):
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        if _libc.inotify_add_watch(fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            e = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(e, os.strerror(e))
+        return fd
+
+    def _run_inotify(self):
+        #watch directory, since file may be replaced by rename
+        name = os.path.basename(self.filename)
         while self.keeprunning:
+            try:
+                ready = select.select([self._fd], [], [], self.interval)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+
+            #all events queued so far, delivered as one change
+            changes = 0
+            while True:
+                try:
+                    buf = os.read(self._fd, 65536)
+                except OSError, e:
+                    if e.errno == errno.EAGAIN:
+                        break
+                    raise
+                pos = 0
+                while pos < len(buf):
+                    wd, mask, cookie, length = inotify_event.unpack_from(buf, pos)
+                    pos += inotify_event.size
+                    eventname = buf[pos:pos + length].rstrip('\0')
+                    pos += length
+                    if eventname == name or mask & IN_Q_OVERFLOW:
+                        changes += 1
+
+            if changes:
+                self._deliver(changes)
+
+    def _signature(self):
+        #replacing the file by rename changes the inode, maybe not mtime
+        try:
             s = os.stat(self.filename)
-            if s.st_mtime > self.s.st_mtime:
-                #print "old time: ", self.s.st_mtime
-                #print "new time: ", s.st_mtime
+        except OSError:
+            return None
+        return (s.st_mtime, s.st_size, s.st_ino)
+
+    def _run_polling(self):
+        while self.keeprunning:
+            s = self._signature()
+            if s != self.s:
+                #wait until writing is finished
                 time.sleep(self.delay)
-                self.callback()
-                time.sleep(1)
-                self.s = os.stat(self.filename)
-                
-            time.sleep(0.2)
+                snew = self._signature()
+                if snew != s:
+                    continue
+                #take reference before callback: changes during
+                #callback are seen in next iteration
+                self.s = s
+                if s is not None:
+                    self._deliver()
+            time.sleep(self.interval)
+
+def test_notifier(backend = None, n = 20, period = 0.05):
+    """write file n times in place and by rename, measure time until
+    callback"""
+    import tempfile
+    import imagewriter
+
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'test.png')
+    open(filename, 'w').close()
+    written = []
+    latencies = []
+
+    def changed():
+        latencies.append(time.time() - written[-1])
+
+    notifier = FileChangeNotifier(filename, changed, backend = backend)
+    notifier.start()
+    time.sleep(0.1)
+    for k in range(n):
+        written.append(time.time())
+        if k%2:
+            with open(filename, 'w') as f:
+                f.write('x'*k)
+        else:
+            tmpname = filename + '.tmp'
+            with open(tmpname, 'w') as f:
+                f.write('x'*k)
+            imagewriter.replace(tmpname, filename)
+        time.sleep(period)
+    time.sleep(0.5)
+    notifier.keeprunning = False
+    notifier.join()
+
+    print "%s: %d writes, %d callbacks, %d coalesced, latency median %.1f ms, max %.1f ms"%(
+        notifier.backend, n, notifier.delivered, notifier.coalesced,
+        1e3*sorted(latencies)[len(latencies)//2], 1e3*max(latencies))
 
-    
 if __name__ == '__main__':
-    d = FileChangeNotifier('test')
-    d.start()
-    
-    
-        
+    test_notifier()
+    test_notifier('polling', n = 5, period = 0.5)
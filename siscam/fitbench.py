@@ -0,0 +1,394 @@
+#!/usr/bin/python
+#-*- coding: latin-1 -*-
+"""Benchmark of fit routines on synthetic clouds. For each fit class
+of L{fitting} a reproducible cloud of the matching type is generated
+for several ROI sizes and imaging conditions (noise, saturation of
+optical density, masked pixels). L{Fitting.do_fit} is timed, number of
+Levenberg-Marquardt iterations and deviation of fit results from
+ground truth are recorded. Results are written as JSON and can be
+compared against a stored baseline::
+
+    python fitbench.py --output baseline.json
+    (change something)
+    python fitbench.py --baseline baseline.json
+
+With C{--batch 16}, L{Fitting.do_fit_batch} on stacks of 16 images is
+timed against L{Fitting.do_fit} for each image.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import json
+import platform
+
+import numpy
+
+import LM
+import fitting
+import imagingpars
+from roi import ROI
+from reanalysis import prepare_image
+
+#: synthetic cloud for each fit class: name of model method of fit
+#: class, and true fit parameters as function of ROI width, height and
+#: cloud center
+clouds = {
+    'Gauss2d':       ('gauss2d',
+                      lambda w, h, mx, my: [1.2, mx, my, 0.12*w, 0.10*h, 0.02]),
+    'GaussSym2d':    ('gauss2d',
+                      lambda w, h, mx, my: [1.2, mx, my, 0.10*h, 0.02]),
+    'GaussBose2d':   ('gaussbose2d',
+                      lambda w, h, mx, my: [1.2, mx, my, 0.12*w, 0.10*h, 0.02]),
+    'Bimodal2d':     ('bimodal2d',
+                      lambda w, h, mx, my: [0.5, mx, my, 0.15*w, 0.13*h, 0.02,
+                                            1.5, 0.07*w, 0.06*h]),
+    'BoseBimodal2d': ('bimodal2d',
+                      lambda w, h, mx, my: [0.5, mx, my, 0.15*w, 0.13*h, 0.02,
+                                            1.5, 0.07*w, 0.06*h]),
+    'ThomasFermi2d': ('TF2d',
+                      lambda w, h, mx, my: [mx, my, 0.02, 1.8, 0.15*w, 0.12*h]),
+    }
+
+#: ROI sizes (width, height)
+sizes = {
+    'small':  (160, 120),
+    'medium': (480, 360),
+    'large':  (1392, 1040),
+    }
+
+#: imaging conditions: noise (standard deviation of optical density),
+#: maximum optical density (0: no saturation), fraction of randomly
+#: masked pixels
+conditions = {
+    'clean':     dict(noise = 0.02, ODmax = 0, maskfraction = 0),
+    'noisy':     dict(noise = 0.15, ODmax = 0, maskfraction = 0),
+    'saturated': dict(noise = 0.05, ODmax = 1.5, maskfraction = 0.01),
+    }
+
+class IterationCounter(object):
+    """context manager which counts calls of L{LM.LM} and
+    L{LM.LM_batch}, iterations and function evaluations of all fits
+    performed while active."""
+
+    def __init__(self):
+        self.calls = 0
+        self.iterations = 0
+        self.evaluations = 0
+
+    def _counting(self, lm):
+        def counting(*args, **kwargs):
+            info = kwargs.setdefault('info', {})
+            result = lm(*args, **kwargs)
+            self.calls += 1
+            self.iterations += info.get('iterations', 0)
+            self.evaluations += info.get('evaluations', 0)
+            return result
+        return counting
+
+    def __enter__(self):
+        self._saved = LM.LM, LM.LM_batch
+        LM.LM = self._counting(LM.LM)
+        LM.LM_batch = self._counting(LM.LM_batch)
+        return self
+
+    def __exit__(self, *exc):
+        LM.LM, LM.LM_batch = self._saved
+        return False
+
+def make_image(fit, size, noise = 0.02, ODmax = 0, maskfraction = 0, seed = 0):
+    """create synthetic absorption image of cloud matching fit
+    routine (see L{clouds}). The optical density is saturated at
+    ODmax, noise is added and the image is prepared for fitting like
+    saved images (L{reanalysis.prepare_image}), i.e., saturation is
+    compensated and invalid pixels are masked.
+
+    @param fit: fit routine, its imaging parameters should have ODmax set
+    @type fit: L{fitting.Fitting}
+    @param size: (width, height) of image
+    @param seed: seed of random number generator, for reproducible images
+
+    @return: image, true fit parameters
+    @rtype: masked array, ndarray
+    """
+    rng = numpy.random.RandomState(seed)
+    w, h = size
+    x = numpy.arange(w, dtype = fitting.imgtype).reshape((1, -1))
+    y = numpy.arange(h, dtype = fitting.imgtype).reshape((-1, 1))
+
+    method, parameters = clouds[fit.__class__.__name__]
+    mx = w*rng.uniform(0.45, 0.55)
+    my = h*rng.uniform(0.45, 0.55)
+    truepars = numpy.array(parameters(w, h, mx, my))
+
+    od = numpy.asarray(getattr(fit, method)(truepars, x, y), dtype = numpy.float64)
+    if ODmax > 0:
+        #detected optical density for finite maximum optical density
+        od = -numpy.log(numpy.exp(-ODmax) + (1 - numpy.exp(-ODmax))*numpy.exp(-od))
+    od += noise*rng.standard_normal(od.shape)
+
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        img = prepare_image(od.astype(fitting.imgtype), fit.imaging_pars)
+    if maskfraction > 0:
+        img[rng.uniform(size = img.shape) < maskfraction] = numpy.ma.masked
+    return img, truepars
+
+def parameter_errors(fitpars, truefitpars):
+    """deviation of fit results from ground truth, for all values of
+    fit result object except errors and sigma. Positions (mx, my) and
+    values with vanishing true value: absolute deviation, else
+    relative deviation.
+
+    @type fitpars: L{fitting.FitPars}
+    @type truefitpars: L{fitting.FitPars}
+    @rtype: dict
+    """
+    errors = {}
+    for key in fitpars.fitparnames:
+        if key.endswith('err') or key == 'sigma':
+            continue
+        value, truevalue = getattr(fitpars, key), getattr(truefitpars, key)
+        if key in ('mx', 'my') or truevalue == 0:
+            errors[key] = float(abs(value - truevalue))
+        else:
+            errors[key] = float(abs(value/truevalue - 1))
+    return errors
+
+def run_fit(fitclass, size, condition, repeat = 3, seed = 0, quiet = True):
+    """benchmark L{Fitting.do_fit} of fit class on synthetic image.
+    Result cache is disabled, the fit is repeated, minimum of wall
+    time is taken.
+
+    @param quiet: suppress output of fit routine
+
+    @return: result record
+    @rtype: dict
+    """
+    ip = imagingpars.ImagingPars()
+    ip.ODmax = conditions[condition]['ODmax']
+    fit = fitclass(ip)
+    fit.use_result_cache = False
+
+    img, truepars = make_image(fit, sizes[size], seed = seed, **conditions[condition])
+    r = ROI(0, img.shape[1], 0, img.shape[0])
+
+    times = []
+    stdout = sys.stdout
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        for k in range(repeat):
+            with IterationCounter() as counter:
+                tic = time.time()
+                imgfit, background, fitpars = fit.do_fit(img, r)
+                times.append(time.time() - tic)
+    finally:
+        if quiet:
+            sys.stdout.close()
+        sys.stdout = stdout
+
+    truefitpars = fit.make_fitpars(truepars, numpy.zeros_like(truepars), 0.0)
+    return {'name': '%s/%s/%s'%(fitclass.__name__, size, condition),
+            'fit': fitclass.__name__,
+            'size': size,
+            'shape': list(img.shape),
+            'condition': condition,
+            'time': min(times),
+            'times': times,
+            'lm_calls': counter.calls,
+            'iterations': counter.iterations,
+            'evaluations': counter.evaluations,
+            'valid': bool(fitpars.valid),
+            'sigma': float(fitpars.sigma),
+            'errors': parameter_errors(fitpars, truefitpars),
+            }
+
+def run_batch(fitclass, size, condition, count = 16, repeat = 1, seed = 0, quiet = True):
+    """benchmark L{Fitting.do_fit_batch} against L{Fitting.do_fit} for
+    each image, for stack of synthetic images (seeds seed, ...,
+    seed+count-1, i.e., clouds at different positions). Result cache is
+    disabled, minimum of wall time is taken.
+
+    @param count: number of images in stack
+    @param quiet: suppress output of fit routine
+
+    @return: result record like L{run_fit}, times per image, errors:
+    maximum over all images
+    @rtype: dict
+    """
+    ip = imagingpars.ImagingPars()
+    ip.ODmax = conditions[condition]['ODmax']
+    fit = fitclass(ip)
+    fit.use_result_cache = False
+
+    images, trues = zip(*[make_image(fit, sizes[size], seed = seed + k, **conditions[condition])
+                          for k in range(count)])
+    h, w = images[0].shape
+    r = ROI(0, w, 0, h)
+
+    times = []
+    times_single = []
+    stdout = sys.stdout
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        for k in range(repeat):
+            tic = time.time()
+            single = [fit.do_fit(img, r)[2] for img in images]
+            times_single.append((time.time() - tic)/count)
+
+            tic = time.time()
+            fitpar, fitparerr, imgfits, batch = fit.do_fit_batch(images, r)
+            times.append((time.time() - tic)/count)
+    finally:
+        if quiet:
+            sys.stdout.close()
+        sys.stdout = stdout
+
+    def max_errors(results):
+        errors = {}
+        for fitpars, truepars in zip(results, trues):
+            truefitpars = fit.make_fitpars(truepars, numpy.zeros_like(truepars), 0.0)
+            for key, err in parameter_errors(fitpars, truefitpars).iteritems():
+                errors[key] = max(err, errors.get(key, 0.0))
+        return errors
+
+    return {'name': '%s/%s/%s/batch%d'%(fitclass.__name__, size, condition, count),
+            'fit': fitclass.__name__,
+            'size': size,
+            'shape': [count, h, w],
+            'condition': condition,
+            'time': min(times),
+            'times': times,
+            'time_single': min(times_single),
+            'speedup': min(times_single)/min(times),
+            'valid': all(fitpars.valid for fitpars in batch),
+            'errors': max_errors(batch),
+            'errors_single': max_errors(single),
+            }
+
+def run(fits = None, sizenames = ('small', 'medium'), conditionnames = None,
+        repeat = 3, seed = 0, verbose = True, batch = 0):
+    """run benchmark for all combinations of fit classes, ROI sizes
+    and imaging conditions.
+
+    @param fits: names of fit classes, default: all with entry in L{clouds}
+    @param batch: if nonzero, benchmark batch fits of stacks of this
+    many images instead (see L{run_batch})
+    @return: benchmark results, with list of result records (see
+    L{run_fit}) as entry 'results'
+    @rtype: dict
+    """
+    if fits is None:
+        fits = sorted(clouds)
+    if conditionnames is None:
+        conditionnames = sorted(conditions)
+
+    results = []
+    for name in fits:
+        for size in sizenames:
+            for condition in conditionnames:
+                if batch:
+                    result = run_batch(getattr(fitting, name), size, condition,
+                                       batch, repeat, seed)
+                else:
+                    result = run_fit(getattr(fitting, name), size, condition, repeat, seed)
+                results.append(result)
+                if verbose:
+                    print format_result(result)
+
+    return {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'seed': seed,
+            'results': results}
+
+def format_result(result):
+    if 'speedup' in result:
+        return "%-36s %8.1f ms/image (do_fit %.1f ms, %4.1fx) %s max err %.2e (do_fit %.2e)"%(
+            result['name'], 1e3*result['time'], 1e3*result['time_single'],
+            result['speedup'],
+            'valid  ' if result['valid'] else 'INVALID',
+            max(result['errors'].values()),
+            max(result['errors_single'].values()))
+    return "%-36s %8.1f ms %4d it %5d ev %s max err %.2e"%(
+        result['name'], 1e3*result['time'],
+        result['iterations'], result['evaluations'],
+        'valid  ' if result['valid'] else 'INVALID',
+        max(result['errors'].values()))
+
+def compare(results, baseline,
+            time_tolerance = 0.25, error_tolerance = 0.5, error_floor = 1e-3):
+    """compare benchmark results against baseline. Entries are
+    matched by name, entries missing in one of both are ignored.
+
+    @param time_tolerance: fit is slower if time exceeds baseline by
+    this fraction
+    @param error_tolerance: fit is less accurate if deviation of a
+    fit result from ground truth exceeds that of baseline by this
+    fraction plus error_floor
+    @return: descriptions of regressions, empty if none
+    @rtype: list of str
+    """
+    base = dict((r['name'], r) for r in baseline['results'])
+    regressions = []
+    for r in results['results']:
+        b = base.get(r['name'])
+        if b is None:
+            continue
+        if r['time'] > (1 + time_tolerance)*b['time']:
+            regressions.append("%s: slower, %.1f ms (baseline %.1f ms)"%(
+                r['name'], 1e3*r['time'], 1e3*b['time']))
+        if b['valid'] and not r['valid']:
+            regressions.append("%s: fit invalid"%r['name'])
+        for key, err in sorted(r['errors'].iteritems()):
+            berr = b['errors'].get(key)
+            if berr is not None and err > (1 + error_tolerance)*berr + error_floor:
+                regressions.append("%s: less accurate, %s error %.2e (baseline %.2e)"%(
+                    r['name'], key, err, berr))
+    return regressions
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'benchmark fit routines on synthetic clouds')
+    parser.add_argument('--fits', nargs = '+', default = None, choices = sorted(clouds),
+                        help = 'fit classes, default: all')
+    parser.add_argument('--sizes', nargs = '+', default = ['small', 'medium'],
+                        choices = sorted(sizes))
+    parser.add_argument('--conditions', nargs = '+', default = None,
+                        choices = sorted(conditions))
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--batch', type = int, default = 0, metavar = 'COUNT',
+                        help = 'benchmark do_fit_batch on stacks of COUNT images')
+    parser.add_argument('--output', help = 'write results to file (JSON)')
+    parser.add_argument('--baseline', help = 'compare with results in file (JSON)')
+    parser.add_argument('--time-tolerance', type = float, default = 0.25)
+    parser.add_argument('--error-tolerance', type = float, default = 0.5)
+    args = parser.parse_args()
+
+    results = run(args.fits, args.sizes, args.conditions, args.repeat, args.seed,
+                  batch = args.batch)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 1, sort_keys = True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline,
+                              args.time_tolerance, args.error_tolerance)
+        for line in regressions:
+            print line
+        if regressions:
+            sys.exit(1)
+        print "no regressions against %s"%args.baseline
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+#-*- coding: latin-1 -*-
+"""Contour lines of fit results, for the overlays of
+L{cam.ImgPanel}. Kept free of matplotlib, so that it can be used and
+timed without GUI.
+
+For the fit models of L{fitting} the contour lines are ellipses
+around the center of the cloud: the gaussian (thermal cloud) and the
+inverted parabola (BEC, Thomas-Fermi profile) depend only on the
+normalized radius. The radius at which the profile drops to a given
+fraction of its peak is calculated from the fit parameters, the
+ellipse is sampled at a fixed number of points; no fit image is
+evaluated. For other fit results the contour of the fit image is
+traced by L{marching_squares}.
+
+Contours are returned as (x, y, linestyle), with x and y in image
+pixel coordinates and the matplotlib linestyle ('-' thermal cloud,
+'--' BEC). Separate pieces of a contour line are separated by
+NaN, as understood by matplotlib Line2D."""
+
+import numpy
+
+import fitting
+
+#: number of points of ellipses
+npoints = 73
+
+#: contour level of gaussian fits, fraction of peak optical density
+level_gauss = 0.37
+#: contour level of thermal cloud of bimodal fits
+level_thermal = numpy.exp(-2)
+#: contour level of BEC, fraction of peak optical density of BEC
+level_bec = 0.05
+
+_phi = numpy.linspace(0, 2*numpy.pi, npoints)
+_cos = numpy.cos(_phi)
+_sin = numpy.sin(_phi)
+
+def ellipse(mx, my, ax, ay):
+    """@return: x and y values of axis-aligned ellipse, closed
+    @rtype: (ndarray, ndarray)"""
+    return mx + abs(ax)*_cos, my + abs(ay)*_sin
+
+def radius_gauss(f):
+    """@return: normalized radius at which gaussian exp(-r**2/2)
+    drops to fraction f of its peak, None if f not in (0, 1)"""
+    if not 0 < f < 1:
+        return None
+    return numpy.sqrt(-2*numpy.log(f))
+
+def radius_parabola(f):
+    """@return: normalized radius at which Thomas-Fermi profile
+    (1-r**2)**(3/2) drops to fraction f of its peak, None if f not in
+    (0, 1)"""
+    if not 0 < f < 1:
+        return None
+    return numpy.sqrt(1 - f**(2.0/3))
+
+#u and g2(u)/g2(1) on a grid, for inverting g2 in radius_bose
+_g2_table = None
+
+def radius_bose(f):
+    """@return: normalized radius at which bose enhanced gaussian
+    g2(exp(-r**2/2)) drops to fraction f of its peak g2(1), None if f
+    not in (0, 1)"""
+    global _g2_table
+    if not 0 < f < 1:
+        return None
+    #g2 is monotonic: interpolate inverse from table, computed once
+    if _g2_table is None:
+        u = numpy.linspace(0, 1, 4097)
+        g = fitting.g2(u.copy())
+        _g2_table = u, g/g[-1]
+    u, g = _g2_table
+    return numpy.sqrt(-2*numpy.log(numpy.interp(f, g, u)))
+
+def marching_squares(x, y, img, level):
+    """contour line of image at level, for images without analytic
+    contour. All cells are processed at once; each cell crossed by the
+    contour gives a separate segment, segments are not joined to
+    polylines. Masked or NaN pixels count as below level.
+
+    @param x: x values of columns (M)
+    @param y: y values of rows (N)
+    @param img: image (NxM)
+    @return: x and y values of segments, separated by NaN
+    @rtype: (ndarray, ndarray)
+    """
+    x = numpy.asarray(x, dtype = numpy.float64).ravel()
+    y = numpy.asarray(y, dtype = numpy.float64).ravel()
+    v = numpy.ma.filled(numpy.ma.asarray(img, dtype = numpy.float64), numpy.nan)
+    if v.shape[0] < 2 or v.shape[1] < 2:
+        return numpy.empty(0), numpy.empty(0)
+    with numpy.errstate(invalid = 'ignore'):
+        above = v > level
+
+    #corners of cells: a top left, b top right, c bottom right, d bottom left
+    a, b, c, d = v[:-1, :-1], v[:-1, 1:], v[1:, 1:], v[1:, :-1]
+    A, B, C, D = above[:-1, :-1], above[:-1, 1:], above[1:, 1:], above[1:, :-1]
+    cells = numpy.nonzero((A != B) | (B != C) | (C != D))
+    if not len(cells[0]):
+        return numpy.empty(0), numpy.empty(0)
+    i, j = cells
+    a, b, c, d = a[cells], b[cells], c[cells], d[cells]
+    A, B, C, D = A[cells], B[cells], C[cells], D[cells]
+
+    def crossing(v0, v1):
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            t = (level - v0)/(v1 - v0)
+        #NaN corner: cross at middle of edge
+        return numpy.where(numpy.isfinite(t), numpy.clip(t, 0, 1), 0.5)
+
+    #crossing points on edges top, right, bottom, left
+    t = crossing(a, b)
+    top = (x[j] + t*(x[j+1] - x[j]), y[i])
+    t = crossing(b, c)
+    right = (x[j+1], y[i] + t*(y[i+1] - y[i]))
+    t = crossing(d, c)
+    bottom = (x[j] + t*(x[j+1] - x[j]), y[i+1])
+    t = crossing(a, d)
+    left = (x[j], y[i] + t*(y[i+1] - y[i]))
+    edges = [top, right, bottom, left]
+    crossed = numpy.array([A != B, B != C, C != D, D != A])
+
+    #two crossed edges: one segment between them
+    single = crossed.sum(0) == 2
+    first = numpy.argmax(crossed, 0)
+    last = 3 - numpy.argmax(crossed[::-1], 0)
+    pts_x = numpy.array([e[0] for e in edges])
+    pts_y = numpy.array([e[1] for e in edges])
+    idx = numpy.nonzero(single)[0]
+    segments = [(pts_x[first[idx], idx], pts_y[first[idx], idx],
+                 pts_x[last[idx], idx], pts_y[last[idx], idx])]
+
+    #saddle: two segments, separating the corners whose region is
+    #not connected through the center of the cell
+    idx = numpy.nonzero(~single)[0]
+    if len(idx):
+        with numpy.errstate(invalid = 'ignore'):
+            center = 0.25*(a[idx] + b[idx] + c[idx] + d[idx]) > level
+        cut_bd = A[idx] == center
+        p1 = numpy.zeros_like(idx) #top
+        q1 = numpy.where(cut_bd, 1, 3) #right or left
+        p2 = numpy.where(cut_bd, 2, 1) #bottom or right
+        q2 = numpy.where(cut_bd, 3, 2) #left or bottom
+        for p, q in [(p1, q1), (p2, q2)]:
+            segments.append((pts_x[p, idx], pts_y[p, idx],
+                             pts_x[q, idx], pts_y[q, idx]))
+
+    x0, y0, x1, y1 = [numpy.concatenate(s) for s in zip(*segments)]
+    nan = numpy.empty_like(x0)
+    nan.fill(numpy.nan)
+    return (numpy.column_stack((x0, x1, nan)).ravel(),
+            numpy.column_stack((y0, y1, nan)).ravel())
+
+def fit_contours(fitpars, imgfit = None, x = None, y = None):
+    """contour lines of fit result, as shown on top of the image
+
+    @param fitpars: fit result
+    @type fitpars: L{fitting.FitPars}
+    @param imgfit: fit images and x, y values of ROI, only needed for
+    fit results without analytic contour
+    @return: list of contours (x, y, linestyle)
+    """
+    contours = []
+    if isinstance(fitpars, fitting.FitParsNoFit):
+        return contours
+
+    if isinstance(fitpars, fitting.FitParsBimodal2d):
+        #thermal cloud and BEC, levels relative to their own peak
+        if isinstance(fitpars, fitting.FitParsBoseBimodal2d):
+            r = radius_bose(level_thermal)
+        else:
+            r = radius_gauss(level_thermal)
+        if r is not None and fitpars.A > 0:
+            contours.append(ellipse(fitpars.mx, fitpars.my, r*fitpars.sxpx, r*fitpars.sypx)
+                            + ('-',))
+        r = radius_parabola(level_bec)
+        if fitpars.B > 0:
+            contours.append(ellipse(fitpars.mx, fitpars.my, r*fitpars.rxpx, r*fitpars.rypx)
+                            + ('--',))
+
+    elif isinstance(fitpars, fitting.FitParsGauss2d):
+        #level relative to optical density, fit image includes offset
+        level = level_gauss*fitpars.OD - fitpars.offset
+        if fitpars.A > 0:
+            if isinstance(fitpars, fitting.FitParsGaussBose2d):
+                r = radius_bose(level/(fitpars.A*numpy.pi**2/6)) #g2(1)
+            else:
+                r = radius_gauss(level/fitpars.A)
+            if r is not None:
+                contours.append(ellipse(fitpars.mx, fitpars.my, r*fitpars.sxpx, r*fitpars.sypx)
+                                + ('-',))
+
+    elif isinstance(fitpars, fitting.FitParsTF2d):
+        r = radius_parabola(level_bec)
+        if fitpars.B > 0:
+            contours.append(ellipse(fitpars.mx, fitpars.my, r*fitpars.rxpx, r*fitpars.rypx)
+                            + ('--',))
+
+    elif imgfit is not None and len(imgfit):
+        img = numpy.asarray(imgfit[0])
+        contours.append(marching_squares(x, y, img, level_gauss*img.max()) + ('-',))
+
+    return contours
+
+def test_contours():
+    import time
+    import imagingpars
+
+    ip = imagingpars.ImagingPars()
+    x = numpy.arange(200, 400, dtype = numpy.float32).reshape((1, -1))
+    y = numpy.arange(100, 260, dtype = numpy.float32).reshape((-1, 1))
+    pars = numpy.array([1.2, 310.3, 170.8, 25.0, 14.0, 0.05, 0.8, 30.0, 20.0])
+
+    def on_contour(cx, cy, img, level):
+        #values of bilinear interpolation of image at contour points
+        take = numpy.isfinite(cx)
+        ix = numpy.interp(cx[take], x.ravel(), numpy.arange(x.size))
+        iy = numpy.interp(cy[take], y.ravel(), numpy.arange(y.size))
+        j, i = numpy.minimum(ix.astype(int), x.size - 2), numpy.minimum(iy.astype(int), y.size - 2)
+        u, v = ix - j, iy - i
+        val = (img[i, j]*(1-u)*(1-v) + img[i, j+1]*u*(1-v)
+               + img[i+1, j]*(1-u)*v + img[i+1, j+1]*u*v)
+        return abs(val - level).max()
+
+    fit = fitting.Gauss2d(ip)
+    fp = fit.make_fitpars(pars[:6], numpy.zeros(6), 0.0)
+    img = fit.fit_images(pars[:6], x, y)[0]
+    level = level_gauss*fp.OD
+    (cx, cy, style), = fit_contours(fp)
+    assert on_contour(cx, cy, img, level) < 2e-3*fp.OD
+    mx, my, style = marching_squares(x, y, img, level) + ('-',)
+    assert on_contour(mx, my, img, level) < 2e-2*fp.OD
+
+    fit = fitting.GaussBose2d(ip)
+    fp = fit.make_fitpars(pars[:6], numpy.zeros(6), 0.0)
+    img = fit.fit_images(pars[:6], x, y)[0]
+    level = level_gauss*fp.OD
+    (cx, cy, style), = fit_contours(fp)
+    assert on_contour(cx, cy, img, level) < 2e-3*fp.OD
+
+    fit = fitting.Bimodal2d(ip)
+    fp = fit.make_fitpars(pars, numpy.zeros(9), 0.0)
+    img, imggauss = fit.fit_images(pars, x, y)
+    (tx, ty, tstyle), (bx, by, bstyle) = fit_contours(fp)
+    thermal = imggauss - fp.offset
+    assert on_contour(tx, ty, thermal, level_thermal*fp.A) < 2e-3*fp.A
+    assert on_contour(bx, by, img - imggauss, level_bec*fp.B) < 2e-3*fp.B
+
+    fit = fitting.BoseBimodal2d(ip)
+    fp = fit.make_fitpars(pars, numpy.zeros(9), 0.0)
+    img, imggauss = fit.fit_images(pars, x, y)
+    (tx, ty, tstyle), (bx, by, bstyle) = fit_contours(fp)
+    thermal = imggauss - fp.offset
+    assert on_contour(tx, ty, thermal, level_thermal*thermal.max()) < 2e-3*thermal.max()
+
+    n = 100
+    t = time.time()
+    for k in range(n):
+        fit_contours(fp)
+    t_fit = (time.time() - t)/n
+    t = time.time()
+    for k in range(n):
+        marching_squares(x, y, thermal, level_thermal*thermal.max())
+    t_ms = (time.time() - t)/n
+    print "contour test passed: analytic %.2f ms, marching squares %.2f ms (%dx%d)"%(
+        1e3*t_fit, 1e3*t_ms, img.shape[1], img.shape[0])
+
+if __name__ == '__main__':
+    test_contours()
@@ -19,6 +19,10 @@ import LM
 reload(LM)
 
 import sys
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
 from time import clock as time
 imgtype = numpy.float32
 
@@ -64,9 +68,322 @@ Search for peaks in data. Reurn arrays may contain NaN, e.g., if less peaks than
         pos_peaks = pos_peaks[ind]
         if numpy.isfinite(val_peaks).sum() == 0: 
             break
-        
+
     return vals, loc
 
+def filled(img):
+    """@return: for masked arrays data with masked values replaced
+    by fill value, otherwise unchanged data"""
+    try:
+        return img.filled()
+    except AttributeError:
+        return img
+
+def bin_image(x, y, img, b):
+    """mask-aware block binning of image in blocks of b x b pixels.
+    Incomplete blocks at the border are dropped.
+
+    @param x: x values (1xM row vector)
+    @param y: y values (Nx1 column vector)
+    @param img: image (NxM), optionally masked
+
+    @return: x values of block centers (1 x M/b), y values (N/b x 1),
+    binned image (mean of valid pixels in each block, masked if block
+    contains no valid pixel)
+    @rtype: (ndarray, ndarray, masked array)
+    """
+    N, M = img.shape
+    Nb, Mb = N//b, M//b
+    img = img[:Nb*b, :Mb*b]
+
+    valid = ~numpy.ma.getmaskarray(img)
+    data = numpy.where(valid, numpy.ma.getdata(img), 0)
+
+    blocksum = data.reshape((Nb, b, Mb, b)).sum(3).sum(1)
+    count = valid.reshape((Nb, b, Mb, b)).sum(3).sum(1)
+    imgb = numpy.ma.array(blocksum / numpy.maximum(count, 1),
+                          mask = (count == 0),
+                          dtype = imgtype)
+
+    xb = numpy.asarray(x).ravel()[:Mb*b].reshape((Mb, b)).mean(1).astype(imgtype)
+    yb = numpy.asarray(y).ravel()[:Nb*b].reshape((Nb, b)).mean(1).astype(imgtype)
+    xb.shape = (1, -1)
+    yb.shape = (-1, 1)
+    return xb, yb, imgb
+
+def gauss_factors(dx, dy, sx, sy):
+    """factorize axis-aligned 2d gaussian exp(-dx**2/(2 sx**2) -
+    dy**2/(2 sy**2)) into product gx*gy of 1d gaussians. For dx as row
+    and dy as column vector only O(M+N) instead of O(M*N) exponentials
+    are needed.
+
+    @param dx: x values relative to center (e.g. 1xM row vector)
+    @param dy: y values relative to center (e.g. Nx1 column vector)
+    @return: gx, gy
+    """
+    return numpy.exp(- dx**2 / (2*sx**2)), numpy.exp(- dy**2 / (2*sy**2))
+
+def gauss_batch_data(stack, masks):
+    """prepare stack of images for L{gauss_normal_batch}: masked pixels
+    set to zero, sums of data and squared data, positions of masked
+    pixels.
+
+    @param stack: images (K x N x M), optionally masked
+    @param masks: flattened masks of images, one per row, True for
+    ignored pixels
+    @return: data, sum of data, sum of squared data, [(rows, columns)
+    of masked pixels, ...]
+    """
+    data = numpy.array(numpy.ma.getdata(stack), dtype = numpy.float64)
+    masks = numpy.asarray(masks).reshape(data.shape)
+    data[masks] = 0
+    datasum = data.sum(2).sum(1)
+    datasq = numpy.einsum('kij,kij->k', data, data)
+    masked = [numpy.nonzero(mask) for mask in masks]
+    return data, datasum, datasq, masked
+
+def gauss_normal_batch(pars, index, x, y, data, datasum, datasq, masked):
+    """normal equations of fits of axis-aligned 2d gaussian (parameters
+    as in L{Gauss2d}) to several images, for L{LM.LM_batch_normal}.
+
+    The Jacobian of the gaussian A*gx*gy + offs with respect to each
+    parameter is a product u(x)*v(y) of factors for x and y. Thus the
+    normal matrix J J^T is calculated from sums over rows and columns
+    only, and the data enter only by a matrix product with the x
+    factors: O(N*M) operations per image (a BLAS call), instead of
+    evaluating the model and Jacobian for every pixel. Contributions
+    of masked pixels are subtracted explicitly.
+
+    @param pars: parameters for members (n x 6)
+    @param index: images of members
+    @param x: x values (1xM row vector)
+    @param y: y values (Nx1 column vector)
+    @param data: see L{gauss_batch_data}
+    @return: normal matrices (n x 6 x 6), gradients (n x 6), squared
+    norms of residua (n), None
+    """
+    n = len(pars)
+    A, mx, my, sx, sy, offs = [pars[:, k:k+1] for k in range(6)]
+    dx = numpy.asarray(x, dtype = numpy.float64).reshape((1, -1)) - mx
+    dy = numpy.asarray(y, dtype = numpy.float64).reshape((1, -1)) - my
+    gx, gy = gauss_factors(dx, dy, sx, sy)
+
+    #Jacobian: J[k] = U[k](x) * V[k](y)
+    U = numpy.empty(shape = (n, 6, dx.shape[1]))
+    V = numpy.empty(shape = (n, 6, dy.shape[1]))
+    U[:, [0, 2, 4]] = gx[:, numpy.newaxis]
+    U[:, 1] = A*gx*dx/sx**2
+    U[:, 3] = A*gx*dx**2/sx**3
+    U[:, 5] = 1
+    V[:, [0, 1, 3]] = gy[:, numpy.newaxis]
+    V[:, 2] = A*gy*dy/sy**2
+    V[:, 4] = A*gy*dy**2/sy**3
+    V[:, 5] = 1
+
+    UU = numpy.matmul(U, U.swapaxes(1, 2))
+    VV = numpy.matmul(V, V.swapaxes(1, 2))
+    JJ = UU*VV
+
+    #J data: sum over y of V[k](y) * sum over x of data(y, x) U[k](x),
+    #matrix product per member (BLAS, no copy of data)
+    W = numpy.empty(shape = (n, dy.shape[1], 6))
+    for j, i in enumerate(index):
+        numpy.dot(data[i], U[j].T, W[j])
+    Jd = numpy.einsum('nky,nyk->nk', V, W)
+
+    #model A*J[0] + offs*J[5]
+    A, offs = A[:, 0], offs[:, 0]
+    g = A[:, numpy.newaxis]*JJ[:, :, 0] + offs[:, numpy.newaxis]*JJ[:, :, 5] - Jd
+    F = (A**2*JJ[:, 0, 0] + 2*A*offs*JJ[:, 0, 5] + offs**2*JJ[:, 5, 5]
+         - 2*(A*Jd[:, 0] + offs*datasum[index]) + datasq[index])
+
+    for j, i in enumerate(index):
+        rows, cols = masked[i]
+        if len(rows):
+            Jp = U[j][:, cols]*V[j][:, rows]
+            mp = A[j]*Jp[0] + offs[j]
+            JJ[j] -= numpy.dot(Jp, Jp.T)
+            g[j] -= numpy.dot(Jp, mp)
+            F[j] -= numpy.dot(mp, mp)
+    return JJ, g, F, None
+
+def ellipse_box(x, y, mx, my, rx, ry):
+    """bounding box of ellipse ((x-mx)/rx)**2 + ((y-my)/ry)**2 < 1,
+    i.e. of support of Thomas-Fermi profile
+
+    @param x: x values (1xM row vector)
+    @param y: y values (Nx1 column vector)
+    @return: slices of rows and columns, None if no pixel is inside
+    """
+    cols = numpy.flatnonzero(abs(numpy.ravel(x) - mx) < abs(rx))
+    rows = numpy.flatnonzero(abs(numpy.ravel(y) - my) < abs(ry))
+    if len(cols) == 0 or len(rows) == 0:
+        return None
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+def bimodal_linear(FtF, Fty):
+    """linear parameters (thermal and condensate amplitude, offset) of
+    reduced bimodal fit from normal equations, negative amplitudes
+    forced to zero like in L{Bimodal2d.fJr}"""
+    def solve(sub):
+        try:
+            return numpy.linalg.solve(FtF[numpy.ix_(sub, sub)], Fty[sub])
+        except numpy.linalg.LinAlgError:
+            return numpy.linalg.lstsq(FtF[numpy.ix_(sub, sub)], Fty[sub])[0]
+
+    c = solve([0, 1, 2])
+    if c[1] < 0:
+        cm = solve([0, 2])
+        c = numpy.array([cm[0], 0.0, cm[1]])
+    if c[0] < 0:
+        cm = solve([1, 2])
+        c = numpy.array([0.0, cm[0], cm[1]])
+    return c
+
+def bimodal_reduced_normal(pars, H, h, datasq):
+    """normal equations of reduced bimodal fits (see L{Bimodal2d.fJr})
+    of several images, from inner products of basis functions only
+    (see L{Bimodal2d.basis_normal}).
+
+    The linear functions (thermal part, parabola**3, offset) and their
+    derivatives with respect to the nonlinear parameters are linear
+    combinations of the 11 basis functions, so is the Jacobian of the
+    reduced problem. Normal matrix, gradient and norm of residuum
+    follow from the inner products H of the basis functions and h of
+    basis functions and data.
+
+    @param pars: nonlinear parameters mx, my, sx, sy, rx, ry (n x 6)
+    @param H: inner products of basis functions (n x 11 x 11)
+    @param h: inner products of basis functions and data (n x 11)
+    @param datasq: squared norms of data (n)
+    @return: normal matrices (n x 6 x 6), gradients (n x 6), squared
+    norms of residua (n), [(linear parameters, normal matrix of linear
+    and nonlinear parameters (9 x 9)), ...]
+    """
+    n = len(pars)
+    mx, my, sx, sy, rx, ry = pars.T
+    FtF = H[:, :3, :3]
+    Fty = h[:, :3]
+
+    c = numpy.array([bimodal_linear(FtF[j], Fty[j]) for j in range(n)])
+
+    #derivatives of linear functions: Fd[j] = D[j] * basis functions
+    D = numpy.zeros((n, 6, 3, 11))
+    D[:, 0, 0, 3] = 1.0/sx**2
+    D[:, 0, 1, 7] = 3.0/rx**2
+    D[:, 1, 0, 4] = 1.0/sy**2
+    D[:, 1, 1, 8] = 3.0/ry**2
+    D[:, 2, 0, 5] = 1.0/sx**3
+    D[:, 3, 0, 6] = 1.0/sy**3
+    D[:, 4, 1, 9] = 3.0/rx**3
+    D[:, 5, 1, 10] = 3.0/ry**3
+
+    #coefficients of c*Fd[j], inner products of basis functions with residuum
+    e = numpy.einsum('ni,njik->njk', c, D)
+    q = numpy.einsum('nki,ni->nk', H[:, :, :3], c) - h
+
+    #derivatives of linear parameters, as in fJr
+    rm = numpy.einsum('njik,nk->nji', D, q) - numpy.einsum('nik,njk->nji', H[:, :3, :], e)
+    cd = numpy.empty_like(rm)
+    for j in range(n):
+        try:
+            cd[j] = numpy.linalg.solve(FtF[j], rm[j].T).T
+        except numpy.linalg.LinAlgError:
+            cd[j] = numpy.linalg.lstsq(FtF[j], rm[j].T)[0].T
+
+    #Jacobian of linear functions (for errors) and of reduced problem
+    K = numpy.zeros((n, 9, 11))
+    K[:, [0, 1, 2], [0, 1, 2]] = 1
+    K[:, 3:] = e
+    K[:, 3:, :3] += cd
+    Afull = numpy.matmul(numpy.matmul(K, H), K.swapaxes(1, 2))
+
+    g = numpy.einsum('njk,nk->nj', K[:, 3:], q)
+    F = (numpy.einsum('ni,nij,nj->n', c, FtF, c) - 2*(c*Fty).sum(1)) + datasq
+    return Afull[:, 3:, 3:], g, F, zip(c, Afull)
+
+class ResultCache(object):
+    """Bounded cache of fit results. If full (number of entries or
+    size of stored arrays), least recently used entries are discarded.
+    Safe for use from several threads.
+
+    @ivar hits: number of successful lookups
+    @ivar misses: number of failed lookups
+    @ivar evictions: number of discarded entries
+    @ivar nbytes: size of arrays of all entries
+    """
+
+    def __init__(self, maxsize = 32, maxbytes = 64*2**20):
+        """
+        @param maxsize: maximum number of entries
+        @param maxbytes: maximum size of arrays of all entries; larger
+        entries are not stored
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict() #key: (value, size)
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def size(value):
+        """@return: size of all arrays contained in value (nested
+        sequences)"""
+        if isinstance(value, numpy.ndarray):
+            return value.nbytes
+        if isinstance(value, (list, tuple)):
+            return sum(ResultCache.size(item) for item in value)
+        return 0
+
+    def get(self, key):
+        """@return: cached entry, None if not found"""
+        with self.lock:
+            try:
+                item = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries[key] = item #mark as most recently used
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        size = self.size(value)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            if size > self.maxbytes:
+                return
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            while len(self.entries) > self.maxsize or self.nbytes > self.maxbytes:
+                value, size = self.entries.popitem(last = False)[1]
+                self.nbytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return "%d entries (%.1f MB), %d hits, %d misses, %d evictions"%(
+            len(self), self.nbytes/2.0**20, self.hits, self.misses, self.evictions)
+
+#: cache of fit results, shared by all fit routines, see L{Fitting.do_fit}
+result_cache = ResultCache()
+
+#work arrays in use by current thread, see L{Fitting.workspace}
+_workspace_local = threading.local()
+_workspace_lock = threading.Lock()
+
 class Fitting(object):
     """Base class for fitting. Provides common interface for handling
     of imaging parameters.
@@ -78,12 +395,47 @@ class Fitting(object):
     
     imaging_pars = None
     verbose = False
+
+    #: look up results of do_fit in L{result_cache}
+    use_result_cache = True
+    #: fields of imaging parameters which are part of key of result cache
+    cache_imaging_fields = ('pixelsize', 'sigma0', 'expansion_time', 'mass', 'ODmax')
+
+    #: maximum number of images fitted simultaneously by do_fit_batch
+    batchsize = 16
+
+    #: coarse-to-fine fitting: fit binned images first (see L{fit_pyramid})
+    pyramid = False
+    #: binning factor between levels of pyramid
+    pyramid_factor = 3
+    #: minimum number of pixels of coarsest level
+    pyramid_minpixels = 20000
+
+    #: start from result of previous valid fit with same ROI (see L{do_fit})
+    warm_start = False
+    #: warm start fails if standard deviation of residuum exceeds that
+    #: of previous fit by this factor
+    warm_start_tolerance = 1.5
+    #: initial damping of LM for warm start
+    warm_start_tau = 1e-6
+    #: (ROI bounds, fit parameters, standard deviation of residuum) of
+    #: last valid fit, used for warm start
+    _last_fit = None
+
+    #: floating point type of work arrays of reduced fits (GaussBose2d,
+    #: Bimodal2d, BoseBimodal2d). With numpy.float32 memory traffic is
+    #: halved, normal equations are still accumulated in double precision.
+    precision = numpy.float64
     
     def set_imaging_pars(self, ip):
         self.imaging_pars = ip
 
     def do_fit(self, img, roi):
-        """perform fitting.
+        """perform fitting. Results are looked up in
+        L{result_cache} first. In warm start mode the fit starts from
+        the previous valid fit (same ROI); if this fails (invalid
+        result or much larger residuum), start parameters are
+        estimated as usual.
 
         @param img:
         @type img: 2d ndarray
@@ -94,8 +446,287 @@ class Fitting(object):
         @return: [fit image,...], fit background, FitPars
         @rtype: [ndarray,...], ndarray, L{FitPars}
         """
-        pass
-    
+        x, y = self.roi_coordinates(img, roi)
+        imgroi = img[roi.y, roi.x]
+        imgsel = numpy.ma.getmaskarray(imgroi).ravel()
+
+        if self.use_result_cache:
+            key = self.cache_key(imgroi, imgsel, roi)
+            result = result_cache.get(key)
+            if result is not None:
+                return self.cached_result(result)
+
+        self.acquire_workspace()
+        try:
+            roikey = (roi.xmin, roi.xmax, roi.ymin, roi.ymax)
+            fitpar = None
+            if self.warm_start and self._last_fit is not None and self._last_fit[0] == roikey:
+                lastroi, lastfitpar, lastsigma = self._last_fit
+                fitpar, fitparerr, sigma = self.fit_startpar(x, y, imgroi, imgsel, lastfitpar,
+                                                             tau = self.warm_start_tau)
+                if not (self.check_fit(fitpar, roi) and
+                        sigma <= self.warm_start_tolerance * lastsigma):
+                    print "warm start failed, using estimated start parameters"
+                    fitpar = None
+
+            if fitpar is None:
+                startpar = self.find_startpar(x, y, imgroi)
+                if self.pyramid:
+                    startpar = self.fit_pyramid(x, y, imgroi, startpar)
+                fitpar, fitparerr, sigma = self.fit_startpar(x, y, imgroi, imgsel, startpar)
+            result = self.fit_results(fitpar, fitparerr, sigma, x, y, roi)
+        finally:
+            self.release_workspace()
+
+        if result[2].valid and numpy.isfinite(sigma):
+            self._last_fit = (roikey, fitpar, sigma)
+
+        if self.use_result_cache:
+            result_cache.put(key, result)
+            return self.cached_result(result)
+        return result
+
+    def cached_result(self, result):
+        """@return: result of L{result_cache} for caller: fit images,
+        background and FitPars copied, so that changes by caller
+        (e.g., imaging parameters, invalidate, in-place operations on
+        images) don't change cached result"""
+        imgfit, background, fitpars = result
+        fitpars = copy.copy(fitpars)
+        fitpars.imaging_pars = self.imaging_pars
+        return [f.copy() for f in imgfit], background.copy(), fitpars
+
+    def cache_key(self, imgroi, imgsel, roi):
+        """key for L{result_cache}: digest of image data and mask in
+        region of interest, fit routine and its settings, imaging
+        parameters and ROI bounds."""
+        digest = hashlib.sha1()
+        digest.update(numpy.ascontiguousarray(numpy.ma.getdata(imgroi)))
+        digest.update(numpy.ascontiguousarray(imgsel))
+
+        ip = self.imaging_pars
+        ipvalues = tuple(getattr(ip, field, None) for field in self.cache_imaging_fields)
+
+        return (digest.digest(), imgroi.shape, imgroi.dtype.str,
+                self.__class__, self.pyramid, numpy.dtype(self.precision).str,
+                self.warm_start, ipvalues,
+                (roi.xmin, roi.xmax, roi.ymin, roi.ymax))
+
+    def do_fit_batch(self, images, rois):
+        """perform fitting on a stack of images. Coordinates, masks
+        and start parameters are determined only once for all images
+        sharing the same ROI (start parameters from the mean image).
+
+        @param images: stack of images, masked images (e.g., list of
+        images from L{reanalysis.prepare_image}) keep the fill value
+        of the first one
+        @type images: 3d ndarray (K x N x M), optionally masked
+
+        @param rois: common region of interest for all images, or one
+        ROI per image.
+        @type rois: L{ROI} or sequence of L{ROI}
+
+        @return: fit parameters (as used internally by fit routine),
+        fit parameter errors, [[fit image, ...], ...], [FitPars, ...]
+        @rtype: ndarray (K x P), ndarray (K x P), list, list
+        """
+        fill_value = numpy.ma.asarray(images[0]).fill_value
+        images = numpy.ma.asarray(images)
+        images.set_fill_value(fill_value)
+        if hasattr(rois, 'xmin'):
+            rois = [rois]*len(images)
+
+        #group images with identical ROI
+        groups = {}
+        for k, roi in enumerate(rois):
+            key = (roi.xmin, roi.xmax, roi.ymin, roi.ymax)
+            groups.setdefault(key, []).append(k)
+
+        results = [None]*len(images)
+        self.acquire_workspace()
+        try:
+            for index in groups.itervalues():
+                roi = rois[index[0]]
+                x, y = self.roi_coordinates(images[0], roi)
+                stack = images[:, roi.y, roi.x][index]
+
+                masks = numpy.ma.getmaskarray(stack).reshape((len(index), -1))
+
+                mean = stack.mean(0)
+                mean.set_fill_value(fill_value)
+                startpar = self.find_startpar(x, y, mean)
+                if self.pyramid:
+                    startpar = self.fit_pyramid(x, y, mean, startpar)
+
+                for start in range(0, len(index), self.batchsize):
+                    chunk = slice(start, start + self.batchsize)
+                    fits = self.fit_startpar_batch(x, y, stack[chunk], masks[chunk], startpar)
+                    for k, (fitpar, fitparerr, sigma) in zip(index[chunk], fits):
+                        imgfit, background, fitpars = self.fit_results(fitpar, fitparerr, sigma, x, y, roi)
+                        results[k] = (fitpar, fitparerr, imgfit, fitpars)
+        finally:
+            self.release_workspace()
+
+        fitpar, fitparerr, imgfits, fitpars = zip(*results)
+        return numpy.array(fitpar), numpy.array(fitparerr), list(imgfits), list(fitpars)
+
+    def __getstate__(self):
+        #don't pickle work arrays
+        state = self.__dict__.copy()
+        state.pop('_free_workspaces', None)
+        return state
+
+    def acquire_workspace(self):
+        """provide set of work arrays for fitting in current thread,
+        see L{workspace}. Fits running simultaneously in different
+        threads (e.g., if an outdated fit is still running) get
+        different sets. Call L{release_workspace} when done."""
+        with _workspace_lock:
+            free = self.__dict__.setdefault('_free_workspaces', [])
+            _workspace_local.arrays = free.pop() if free else {}
+
+    def release_workspace(self):
+        arrays = _workspace_local.arrays
+        _workspace_local.arrays = None
+        with _workspace_lock:
+            self.__dict__.setdefault('_free_workspaces', []).append(arrays)
+
+    def workspace(self, name, shape):
+        """work array of type L{precision}, reused across LM
+        iterations and fits. Contents are undefined, the array is
+        valid until the next request for the same name and size.
+        Outside of L{acquire_workspace}/L{release_workspace} a new
+        array is returned.
+
+        @param name: name of work array
+        @param shape: shape of work array
+        """
+        arrays = getattr(_workspace_local, 'arrays', None)
+        if arrays is None:
+            return numpy.empty(shape, dtype = self.precision)
+
+        size = int(numpy.prod(shape))
+        key = (name, size, self.precision)
+        buf = arrays.get(key)
+        if buf is None:
+            if len(arrays) > 64:
+                #e.g., after many changes of ROI
+                arrays.clear()
+            buf = arrays[key] = numpy.empty(size, dtype = self.precision)
+        return buf.reshape(shape)
+
+    def roi_coordinates(self, img, roi):
+        """@return: x values (1xM row vector) and y values (Nx1 column
+        vector) of region of interest
+        @rtype: (ndarray, ndarray)"""
+        x = numpy.asarray(roi.xrange_clipped(img), dtype = imgtype)
+        y = numpy.asarray(roi.yrange_clipped(img), dtype = imgtype)
+        x.shape = (1,-1)
+        y.shape = (-1, 1)
+        return x, y
+
+    def find_startpar(self, x, y, imgroi):
+        """find initial estimates for fit parameters.
+
+        @param x: x values (1xM row vector)
+        @param y: y values (Nx1 column vector)
+        @param imgroi: image data in region of interest
+        @type imgroi: 2d ndarray (NxM), optionally masked
+
+        @return: start parameters
+        @rtype: ndarray
+        """
+        raise NotImplementedError
+
+    def fit_startpar(self, x, y, imgroi, imgsel, startpar, tau = 1e-2):
+        """perform fit starting from given start parameters.
+
+        @param imgsel: flattened mask of image data, True for ignored pixels
+        @type imgsel: 1d bool ndarray
+
+        @param tau: initial damping of LM, small if start parameters
+        are known to be good (see L{LM.LM})
+
+        @return: fit parameters, fit parameter errors, standard
+        deviation of residuum
+        @rtype: ndarray, ndarray, float
+        """
+        raise NotImplementedError
+
+    def pyramid_levels(self, shape):
+        """determine depth of pyramid from size of region of interest:
+        bin as long as at least pyramid_minpixels are left.
+
+        @param shape: shape of region of interest
+        @return: binning factors of coarse levels, coarsest first
+        @rtype: list of int
+        """
+        levels = []
+        b = self.pyramid_factor
+        while b > 1 and shape[0]*shape[1] >= b**2 * self.pyramid_minpixels:
+            levels.insert(0, b)
+            b *= self.pyramid_factor
+        return levels
+
+    def fit_pyramid(self, x, y, imgroi, startpar):
+        """coarse-to-fine fitting: fit binned versions of region of
+        interest, from coarsest to finest level, each starting from
+        result of previous level.
+
+        @return: fit parameters of finest binned level, to be used as
+        start parameters for fit on full resolution
+        """
+        for b in self.pyramid_levels(imgroi.shape):
+            xb, yb, imgb = bin_image(x, y, imgroi, b)
+            imgsel = numpy.ma.getmaskarray(imgb).ravel()
+            try:
+                startpar, fitparerr, sigma = self.fit_startpar(xb, yb, imgb, imgsel, startpar)
+            except Exception, e:
+                print "fit of binned image (%dx%d) failed: %s"%(b, b, e)
+                break
+            if self.verbose:
+                print "pyramid level %dx%d:"%(b, b), startpar
+        return startpar
+
+    def fit_startpar_batch(self, x, y, stack, masks, startpar):
+        """perform fit for a stack of images sharing the same ROI,
+        starting from common start parameters. Default: fit images
+        one after another with L{fit_startpar}.
+
+        @param masks: flattened masks of images, one per row
+        @type masks: 2d bool ndarray
+
+        @return: [(fit parameters, fit parameter errors, standard
+        deviation of residuum), ...]
+        """
+        return [self.fit_startpar(x, y, img, imgsel, startpar)
+                for img, imgsel in zip(stack, masks)]
+
+    def fit_images(self, fitpar, x, y):
+        """@return: [fit image,...] calculated from fit parameters"""
+        raise NotImplementedError
+
+    def make_fitpars(self, fitpar, fitparerr, sigma):
+        """@return: object representing fit result
+        @rtype: L{FitPars}"""
+        return self.MyFitPars(fitpar, self.imaging_pars, fitparerr, sigma)
+
+    def check_fit(self, fitpar, roi):
+        """validity check of fit parameters.
+        @return: False if fit result is not valid"""
+        return True
+
+    def fit_results(self, fitpar, fitparerr, sigma, x, y, roi):
+        """create fit images and fit result object from fit parameters.
+        @return: [fit image,...], fit background, FitPars"""
+        imgfit = self.fit_images(fitpar, x, y)
+        fitpars = self.make_fitpars(fitpar, fitparerr, sigma)
+        if not self.check_fit(fitpar, roi):
+            fitpars.invalidate()
+
+        background = numpy.array([fitpars.offset], dtype = imgtype)
+        return imgfit, background, fitpars
+
     def fJ_masked(self, pars, x, y, v0=0, sel = None):
         """
         ignore masked values in v0. somewhat specialized for 2d fitting functions
@@ -114,7 +745,13 @@ class NoFit(Fitting):
     def __init__(self, imaging_pars=None):
         self.imaging_pars = imaging_pars
 
-    def do_fit(self, img, roi):
+    def find_startpar(self, x, y, imgroi):
+        return numpy.array([])
+
+    def fit_startpar(self, x, y, imgroi, imgsel, startpar, tau = 1e-2):
+        return numpy.array([]), numpy.array([]), 0.0
+
+    def fit_results(self, fitpar, fitparerr, sigma, x, y, roi):
         background = numpy.array([0.0], dtype = imgtype)
         return [], background, FitParsNoFit()
 
@@ -131,6 +768,7 @@ class Gauss2d(Fitting):
 
         self.imaging_pars = imaging_pars
         self.cache = {}
+        self.MyFitPars = FitParsGauss2d
 
     def gauss1d(self, pars, x, v0 = 0):
         """calculate 1d gaussian.
@@ -186,8 +824,8 @@ class Gauss2d(Fitting):
         if self.cache.has_key(key):
             v = self.cache[key]
         else:
-            v = A*numpy.exp( - (x-mx)**2 / (2*sx**2) 
-                       - (y-my)**2 / (2*sy**2))
+            gx, gy = gauss_factors(x-mx, y-my, sx, sy)
+            v = (A*gy)*gx
             self.cache.clear()
             #caching in effect only for calculating of Jacobi, clear
             #cache after result has been retrieved to avoid excessive
@@ -210,10 +848,10 @@ class Gauss2d(Fitting):
 
         J = numpy.empty(shape = (6,) + f.shape, dtype = imgtype) 
         J[0] = 1.0/A * f
-        J[1] = f*(x-mx)/sx**2
-        J[2] = f*(y-my)/sy**2
-        J[3] = f*(x-mx)**2/sx**3
-        J[4] = f*(y-my)**2/sy**3
+        numpy.multiply(f, (x-mx)/sx**2, J[1])
+        numpy.multiply(f, (y-my)/sy**2, J[2])
+        numpy.multiply(f, (x-mx)**2/sx**3, J[3])
+        numpy.multiply(f, (y-my)**2/sy**3, J[4])
         J[5] = 1
 
         return J.reshape((6,-1))
@@ -221,25 +859,26 @@ class Gauss2d(Fitting):
     def fJ(self, pars, x, y, v0=0):
         A, mx, my, sx, sy, offs = pars[0:6]
 
-        f = A*numpy.exp( - (x-mx)**2 / (2*sx**2) 
-                         - (y-my)**2 / (2*sy**2))
-        
-        J = numpy.empty(shape = (6,) + f.shape, dtype = imgtype)
-        J[0] = 1.0/A * f
-        J[1] = f*(x-mx)/sx**2
-        J[2] = f*(y-my)/sy**2
-        J[3] = f*(x-mx)**2/sx**3
-        J[4] = f*(y-my)**2/sy**3
+        #separable: all entries are outer products of 1d factors
+        dx, dy = x-mx, y-my
+        gx, gy = gauss_factors(dx, dy, sx, sy)
+        Agy = A*gy
+
+        J = numpy.empty(shape = (6,) + numpy.broadcast(x, y).shape, dtype = imgtype)
+        numpy.multiply(gy, gx, J[0])
+        numpy.multiply(Agy, gx*(dx/sx**2), J[1])
+        numpy.multiply(Agy*(dy/sy**2), gx, J[2])
+        numpy.multiply(Agy, gx*(dx**2/sx**3), J[3])
+        numpy.multiply(Agy*(dy**2/sy**3), gx, J[4])
         J[5] = 1
 
+        f = A*J[0]
         f += offs
         f -= v0
         f.shape = (-1,)
         J.shape = (6,-1)
         return f, J
 
-    
-
     def _find_startpar_gauss(self, x, prof):
         """
         find good initial estimates for fit parameters based on
@@ -307,28 +946,20 @@ class Gauss2d(Fitting):
         return fitpar
 
 
-    def do_fit(self,img, roi):
-        x = numpy.asarray(roi.xrange_clipped(img), dtype = imgtype)
-        y = numpy.asarray(roi.yrange_clipped(img), dtype = imgtype)
-
-
-        imgroi = img[roi.y, roi.x]
-        try:
-            imgroifilled = imgroi.filled()
-        except AttributeError:
-            imgroifilled = imgroi
+    def find_startpar(self, x, y, imgroi):
+        imgroifilled = filled(imgroi)
 
         xprof = imgroifilled.sum(0)
         yprof = imgroifilled.sum(1)
 
         try:
-            startparx = self._find_startpar_gauss(x,xprof)
-            startpary = self._find_startpar_gauss(y,yprof)
+            startparx = self._find_startpar_gauss(x.ravel(),xprof)
+            startpary = self._find_startpar_gauss(y.ravel(),yprof)
         except Exception:
             startparx = numpy.array([1, 100, 100, 10, 10, 0])
             startpary = numpy.array([1, 100, 100, 10, 10, 0])
             print "Warning: can't determine initial guess for fitting parameters"
-        
+
         startpar = numpy.array([startparx[0]/(startpary[2]*numpy.sqrt(2*numpy.pi)),
                                 startparx[1], #m_x
                                 startpary[1], #m_y
@@ -336,11 +967,9 @@ class Gauss2d(Fitting):
                                 startpary[2], #sigma_y
                                 0 #offset
                                 ])
+        return startpar
 
-        x.shape = (1,-1)
-        y.shape = (-1, 1)
-
-        
+    def fit_startpar(self, x, y, imgroi, imgsel, startpar, tau = 1e-2):
         if use_minpack:
             fitpar, cov_x, infodict, mesg, ier = \
                 leastsq(self.gauss2d_flat, 
@@ -352,37 +981,52 @@ class Gauss2d(Fitting):
                         full_output=1, 
                         )
         else:
-            imgsel = numpy.ma.getmaskarray(imgroi.ravel())
             fitpar, J, r = LM.LM(self.fJ_masked,
                                  startpar,
                                  args = (x, y, imgroi, imgsel),
                                  kmax = 30,
+                                 tau = tau,
                                  eps1 = 1e-6,
                                  eps2 = 1e-6,
                                  verbose = self.verbose,
                                  full_output = True,
                                  )
         fitparerr, sigma = LM.fitparerror(fitpar, J, r)
-                        
-        imgfit = self.gauss2d(fitpar, x, y)
-
-        fitpars = FitParsGauss2d(fitpar, self.imaging_pars, fitparerr, sigma)
-
-        #validity check
+        return fitpar, fitparerr, sigma
+
+    def fit_startpar_batch(self, x, y, stack, masks, startpar):
+        #normal equations of plain gaussian only, not models of derived classes
+        if use_minpack or self.fit_startpar.im_func is not Gauss2d.fit_startpar.im_func:
+            return Fitting.fit_startpar_batch(self, x, y, stack, masks, startpar)
+
+        results = LM.LM_batch_normal(gauss_normal_batch,
+                                     numpy.tile(startpar, (len(stack), 1)),
+                                     args = (x, y) + gauss_batch_data(stack, masks),
+                                     kmax = 30,
+                                     eps1 = 1e-6,
+                                     eps2 = 1e-6,
+                                     verbose = self.verbose,
+                                     full_output = True,
+                                     )
+        return [(fitpar,) + LM.fitparerror_normal(fitpar, A, F, x.size*y.size)
+                for fitpar, A, F, state in results]
+
+    def fit_images(self, fitpar, x, y):
+        return [self.gauss2d(fitpar, x, y),]
+
+    def check_fit(self, fitpar, roi):
         A, mx, my, sx, sy, offs = fitpar[0:6]
         A, sx, sy = abs(A), abs(sx), abs(sy)
         if A<0:
-            fitpars.invalidate()
+            return False
         if mx < roi.xmin - 100 or mx > roi.xmax + 100:
-            fitpars.invalidate()
+            return False
         if my < roi.ymin - 100 or my > roi.ymax + 100:
-            fitpars.invalidate()
+            return False
         if sx > 3*abs(roi.xmax - roi.xmin) or \
            sy > 3*abs(roi.ymax - roi.ymin):
-            fitpars.invalidate()
-
-        background = numpy.array([fitpars.offset], dtype = imgtype)
-        return [imgfit,], background, fitpars
+            return False
+        return True
 
 
 class GaussBose2d(Gauss2d):
@@ -405,8 +1049,8 @@ class GaussBose2d(Gauss2d):
         if self.cache.has_key(key):
             g = self.cache[key]
         else:
-            g = numpy.exp(- (x-mx)**2 / (2*sx**2) 
-                          - (y-my)**2 / (2*sy**2))
+            gx, gy = gauss_factors(x-mx, y-my, sx, sy)
+            g = gy*gx
             g2(g,g)
             numpy.multiply(g, A, g)
             
@@ -423,15 +1067,13 @@ class GaussBose2d(Gauss2d):
         mx, my, sx, sy = pars
 
         X,Y = numpy.broadcast_arrays(x,y)
-        F = numpy.empty(shape = (2,) + X.shape)
+        F = self.workspace('F', (2,) + X.shape)
 
         #gauss
-        numpy.multiply(numpy.exp( -(x-mx)**2/(2*sx**2)),
-                       numpy.exp( -(y-my)**2/(2*sy**2)),
-                       F[0])
-        G = F[0].copy()
-        g2(F[0], F[0])
-        dg2G = dg2(G)
+        gx, gy = gauss_factors(x-mx, y-my, sx, sy)
+        G = self.workspace('G', X.shape)
+        numpy.multiply(gy, gx, G)
+        dg2G = g2dg2(G, F[0], self.workspace('dg2G', X.shape))[1]
 
         #offset
         F[1] = 1
@@ -440,25 +1082,25 @@ class GaussBose2d(Gauss2d):
         Fd = []
 
         #mx
-        Fdmx = numpy.empty_like(F)
+        Fdmx = self.workspace('Fdmx', F.shape)
         numpy.multiply(G, 1.0/(sx**2)*(x-mx), Fdmx[0])
         numpy.multiply(Fdmx[0], dg2G, Fdmx[0])
         Fdmx[1] = 0
 
         #my
-        Fdmy = numpy.empty_like(F)
+        Fdmy = self.workspace('Fdmy', F.shape)
         numpy.multiply(G, 1.0/(sy**2)*(y-my), Fdmy[0])
         numpy.multiply(Fdmy[0], dg2G, Fdmy[0])
         Fdmy[1] = 0
 
         #sx
-        Fdsx = numpy.empty_like(F)
+        Fdsx = self.workspace('Fdsx', F.shape)
         numpy.multiply(G, 1.0/sx**3 * ((x-mx)**2), Fdsx[0])
         numpy.multiply(Fdsx[0], dg2G, Fdsx[0])
         Fdsx[1] = 0
 
         #sy
-        Fdsy = numpy.empty_like(F)
+        Fdsy = self.workspace('Fdsy', F.shape)
         numpy.multiply(G, 1.0/sy**3 * ((y-my)**2), Fdsy[0])
         numpy.multiply(Fdsy[0], dg2G, Fdsy[0])
         Fdsy[1] = 0
@@ -482,8 +1124,8 @@ class GaussBose2d(Gauss2d):
         v = numpy.ravel(vin)
 
         #calculate linear Parameters
-        FtF = numpy.inner(F, F)
-        Fty = numpy.inner(F, v)
+        FtF = LM.inner64(F, F)
+        Fty = LM.inner64(F, v)
         try:
             c = numpy.linalg.solve(FtF, Fty)
         except numpy.linalg.LinAlgError:
@@ -499,15 +1141,18 @@ class GaussBose2d(Gauss2d):
         ##calculate complete Jacobian
         cd = numpy.empty(shape = (len(pars),) + c.shape)
         Jr = numpy.empty(shape = (len(pars),) + F.shape[1:])
+        cw = c.astype(F.dtype)
+        cFdj = self.workspace('cFdj', F.shape[1:])
+        cdF = self.workspace('cdF', F.shape[1:])
 
         for j in range(len(pars)):
-            cFdj = numpy.dot(c[nz[j]], Fd[j][nz[j]])
+            numpy.dot(cw[nz[j]], Fd[j][nz[j]], cFdj)
 
             #rm = numpy.inner(Fd[j], r) - numpy.inner(F, cFdj) #expensive
             rm = numpy.zeros(shape = Fd[j].shape[0])
-            rmnz = numpy.inner(Fd[j][nz[j]], r)
+            rmnz = LM.inner64(Fd[j][nz[j]], r)
             rm[nz[j]] = rmnz
-            rm -= numpy.inner(F, cFdj) #expensive
+            rm -= LM.inner64(F, cFdj) #expensive
             try:
                 cd[j] = numpy.linalg.solve(FtF, rm) #cheap
             except numpy.linalg.LinAlgError:
@@ -515,7 +1160,8 @@ class GaussBose2d(Gauss2d):
                 cdj, res, rank, s = numpy.linalg.lstsq(F.transpose(), cFdj)
                 cd[j] = -cdj
                 
-            Jr[j] = cFdj + numpy.dot(cd[j], F) #expensive!
+            numpy.dot(cd[j].astype(F.dtype), F, cdF) #expensive!
+            numpy.add(cFdj, cdF, Jr[j])
 
         if sel is None:
             sel = numpy.ma.getmaskarray(v)
@@ -525,48 +1171,14 @@ class GaussBose2d(Gauss2d):
         return r, Jr
 
 
-    def do_fit(self,img, roi):
-        x = numpy.asarray(roi.xrange_clipped(img), dtype = imgtype)
-        y = numpy.asarray(roi.yrange_clipped(img), dtype = imgtype)
-
-        imgroi = img[roi.y, roi.x]
-        try:
-            imgroifilled = imgroi.filled()
-        except AttributeError:
-            imgroifilled = imgroi
-
-        xprof = imgroifilled.sum(0)
-        yprof = imgroifilled.sum(1)
-
-        try:
-            startparx = self._find_startpar_gauss(x,xprof)
-            startpary = self._find_startpar_gauss(y,yprof)
-        except Exception:
-            startparx = numpy.array([1, 100, 100, 10, 10, 0])
-            startpary = numpy.array([1, 100, 100, 10, 10, 0])
-            print "Warning: can't determine initial guess for fitting parameters"
-        
-        startpar = numpy.array([startparx[0]/(startpary[2]*numpy.sqrt(2*numpy.pi)),
-                                startparx[1], #m_x
-                                startpary[1], #m_y
-                                startparx[2], #sigma_x
-                                startpary[2], #sigma_y
-                                0 #offset
-                                ])
-
-        x.shape = (1,-1)
-        y.shape = (-1, 1)
-    
-
-        imgsel = numpy.ma.getmaskarray(imgroi.ravel())
-                
+    def fit_startpar(self, x, y, imgroi, imgsel, startpar, tau = 1e-3):
         p, J, f = LM.LM(self.fJr,
                         startpar[1:-1],
                         args = (x,y,imgroi,imgsel),
                         kmax = 30,
                         eps1 = 1e-5,
                         eps2 = 5e-5,
-                        tau = 1e-3,
+                        tau = tau,
                         verbose = self.verbose,
                         full_output = True)
                     #TODO: check for fit succeed
@@ -579,26 +1191,10 @@ class GaussBose2d(Gauss2d):
         fitparerr = numpy.array([ce[0],
                                  pe[0], pe[1], pe[2], pe[3],
                                  ce[1]])
+        return fitpar, fitparerr, sigma
 
-        imgfit = self.gaussbose2d(fitpar, x, y)
-
-        fitpars = FitParsGaussBose2d(fitpar, self.imaging_pars, fitparerr, sigma)
-
-        #validity check
-        A, mx, my, sx, sy, offs = fitpar[0:6]
-        A, sx, sy = abs(A), abs(sx), abs(sy)
-        if A<0:
-            fitpars.invalidate()
-        if mx < roi.xmin - 100 or mx > roi.xmax + 100:
-            fitpars.invalidate()
-        if my < roi.ymin - 100 or my > roi.ymax + 100:
-            fitpars.invalidate()
-        if sx > 3*abs(roi.xmax - roi.xmin) or \
-           sy > 3*abs(roi.ymax - roi.ymin):
-            fitpars.invalidate()
-
-        background = numpy.array([fitpars.offset], dtype = imgtype)
-        return [imgfit,], background, fitpars
+    def fit_images(self, fitpar, x, y):
+        return [self.gaussbose2d(fitpar, x, y),]
 
 
 class GaussSym2d(Fitting):
@@ -645,8 +1241,8 @@ class GaussSym2d(Fitting):
         if self.cache.has_key(key):
             v = self.cache[key]
         else:
-            v = A*numpy.exp( - (x-mx)**2 / (2*s**2) 
-                       - (y-my)**2 / (2*s**2))
+            gx, gy = gauss_factors(x-mx, y-my, s, s)
+            v = (A*gy)*gx
             self.cache.clear()
             #caching in effect only for calculating of Jacobi, clear
             #cache after result has been retrieved to avoid excessive
@@ -662,16 +1258,20 @@ class GaussSym2d(Fitting):
     def fJ(self, pars, x, y, v0=0):
         A, mx, my, s, offs = pars[0:5]
 
-        f = A*numpy.exp( - (x-mx)**2 / (2*s**2) 
-                         - (y-my)**2 / (2*s**2))
-        
-        J = numpy.empty(shape = (5,) + f.shape, dtype = imgtype)
-        J[0] = 1.0/A * f
-        J[1] = f*(x-mx)/s**2
-        J[2] = f*(y-my)/s**2
-        J[3] = f*( (x-mx)**2/s**3 + (y-my)**2/s**3) #TODO: nachrechnen
+        dx, dy = x-mx, y-my
+        gx, gy = gauss_factors(dx, dy, s, s)
+        Agy = A*gy
+
+        J = numpy.empty(shape = (5,) + numpy.broadcast(x, y).shape, dtype = imgtype)
+        numpy.multiply(gy, gx, J[0])
+        numpy.multiply(Agy, gx*(dx/s**2), J[1])
+        numpy.multiply(Agy*(dy/s**2), gx, J[2])
+        #f*(dx**2 + dy**2)/s**3 #TODO: nachrechnen
+        numpy.multiply(Agy, gx*(dx**2/s**3), J[3])
+        J[3] += Agy*(dy**2/s**3)*gx
         J[4] = 1
 
+        f = A*J[0]
         f += offs
         f -= v0
         f.shape = (-1,)
@@ -737,65 +1337,81 @@ class GaussSym2d(Fitting):
         return fitpar
         
 
-    def do_fit(self,img, roi):
-        x = numpy.asarray(roi.xrange_clipped(img), dtype = imgtype)
-        y = numpy.asarray(roi.yrange_clipped(img), dtype = imgtype)
-
-        imgroi = img[roi.y, roi.x]
-        try:
-            imgroifilled = imgroi.filled()
-        except AttributeError:
-            imgroifilled = imgroi
-            
+    def find_startpar(self, x, y, imgroi):
         xprof = imgroi.sum(0)
         yprof = imgroi.sum(1)
 
-        startparx = self._find_startpar_gauss(x,xprof)
-        startpary = self._find_startpar_gauss(y,yprof)
-        
-        startpar = [startparx[0]/(startpary[2]*numpy.sqrt(2*numpy.pi)),
-                    startparx[1], #m_x
-                    startpary[1], #m_y
-                    (startparx[2] + startpary[2])/2, #sigma
-                    0 #offset
-            ]
+        startparx = self._find_startpar_gauss(x.ravel(),xprof)
+        startpary = self._find_startpar_gauss(y.ravel(),yprof)
 
-        x.shape = (1,-1)
-        y.shape = (-1, 1)
+        startpar = numpy.array([startparx[0]/(startpary[2]*numpy.sqrt(2*numpy.pi)),
+                                startparx[1], #m_x
+                                startpary[1], #m_y
+                                (startparx[2] + startpary[2])/2, #sigma
+                                0 #offset
+                                ])
+        return startpar
 
-        imgsel = numpy.ma.getmaskarray(imgroi.ravel())
+    def fit_startpar(self, x, y, imgroi, imgsel, startpar, tau = 1e-2):
         fitpar, J, r = LM.LM(self.fJ_masked,
                              startpar,
                              args = (x, y, imgroi, imgsel),
                              kmax = 30,
+                             tau = tau,
                              eps1 = 1e-6,
                              eps2 = 1e-6,
                              verbose = self.verbose,
                              full_output = True,
                              )
-                        
-        imgfit = self.gauss2d(fitpar, x, y)
         fitparerror, sigma = LM.fitparerror( fitpar, J, r)
-
-        fitpar = fitpar[[0,1,2,3,3,4]]
-        fitparerror = fitparerror[[0,1,2,3,3,4]]
-
-        fitpars = FitParsGauss2d(fitpar, self.imaging_pars, fitparerror, sigma)
-
-        #validity check
-        A, mx, my, s, offs = fitpar[0:5]
+        return fitpar, fitparerror, sigma
+
+    #: parameters of L{Gauss2d} from own parameters
+    _gauss2d_pars = numpy.array([[1, 0, 0, 0, 0],
+                                 [0, 1, 0, 0, 0],
+                                 [0, 0, 1, 0, 0],
+                                 [0, 0, 0, 1, 0],
+                                 [0, 0, 0, 1, 0],
+                                 [0, 0, 0, 0, 1]], dtype = numpy.float64)
+
+    def normal_batch(self, pars, index, x, y, *data):
+        """normal equations, see L{gauss_normal_batch}: sx = sy = s"""
+        T = self._gauss2d_pars
+        JJ, g, F, state = gauss_normal_batch(numpy.dot(pars, T.T), index, x, y, *data)
+        return numpy.matmul(numpy.matmul(T.T, JJ), T), numpy.dot(g, T), F, state
+
+    def fit_startpar_batch(self, x, y, stack, masks, startpar):
+        results = LM.LM_batch_normal(self.normal_batch,
+                                     numpy.tile(startpar, (len(stack), 1)),
+                                     args = (x, y) + gauss_batch_data(stack, masks),
+                                     kmax = 30,
+                                     eps1 = 1e-6,
+                                     eps2 = 1e-6,
+                                     verbose = self.verbose,
+                                     full_output = True,
+                                     )
+        return [(fitpar,) + LM.fitparerror_normal(fitpar, A, F, x.size*y.size)
+                for fitpar, A, F, state in results]
+
+    def fit_images(self, fitpar, x, y):
+        return [self.gauss2d(fitpar, x, y),]
+
+    def make_fitpars(self, fitpar, fitparerr, sigma):
+        return FitParsGauss2d(fitpar[[0,1,2,3,3,4]], self.imaging_pars,
+                              fitparerr[[0,1,2,3,3,4]], sigma)
+
+    def check_fit(self, fitpar, roi):
+        A, mx, my, s = fitpar[0:4]
         s = abs(s)
         if A<0:
-            fitpars.invalidate()
+            return False
         if mx < roi.xmin - 100 or mx > roi.xmax + 100:
-            fitpars.invalidate()
+            return False
         if my < roi.ymin - 100 or my > roi.ymax + 100:
-            fitpars.invalidate()
+            return False
         if s > 3*abs(roi.xmax - roi.xmin):
-            fitpars.invalidate()
-
-        background = numpy.array([fitpars.offset], dtype = imgtype)
-        return [imgfit,], background, fitpars
+            return False
+        return True
 
 
 class Bimodal2d(Gauss2d):
@@ -823,8 +1439,8 @@ class Bimodal2d(Gauss2d):
         if self.cache.has_key(key):
             [g, b] = self.cache[key]
         else:
-            g = A*numpy.exp(- (x-mx)**2 / (2*sx**2) 
-                            - (y-my)**2 / (2*sy**2))
+            gx, gy = gauss_factors(x-mx, y-my, sx, sy)
+            g = (A*gy)*gx
             b = (1 - ((x-mx)/rx)**2 - ((y-my)/ry)**2)
             numpy.maximum(b, 0, b)
             numpy.sqrt(b,b)
@@ -861,8 +1477,8 @@ class Bimodal2d(Gauss2d):
         #print pars
         A, mx, my, sx, sy, offs, B, rx, ry = pars[0:9]
 
-        g = A*numpy.exp(- (x-mx)**2 / (2*sx**2) 
-                        - (y-my)**2 / (2*sy**2))
+        gx, gy = gauss_factors(x-mx, y-my, sx, sy)
+        g = (A*gy)*gx
         b = (1 - ((x-mx)/rx)**2 - ((y-my)/ry)**2)
         numpy.maximum(b, 0, b)
         numpy.sqrt(b,b)
@@ -892,16 +1508,16 @@ class Bimodal2d(Gauss2d):
         mx, my, sx, sy, rx, ry = pars
 
         X,Y = numpy.broadcast_arrays(x,y)
-        F = numpy.empty(shape = (3,) + X.shape)
+        F = self.workspace('F', (3,) + X.shape)
 
         #gauss
-        numpy.multiply(numpy.exp( -(x-mx)**2/(2*sx**2)),
-                       numpy.exp( -(y-my)**2/(2*sy**2)),
-                       F[0])
+        gx, gy = gauss_factors(x-mx, y-my, sx, sy)
+        numpy.multiply(gy, gx, F[0])
 
         #TF
         b = F[1]
-        numpy.maximum(1 - ((x-mx)/rx)**2 - ((y-my)/ry)**2, 0, b)
+        numpy.subtract(1 - ((x-mx)/rx)**2, ((y-my)/ry)**2, b)
+        numpy.maximum(b, 0, b)
         numpy.sqrt(b,b)
         #numpy.power(b,3,b)
 
@@ -911,38 +1527,38 @@ class Bimodal2d(Gauss2d):
         #derivatives
         Fd = []
         #mx
-        Fdmx = numpy.empty_like(F)
+        Fdmx = self.workspace('Fdmx', F.shape)
         
         numpy.multiply(F[0], 1.0/(sx**2)*(x-mx), Fdmx[0])
         numpy.multiply(F[1], 3.0/(rx**2)*(x-mx), Fdmx[1])
         Fdmx[2] = 0
 
         #my
-        Fdmy = numpy.empty_like(F)
+        Fdmy = self.workspace('Fdmy', F.shape)
         numpy.multiply(F[0], 1.0/(sy**2)*(y-my), Fdmy[0])
         numpy.multiply(F[1], 3.0/(ry**2)*(y-my), Fdmy[1])
         Fdmy[2] = 0
 
         #sx
-        Fdsx = numpy.empty_like(F)
+        Fdsx = self.workspace('Fdsx', F.shape)
         numpy.multiply(F[0], 1.0/sx**3 * ((x-mx)**2), Fdsx[0])
         Fdsx[1] = 0
         Fdsx[2] = 0
 
         #sy
-        Fdsy = numpy.empty_like(F)
+        Fdsy = self.workspace('Fdsy', F.shape)
         numpy.multiply(F[0], 1.0/sy**3 * ((y-my)**2), Fdsy[0])
         Fdsy[1] = 0
         Fdsy[2] = 0
 
         #rx
-        Fdrx = numpy.empty_like(F)
+        Fdrx = self.workspace('Fdrx', F.shape)
         Fdrx[0] = 0
         numpy.multiply(F[1], 3.0/(rx**3) * ((x-mx)**2), Fdrx[1])
         Fdrx[2] = 0
 
         #ry
-        Fdry = numpy.empty_like(F)
+        Fdry = self.workspace('Fdry', F.shape)
         Fdry[0] = 0
         numpy.multiply(F[1], 3.0/(ry**3) * ((y-my)**2), Fdry[1])
         Fdry[2] = 0
@@ -960,6 +1576,16 @@ class Bimodal2d(Gauss2d):
 
         return F, Fd, nz
 
+    def _solve_partial(self, FtF, Fty, F, v, sub):
+        """solve linear least squares problem for subset sub of
+        linear parameters only, using normal equations (FtF, Fty) of
+        complete problem."""
+        try:
+            return numpy.linalg.solve(FtF[numpy.ix_(sub, sub)], Fty[sub])
+        except numpy.linalg.LinAlgError:
+            cm, res, rank, s = numpy.linalg.lstsq(F[sub].transpose(), v)
+            return cm
+
     def fJr(self, pars, x, y, vin = 0, sel = None, calcJ = True):
         """
         calculate f and J for reduced system (only nonlinear parameters)
@@ -972,8 +1598,8 @@ class Bimodal2d(Gauss2d):
         v = numpy.ravel(vin)
 
         #calculate linear Parameters
-        FtF = numpy.inner(F, F)
-        Fty = numpy.inner(F, v)
+        FtF = LM.inner64(F, F)
+        Fty = LM.inner64(F, v)
         try:
             c = numpy.linalg.solve(FtF, Fty)
         except numpy.linalg.LinAlgError:
@@ -982,11 +1608,11 @@ class Bimodal2d(Gauss2d):
 
         #magic: if gauss or bec amplitude negative: force it to zero
         if c[1] < 0:
-            cm, res, rank, s = numpy.linalg.lstsq(F[[0,2]].transpose(), v)
+            cm = self._solve_partial(FtF, Fty, F, v, [0,2])
             c = numpy.array([cm[0], 0.0, cm[1]])
 
         if c[0] < 0:
-            cm, res, rank, s = numpy.linalg.lstsq(F[[1,2]].transpose(), v)
+            cm = self._solve_partial(FtF, Fty, F, v, [1,2])
             c = numpy.array([0.0, cm[0], cm[1]])
             
         #calculate residuum
@@ -998,15 +1624,18 @@ class Bimodal2d(Gauss2d):
         ##calculate complete Jacobian
         cd = numpy.empty(shape = (len(pars),) + c.shape)
         Jr = numpy.empty(shape = (len(pars),) + F.shape[1:])
+        cw = c.astype(F.dtype)
+        cFdj = self.workspace('cFdj', F.shape[1:])
+        cdF = self.workspace('cdF', F.shape[1:])
 
         for j in range(len(pars)):
-            cFdj = numpy.dot(c[nz[j]], Fd[j][nz[j]])
+            numpy.dot(cw[nz[j]], Fd[j][nz[j]], cFdj)
 
             #rm = numpy.inner(Fd[j], r) - numpy.inner(F, cFdj) #expensive
             rm = numpy.zeros(shape = Fd[j].shape[0])
-            rmnz = numpy.inner(Fd[j][nz[j]], r)
+            rmnz = LM.inner64(Fd[j][nz[j]], r)
             rm[nz[j]] = rmnz
-            rm -= numpy.inner(F, cFdj) #expensive
+            rm -= LM.inner64(F, cFdj) #expensive
             try:
                 cd[j] = numpy.linalg.solve(FtF, rm) #cheap
             except numpy.linalg.LinAlgError:
@@ -1014,7 +1643,8 @@ class Bimodal2d(Gauss2d):
                 cdj, res, rank, s = numpy.linalg.lstsq(F.transpose(), cFdj)
                 cd[j] = -cdj
                 
-            Jr[j] = cFdj + numpy.dot(cd[j], F) #expensive!
+            numpy.dot(cd[j].astype(F.dtype), F, cdF) #expensive!
+            numpy.add(cFdj, cdF, Jr[j])
 
         #tic2 = time()
         #print "%.2f"%(1e3*(time()-tic2))
@@ -1026,21 +1656,19 @@ class Bimodal2d(Gauss2d):
 
         return r, Jr
 
-    def do_fit(self, img, roi):
+    def find_startpar(self, x, y, imgroi):
         """
-        @rtype: [fit image, fit image gauss only], fit background, FitPars
+        @return: start parameters for two cases: large thermal cloud
+        with small BEC, small thermal cloud with large BEC
+        @rtype: ndarray (2x9)
         """
-        x = numpy.asarray(roi.xrange_clipped(img), dtype = imgtype)
-        y = numpy.asarray(roi.yrange_clipped(img), dtype = imgtype)
-
-        imgroi = img[roi.y, roi.x]
         imgroifilled = imgroi.filled()
 
         xprof = imgroifilled.sum(0)
         yprof = imgroifilled.sum(1)
 
-        startparx = self._find_startpar_gauss(x,xprof)
-        startpary = self._find_startpar_gauss(y,yprof)
+        startparx = self._find_startpar_gauss(x.ravel(),xprof)
+        startpary = self._find_startpar_gauss(y.ravel(),yprof)
 
         [Ax, mx, sx, ox] = startparx[0:4]
         [Ay, my, sy, oy] = startpary[0:4]
@@ -1052,7 +1680,7 @@ class Bimodal2d(Gauss2d):
                                 my,
                                 sx ,
                                 sy ,
-                                0.5*(ox/len(y)+oy/len(x)),
+                                0.5*(ox/y.size+oy/x.size),
                                 A*0.5,
                                 sx ,
                                 sy ]
@@ -1064,7 +1692,7 @@ class Bimodal2d(Gauss2d):
                                 my,
                                 sx*2 ,
                                 sy*2 ,
-                                0.5*(ox/len(y)+oy/len(x)),
+                                0.5*(ox/y.size+oy/x.size),
                                 A*0.5,
                                 sx*2 ,
                                 sy*2 ]
@@ -1073,14 +1701,22 @@ class Bimodal2d(Gauss2d):
         if self.verbose:
             print "gauss fit profile horz: A = %3.1f, sx = %3.1f, offset %4.1f"%(A, sx, ox)
             print "gauss fit profile vert: A = %3.1f, sx = %3.1f, offset %4.1f"%(A, sx, ox)
-        
-        x.shape = (1,-1)
-        y.shape = (-1, 1)
+
+        return numpy.array([startparA, startparB])
+
+    def fit_startpar(self, x, y, imgroi, imgsel, startpar, tau = 1e-3):
+        """
+        @param startpar: start parameters, or several candidates of
+        start parameters (one per row). Candidates are fitted in order
+        of increasing residuum at the start parameters, until a fit
+        converges.
+        """
+        startparlist = numpy.atleast_2d(startpar)
 
         if use_minpack:
             fitpar, cov, infodict, mesg, ier = \
                     leastsq(self.bimodal2d_flat,
-                            startpar,
+                            startparlist[0],
                             args = (x,y,imgroi),
                             Dfun = self.Dbimodal2d, col_deriv=1,
                             maxfev = 50,
@@ -1091,52 +1727,31 @@ class Bimodal2d(Gauss2d):
             usereduced = True
 
             if usereduced:
-                imgsel = numpy.ma.getmaskarray(imgroi.ravel())
-
-                ##selection of startpars
-                rA,cA,FA = self.fJr(startparA[[1,2,3,4,7,8]], x,y,imgroi,imgsel, calcJ=False)
-                rB,cB,FB = self.fJr(startparB[[1,2,3,4,7,8]], x,y,imgroi,imgsel, calcJ=False)
-                rA = abs(rA**2).sum()
-                rB = abs(rB**2).sum()
-                print "A: small BEC:", cA, rA
-                print "B: large BEC:", cB, rB
-                if rA<rB:
-                    print "I guess: small BEC"
-                    startparlist = [startparA, startparB]
-                else:
-                    print "I guess: large BEC"
-                    startparlist = [startparB, startparA]
-
-                for startpar in startparlist:
-                    startpar_red = startpar[ [1,2,3,4,7,8] ]
+                startparlist_red = startparlist[:, [1,2,3,4,7,8]]
+
+                ##selection of startpars: most promising first. Usually
+                ##only the first candidate has to be fitted, so fitting
+                ##the candidates simultaneously (LM.LM_batch) would cost
+                ##more, fJr is not vectorized over candidates
+                if len(startparlist_red) > 1:
+                    residua = []
+                    for startpar_red in startparlist_red:
+                        r,c,F = self.fJr(startpar_red, x,y,imgroi,imgsel, calcJ=False)
+                        residua.append(abs(r**2).sum())
+                    startparlist_red = startparlist_red[numpy.argsort(residua)]
+
+                for startpar_red in startparlist_red:
                     p, J, f = LM.LM(self.fJr,
-                           startpar_red,
-                           args = (x,y,imgroi,imgsel),
-                           #args = (x[::3,::3], y[::3,::3], 
-                                    #imgroi[::3, ::3], 
-                                    #numpy.ma.getmaskarray(imgroi[::3, ::3].ravel())),
-                           kmax = 30,
-                           eps1 = 1e-5,
-                           eps2 = 5e-5,
-                           tau = 1e-3,
-                           verbose = self.verbose,
-                           full_output = True)
-                    #TODO: check for fit succeed
+                                    startpar_red,
+                                    args = (x,y,imgroi,imgsel),
+                                    kmax = 30,
+                                    eps1 = 1e-5,
+                                    eps2 = 5e-5,
+                                    tau = tau,
+                                    verbose = self.verbose,
+                                    full_output = True)
 
                     r,c,F = self.fJr(p,x,y,imgroi, calcJ = False)
-                    fitpar = numpy.array([c[0], p[0], p[1], p[2], p[3], 
-                                          c[2], c[1], p[4], p[5]])
-
-                    Jfull = numpy.vstack((F, J))
-                    cepe, sigma = LM.fitparerror( numpy.hstack((c, p)), Jfull, r)
-                    ce, pe = cepe[:3], cepe[3:]
-                    fitparerr = numpy.array([ce[0], pe[0], pe[1], pe[2], pe[3], 
-                                             ce[2], ce[1], pe[4], pe[5]])
-
-                    #pe = LM.fitparerror(p,J,f)
-                    #print 'fitpars', p
-                    #print 'fitparerr', pe
-                    #fitparerr = numpy.array([0.0, pe[0], pe[1], pe[2], pe[3], 0.0, 0.0, pe[4], pe[5]])
                     if c[0]>0 and c[1]>0:
                         #both thermal and BEC fraction are nonzero
                         print "fit converged"
@@ -1146,55 +1761,392 @@ class Bimodal2d(Gauss2d):
                 else:
                     print "fit didn't converge!"
                     #TODO: FitNoFit
+
+                fitpar = numpy.array([c[0], p[0], p[1], p[2], p[3], 
+                                      c[2], c[1], p[4], p[5]])
+
+                Jfull = numpy.vstack((F, J))
+                cepe, sigma = LM.fitparerror( numpy.hstack((c, p)), Jfull, r)
+                ce, pe = cepe[:3], cepe[3:]
+                fitparerr = numpy.array([ce[0], pe[0], pe[1], pe[2], pe[3], 
+                                         ce[2], ce[1], pe[4], pe[5]])
+
+                #pe = LM.fitparerror(p,J,f)
+                #print 'fitpars', p
+                #print 'fitparerr', pe
+                #fitparerr = numpy.array([0.0, pe[0], pe[1], pe[2], pe[3], 0.0, 0.0, pe[4], pe[5]])
                     
             else:
                 #TODO: also implement two different starting pars!!!!!!
                 
-                imgsel = numpy.ma.getmaskarray(imgroi.ravel())
                 fitpar, J, r = LM.LM(self.fJ_masked,
-                                    startparA,
+                                    startparlist[0],
                                     args = (x, y, imgroi, imgsel),
                                     kmax = 30,
+                                    tau = tau,
                                     eps1 = 1e-6,
                                     eps2 = 1e-6,
                                     verbose = self.verbose,
                                     full_output = True,
                                     )
                 fitparerr, sigma = LM.fitparerror(fitpar, J, r)
-            
+
+        return fitpar, fitparerr, sigma
+
+    def thermal_functions(self, pars, dx, dy):
+        """thermal basis functions of reduced problem: gaussian G,
+        constant, and G*dx, G*dy, G*dx**2, G*dy**2 (derivatives of G
+        up to factors)
+
+        @param pars: nonlinear parameters mx, my, sx, sy, rx, ry
+        @param dx: x values relative to center (row vector)
+        @param dy: y values relative to center (column vector)
+        @return: basis functions (6 x N x M)
+        """
+        gx, gy = gauss_factors(dx, dy, pars[2], pars[3])
+        G = gy*gx
+        Phi = numpy.empty((6,) + G.shape)
+        Phi[0] = G
+        Phi[1] = 1
+        numpy.multiply(G, dx, Phi[2])
+        numpy.multiply(G, dy, Phi[3])
+        numpy.multiply(Phi[2], dx, Phi[4])
+        numpy.multiply(Phi[3], dy, Phi[5])
+        return Phi
+
+    def thermal_normal(self, pars, x, y, data, masked, box):
+        """inner products of thermal basis functions (see
+        L{thermal_functions}) with each other and with data.
+
+        The gaussian is a product of factors for x and y, so are
+        the thermal basis functions: the inner products are sums over
+        rows and columns, the data enter by a matrix product with the
+        x factors only (see L{gauss_normal_batch}). Contributions of
+        masked pixels are subtracted.
+
+        @param data: image, masked pixels set to zero
+        @param masked: rows and columns of masked pixels
+        @param box: rows and columns of condensate, see L{ellipse_box}
+        @return: inner products (6 x 6), inner products with data (6),
+        basis functions in box (None if box is None)
+        """
+        mx, my, sx, sy = pars[:4]
+        dx = numpy.ravel(x).astype(numpy.float64) - mx
+        dy = numpy.ravel(y).astype(numpy.float64) - my
+        gx, gy = gauss_factors(dx, dy, sx, sy)
+
+        U = numpy.array([gx, numpy.ones_like(gx), gx*dx, gx, gx*dx**2, gx])
+        V = numpy.array([gy, numpy.ones_like(gy), gy, gy*dy, gy, gy*dy**2])
+        H = numpy.dot(U, U.T)*numpy.dot(V, V.T)
+        h = (V*numpy.dot(data, U.T).T).sum(1)
+
+        rows, cols = masked
+        if len(rows):
+            Phi = U[:, cols]*V[:, rows]
+            H -= numpy.dot(Phi, Phi.T)
+
+        if box is None:
+            return H, h, None
+        rows, cols = box
+        return H, h, U[:, numpy.newaxis, cols]*V[:, rows, numpy.newaxis]
+
+    def basis_normal(self, pars, x, y, data, mask, masked):
+        """inner products of basis functions of reduced problem with
+        each other and with data, for L{bimodal_reduced_normal}. Basis
+        functions are: thermal part, parabola b**3, offset, thermal
+        part times dx, dy, dx**2, dy**2 (see L{thermal_functions}),
+        b*dx, b*dy, b*dx**2, b*dy**2. Condensate functions vanish
+        outside the Thomas-Fermi radii, their inner products are
+        calculated in the bounding box of the condensate only.
+
+        @param pars: nonlinear parameters mx, my, sx, sy, rx, ry
+        @param data: image, masked pixels set to zero
+        @param mask: mask of image, True for masked pixels
+        @param masked: rows and columns of masked pixels
+        @return: inner products (11 x 11), inner products with data (11)
+        """
+        mx, my, sx, sy, rx, ry = pars
+        thermal = [0, 2, 3, 4, 5, 6]
+        condensate = [1, 7, 8, 9, 10]
+
+        box = ellipse_box(x, y, mx, my, rx, ry)
+        HT, hT, PhiT = self.thermal_normal(pars, x, y, data, masked, box)
+        H = numpy.zeros((11, 11))
+        h = numpy.zeros(11)
+        H[numpy.ix_(thermal, thermal)] = HT
+        h[thermal] = hT
+
+        if box is not None:
+            rows, cols = box
+            dx = numpy.asarray(x[:, cols], dtype = numpy.float64) - mx
+            dy = numpy.asarray(y[rows], dtype = numpy.float64) - my
+            b = 1 - (dx/rx)**2 - (dy/ry)**2
+            numpy.maximum(b, 0, b)
+            numpy.sqrt(b, b)
+
+            Phi = numpy.empty((11,) + b.shape)
+            Phi[thermal] = PhiT
+            Phi[1] = b**3
+            numpy.multiply(b, dx, Phi[7])
+            numpy.multiply(b, dy, Phi[8])
+            numpy.multiply(Phi[7], dx, Phi[9])
+            numpy.multiply(Phi[8], dy, Phi[10])
+            Phi.shape = (11, -1)
+
+            Phic = Phi[condensate]
+            Hc = numpy.dot(Phic*~mask[rows, cols].ravel(), Phi.T)
+            H[condensate] = Hc
+            H[:, condensate] = Hc.T
+            h[condensate] = numpy.dot(Phic, data[rows, cols].ravel())
+        return H, h
+
+    def normal_batch(self, pars, index, x, y, data, datasq, masks, masked):
+        """normal equations of reduced fits of several images, for
+        L{LM.LM_batch_normal}, see L{bimodal_reduced_normal}
+
+        @param pars: nonlinear parameters (n x 6)
+        @param index: images of members
+        @param data: images, masked pixels set to zero (see L{gauss_batch_data})
+        @param datasq: squared norms of images
+        @param masks: masks of images (K x N x M)
+        @param masked: rows and columns of masked pixels of images
+        """
+        n = len(pars)
+        H = numpy.empty((n, 11, 11))
+        h = numpy.empty((n, 11))
+        for j, i in enumerate(index):
+            H[j], h[j] = self.basis_normal(pars[j], x, y, data[i], masks[i], masked[i])
+        return bimodal_reduced_normal(pars, H, h, datasq[index])
+
+    def fit_startpar_batch(self, x, y, stack, masks, startpar):
+        """reduced fit like L{fit_startpar}, for all images
+        simultaneously with normal equations from L{normal_batch}. Each
+        image starts from the candidate of start parameters with the
+        smallest residuum; images with vanishing thermal or condensate
+        part are fitted again starting from the next candidate.
+
+        Bimodal fits easily end up in a wrong minimum if the cloud
+        moves from shot to shot: unless fitting coarse-to-fine, the
+        candidates are found for each image separately (cheap, see
+        L{find_startpar}), as L{do_fit} does, instead of using those of
+        the mean image."""
+        if use_minpack or self.fit_startpar.im_func is not Bimodal2d.fit_startpar.im_func:
+            return Fitting.fit_startpar_batch(self, x, y, stack, masks, startpar)
+
+        n = len(stack)
+        data, datasum, datasq, masked = gauss_batch_data(stack, masks)
+        args = (x, y, data, datasq, numpy.asarray(masks).reshape(data.shape), masked)
+
+        #candidates (C x n x 6) for each image in order of increasing residuum
+        if self.pyramid:
+            startpar = [startpar]*n
+        else:
+            startpar = [self.find_startpar(x, y, img) for img in stack]
+        candidates = numpy.array([numpy.atleast_2d(p)[:, [1,2,3,4,7,8]]
+                                  for p in startpar]).swapaxes(0, 1)
+        if len(candidates) > 1:
+            residua = [self.normal_batch(p, numpy.arange(n), *args)[2]
+                       for p in candidates]
+            order = numpy.argsort(residua, 0)
+            candidates = candidates[order, numpy.arange(n)]
+
+        results = [None]*n
+        todo = numpy.arange(n)
+        for k in range(len(candidates)):
+            def normal(pars, index, *args):
+                return self.normal_batch(pars, todo[index], *args)
+
+            fits = LM.LM_batch_normal(normal,
+                                      candidates[k, todo],
+                                      args = args,
+                                      kmax = 30,
+                                      eps1 = 1e-5,
+                                      eps2 = 5e-5,
+                                      tau = 1e-3,
+                                      verbose = self.verbose,
+                                      full_output = True)
+            for i, (p, A, F, (c, Afull)) in zip(todo, fits):
+                results[i] = (p, F, c, Afull)
+
+            #both thermal and BEC fraction nonzero: converged
+            todo = numpy.array([i for i in todo if not (results[i][2][0] > 0 and
+                                                        results[i][2][1] > 0)],
+                               dtype = numpy.int_)
+            if len(todo) == 0:
+                break
+        else:
+            print "fit didn't converge for %d of %d images!"%(len(todo), n)
+
+        fits = []
+        for p, F, c, Afull in results:
+            fitpar = numpy.array([c[0], p[0], p[1], p[2], p[3],
+                                  c[2], c[1], p[4], p[5]])
+            cepe, sigma = LM.fitparerror_normal(numpy.hstack((c, p)), Afull, F, x.size*y.size)
+            ce, pe = cepe[:3], cepe[3:]
+            fitparerr = numpy.array([ce[0], pe[0], pe[1], pe[2], pe[3],
+                                     ce[2], ce[1], pe[4], pe[5]])
+            fits.append((fitpar, fitparerr, sigma))
+        return fits
+
+    def fit_images(self, fitpar, x, y):
+        """
+        @return: [fit image, fit image gauss only]
+        """
         imgfit = self.bimodal2d(fitpar, x, y)
         
         fitpargaussonly = fitpar.copy() # make copy
         fitpargaussonly[6] = 0
         imgfitgaussonly = self.bimodal2d(fitpargaussonly, x, y)
 
-        fitpars = self.MyFitPars(fitpar, self.imaging_pars, fitparerr, sigma)
-        background = numpy.array([fitpars.offset], dtype = imgtype)
-        
-        return [imgfit, imgfitgaussonly], background, fitpars
-
+        return [imgfit, imgfitgaussonly]
+
+    def check_fit(self, fitpar, roi):
+        return True
+
+
+#: coefficients B_2n/(2n+1)! (n = 1, ..., 8) of the series expansion
+#: of g2 in u = -log(1-x), see L{g2dg2}
+_g2_series = (2.7777777777777776e-02,
+              -2.7777777777777778e-04,
+              4.7241118669690100e-06,
+              -9.1857730746619640e-08,
+              1.8978869988971000e-09,
+              -4.0647616451442256e-11,
+              8.9216910204564520e-13,
+              -1.9939295860721074e-14)
+
+def g2dg2(x, g = None, dg = None, derivative = True, blocksize = 65536):
+    """bose function g2(x) = Li2(x) and its derivative dg2(x) =
+    -log(1-x)/x for 0 <= x <= 1, calculated in one pass.
+
+    For x <= 1/2 g2 is evaluated from the series g2 = u - u**2/4 +
+    sum_n B_2n u**(2n+1)/(2n+1)! in u = -log(1-x) <= log(2), for x >
+    1/2 from the reflection formula g2(x) = pi**2/6 - log(x)log(1-x) -
+    g2(1-x). The series is truncated when the terms drop below the
+    resolution of the data type (8 terms for double, 3 for single
+    precision); the absolute error of g2 is below 3e-15 in double
+    precision, and at rounding level (2e-7) in single
+    precision. dg2 = log(w)/(w-1) with w = 1-x is accurate to
+    rounding also for small x (Kahan's trick, avoids the slower
+    log1p), u = x dg2. As for L{dg2}, dg2(0) = 1 and dg2(1) = 0.
+
+    The array is processed in blocks of blocksize entries, so that
+    intermediate results stay in cache.
+
+    @param g: output array for g2, may be x
+    @param dg: output array for derivative, must not be x
+    @param derivative: if False, derivative is not returned
+    @return: g2, dg2 (None if not derivative)
+    """
+    x = numpy.asarray(x)
+    scalar = x.ndim == 0
+    if x.dtype.kind != 'f':
+        x = x.astype(numpy.float64)
+    x = numpy.atleast_1d(x)
+
+    if g is None:
+        g = numpy.empty_like(x)
+    if derivative and dg is None:
+        dg = numpy.empty_like(x)
+
+    #flat views of input and results (temporary copies if not contiguous)
+    xf = x.reshape(-1)
+    gcopy = not g.flags.c_contiguous
+    gf = numpy.empty(x.size, g.dtype) if gcopy else g.reshape(-1)
+    dgcopy = derivative and not dg.flags.c_contiguous
+    if derivative and not dgcopy:
+        dgf = dg.reshape(-1)
+    else:
+        dgf = numpy.empty(x.size if dgcopy else min(blocksize, x.size), x.dtype)
+
+    finfo = numpy.finfo(x.dtype)
+    nterms = sum(abs(c)*numpy.log(2)**(2*n+3) > 0.1*finfo.eps
+                 for n, c in enumerate(_g2_series))
+    series = _g2_series[:max(nterms, 2)]
+    logtiny = numpy.log(finfo.tiny)
+
+    m = min(blocksize, x.size)
+    W = numpy.empty(m, x.dtype)
+    U = numpy.empty(m, x.dtype)
+    U2 = numpy.empty(m, x.dtype)
+
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        for start in xrange(0, x.size, blocksize):
+            xb = xf[start:start + blocksize]
+            gb = gf[start:start + blocksize]
+            n = xb.size
+            w, u, u2 = W[:n], U[:n], U2[:n]
+            db = dgf[start:start + blocksize] if derivative else dgf[:n]
+            lo, hi = xb.min(), xb.max()
+
+            #dg2 = log(w)/(w-1), w = 1-x
+            numpy.subtract(1.0, xb, w)
+            numpy.log(w, db)
+            w -= 1.0
+            if lo < finfo.eps:
+                #x below resolution of w: 0/0 -> (0-1)/(0-1)
+                s = numpy.equal(w, 0.0, u2)
+                db -= s
+                w -= s
+            numpy.divide(db, w, db)
+            if hi > 0.5:
+                upper = numpy.flatnonzero(xb > 0.5)
+                xu = xb[upper]
+                #log(1-x) (exact for x > 1/2), kept finite for x = 1
+                l1 = numpy.log(1.0 - xu)
+                numpy.maximum(l1, logtiny, l1)
+                l2 = numpy.log(xu)
+            if hi >= 1.0:
+                db[xb >= 1.0] = 0.0
+
+            #u = -log(1-x) = x dg2 below, -log(x) above 1/2
+            numpy.multiply(xb, db, u)
+            if hi > 0.5:
+                u[upper] = -l2
+
+            #Horner scheme in u**2 (x no longer needed)
+            numpy.multiply(u, u, u2)
+            numpy.multiply(u2, series[-1], gb)
+            gb += series[-2]
+            for c in series[-3::-1]:
+                gb *= u2
+                gb += c
+            gb *= u
+            gb -= 0.25
+            gb *= u
+            gb += 1.0
+            gb *= u
+
+            #reflection
+            if hi > 0.5:
+                l2 *= l1
+                l2 += gb[upper]
+                gb[upper] = numpy.pi**2/6 - l2
+
+    if gcopy:
+        g[...] = gf.reshape(g.shape)
+    if dgcopy:
+        dg[...] = dgf.reshape(dg.shape)
+
+    if scalar:
+        return g[0], (dg[0] if derivative else None)
+    return g, (dg if derivative else None)
 
 def g2(x, out=None):
     """bose function"""
-    if out is None:
-        return scipy.special.spence(1.0-x)
-    else:
-        return scipy.special.spence(1.0-x, out)
+    return g2dg2(x, out, derivative = False)[0]
 
 def dg2(x, out=None):
     """derivative of g2(x)"""
     #y = -log(1-x)/x
-    if out is None:
-        y = numpy.subtract(1.0, x)
-    else:
-        numpy.subtract(1.0,x,out)
-        y = out
-    numpy.log(y,y)
-    numpy.divide(y,x,y)
-    numpy.negative(y,y)
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        y = numpy.negative(x, out)
+        numpy.log1p(y, y)
+        numpy.divide(y, x, y)
+        numpy.negative(y, y)
     
     y[x<=0.0] = 1.0
-    y[x==1.0] = 0.0
+    y[x>=1.0] = 0.0
     if numpy.any(~numpy.isfinite(y)):
         print "some non finite entries in dg2!"
     
@@ -1227,8 +2179,8 @@ class BoseBimodal2d(Bimodal2d):
         if self.cache.has_key(key):
             [g, b] = self.cache[key]
         else:
-            g = numpy.exp(- (x-mx)**2 / (2*sx**2) 
-                            - (y-my)**2 / (2*sy**2))
+            gx, gy = gauss_factors(x-mx, y-my, sx, sy)
+            g = gy*gx
             g2(g,g)
             numpy.multiply(g, A, g)
             b = (1 - ((x-mx)/rx)**2 - ((y-my)/ry)**2)
@@ -1251,19 +2203,18 @@ class BoseBimodal2d(Bimodal2d):
         mx, my, sx, sy, rx, ry = pars
 
         X,Y = numpy.broadcast_arrays(x,y)
-        F = numpy.empty(shape = (3,) + X.shape)
+        F = self.workspace('F', (3,) + X.shape)
 
         #gauss
-        numpy.multiply(numpy.exp( -(x-mx)**2/(2*sx**2)),
-                       numpy.exp( -(y-my)**2/(2*sy**2)),
-                       F[0])
-        G = F[0].copy()
-        g2(F[0], F[0])
-        dg2G = dg2(G)
+        gx, gy = gauss_factors(x-mx, y-my, sx, sy)
+        G = self.workspace('G', X.shape)
+        numpy.multiply(gy, gx, G)
+        dg2G = g2dg2(G, F[0], self.workspace('dg2G', X.shape))[1]
 
         #TF
         b = F[1]
-        numpy.maximum(1 - ((x-mx)/rx)**2 - ((y-my)/ry)**2, 0, b)
+        numpy.subtract(1 - ((x-mx)/rx)**2, ((y-my)/ry)**2, b)
+        numpy.maximum(b, 0, b)
         numpy.sqrt(b,b)
         #numpy.power(b,3,b) #done later
 
@@ -1273,7 +2224,7 @@ class BoseBimodal2d(Bimodal2d):
         #derivatives
         Fd = []
         #mx
-        Fdmx = numpy.empty_like(F)
+        Fdmx = self.workspace('Fdmx', F.shape)
         
         numpy.multiply(G, 1.0/(sx**2)*(x-mx), Fdmx[0])
         numpy.multiply(Fdmx[0], dg2G, Fdmx[0])
@@ -1281,34 +2232,34 @@ class BoseBimodal2d(Bimodal2d):
         Fdmx[2] = 0
 
         #my
-        Fdmy = numpy.empty_like(F)
+        Fdmy = self.workspace('Fdmy', F.shape)
         numpy.multiply(G, 1.0/(sy**2)*(y-my), Fdmy[0])
         numpy.multiply(Fdmy[0], dg2G, Fdmy[0])
         numpy.multiply(F[1], 3.0/(ry**2)*(y-my), Fdmy[1])
         Fdmy[2] = 0
 
         #sx
-        Fdsx = numpy.empty_like(F)
+        Fdsx = self.workspace('Fdsx', F.shape)
         numpy.multiply(G, 1.0/sx**3 * ((x-mx)**2), Fdsx[0])
         numpy.multiply(Fdsx[0], dg2G, Fdsx[0])
         Fdsx[1] = 0
         Fdsx[2] = 0
 
         #sy
-        Fdsy = numpy.empty_like(F)
+        Fdsy = self.workspace('Fdsy', F.shape)
         numpy.multiply(G, 1.0/sy**3 * ((y-my)**2), Fdsy[0])
         numpy.multiply(Fdsy[0], dg2G, Fdsy[0])
         Fdsy[1] = 0
         Fdsy[2] = 0
 
         #rx
-        Fdrx = numpy.empty_like(F)
+        Fdrx = self.workspace('Fdrx', F.shape)
         Fdrx[0] = 0
         numpy.multiply(F[1], 3.0/(rx**3) * ((x-mx)**2), Fdrx[1])
         Fdrx[2] = 0
 
         #ry
-        Fdry = numpy.empty_like(F)
+        Fdry = self.workspace('Fdry', F.shape)
         Fdry[0] = 0
         numpy.multiply(F[1], 3.0/(ry**3) * ((y-my)**2), Fdry[1])
         Fdry[2] = 0
@@ -1326,10 +2277,44 @@ class BoseBimodal2d(Bimodal2d):
 
         return F, Fd, nz
 
+    def thermal_functions(self, pars, dx, dy):
+        """thermal basis functions of reduced problem: g2(G),
+        constant, and u*dx, u*dy, u*dx**2, u*dy**2 with u = G*dg2(G)
+        (derivatives of g2(G) up to factors), see
+        L{Bimodal2d.thermal_functions}"""
+        gx, gy = gauss_factors(dx, dy, pars[2], pars[3])
+        shape = numpy.broadcast(gx, gy).shape
+        G = numpy.multiply(gy, gx, self.workspace('G', shape))
+        Phi = self.workspace('Phi', (6,) + shape)
+        g2dg2(G, Phi[0], Phi[2])
+        Phi[1] = 1
+        numpy.multiply(Phi[2], G, Phi[2])
+        numpy.multiply(Phi[2], dy, Phi[3])
+        numpy.multiply(Phi[2], dx, Phi[2])
+        numpy.multiply(Phi[2], dx, Phi[4])
+        numpy.multiply(Phi[3], dy, Phi[5])
+        return Phi
+
+    def thermal_normal(self, pars, x, y, data, masked, box):
+        """inner products of thermal basis functions, see
+        L{Bimodal2d.thermal_normal}. The bose enhanced gaussian is not
+        a product of factors for x and y, the basis functions are
+        evaluated for every pixel."""
+        Phi = self.thermal_functions(pars, x - pars[0], y - pars[1])
+        rows, cols = masked
+        Phi[:, rows, cols] = 0
+        Phibox = Phi[(slice(None),) + box] if box is not None else None
+        Phi = Phi.reshape((6, -1))
+        return LM.inner64(Phi, Phi), LM.inner64(Phi, data.ravel()), Phibox
+
 class ThomasFermi2d(Gauss2d):
     """Perform fit of 2d Thomas=Fermi distribution to data.
     @sort: do_fit, TF2d, TF2d_flat, DTF2d, fJ"""
 
+    def __init__(self, imaging_pars = None):
+        super(ThomasFermi2d, self).__init__(imaging_pars)
+        self.MyFitPars = FitParsTF2d
+
     def TF2d(self, pars, x, y, v0 = 0, full_output = False):
         """calculate Thomas-Fermi 2d distribution. See L{gauss2d} for
         parameter description.
@@ -1395,36 +2380,28 @@ class ThomasFermi2d(Gauss2d):
         J.shape = (6,-1)
         return f, J
 
-    def do_fit(self, img, roi):
-        """
-        @rtype: [fit image, fit image gauss only], fit background, FitPars
-        """
-        x = numpy.asarray(roi.xrange_clipped(img), dtype = imgtype)
-        y = numpy.asarray(roi.yrange_clipped(img), dtype = imgtype)
-
-        imgroi = img[roi.y, roi.x]
+    def find_startpar(self, x, y, imgroi):
         imgroifilled = imgroi.filled()
 
         xprof = imgroifilled.sum(0)
         yprof = imgroifilled.sum(1)
 
-        startparx = self._find_startpar_gauss(x,xprof)
-        startpary = self._find_startpar_gauss(y,yprof)
+        startparx = self._find_startpar_gauss(x.ravel(),xprof)
+        startpary = self._find_startpar_gauss(y.ravel(),yprof)
 
         [Ax, mx, sx, ox] = startparx[0:4]
         [Ay, my, sy, oy] = startpary[0:4]
         A = Ay/(numpy.sqrt(2*numpy.pi)*sx)
 
-        startpar = [mx,
-                    my,
-                    0.5*(ox/len(y)+oy/len(x)),
-                    A*0.8,
-                    sx*0.5,
-                    sy*0.5]
-
-        x.shape = (1,-1)
-        y.shape = (-1, 1)
+        startpar = numpy.array([mx,
+                                my,
+                                0.5*(ox/y.size+oy/x.size),
+                                A*0.8,
+                                sx*0.5,
+                                sy*0.5])
+        return startpar
 
+    def fit_startpar(self, x, y, imgroi, imgsel, startpar, tau = 1e-2):
         if use_minpack:
             fitpar, cov, infodict, mesg, ier = \
                     leastsq(self.TF2d_flat,
@@ -1436,23 +2413,98 @@ class ThomasFermi2d(Gauss2d):
                             full_output = 1,
                             )
         else:
-            imgsel = numpy.ma.getmaskarray(imgroi.ravel())
             fitpar, J, r = LM.LM(self.fJ_masked,
                                  startpar,
                                  args = (x, y, imgroi, imgsel),
                                  kmax = 30,
+                                 tau = tau,
                                  eps1 = 1e-6,
                                  eps2 = 1e-6,
                                  verbose = self.verbose,
                                  full_output = True,
                                  )
         fitparerr, sigma = LM.fitparerror(fitpar, J, r)
-        imgfit = self.TF2d(fitpar, x, y)
-        
-        fitpars = FitParsTF2d(fitpar, self.imaging_pars, fitparerr, sigma)
-        background = numpy.array([fitpars.offset], dtype = imgtype)
-        
-        return [imgfit,], background, fitpars
+        return fitpar, fitparerr, sigma
+
+    def normal_batch(self, pars, index, x, y, data, datasum, datasq, masks, counts):
+        """normal equations of fits of several images, for
+        L{LM.LM_batch_normal}. The Thomas-Fermi profile vanishes
+        outside its radii: model and Jacobian are evaluated in the
+        bounding box of the profile only (see L{ellipse_box}), outside
+        only the offset contributes.
+
+        @param pars: parameters (n x 6)
+        @param index: images of members
+        @param data: images, masked pixels set to zero (see L{gauss_batch_data})
+        @param datasum: sums of images
+        @param datasq: squared norms of images
+        @param masks: masks of images (K x N x M), True for masked pixels
+        @param counts: numbers of valid pixels of images
+        @return: normal matrices (n x 6 x 6), gradients (n x 6), squared
+        norms of residua (n), None
+        """
+        n = len(pars)
+        A = numpy.empty((n, 6, 6))
+        g = numpy.empty((n, 6))
+        F = numpy.empty(n)
+        for j, i in enumerate(index):
+            mx, my, offs, B, rx, ry = pars[j]
+            rows, cols = ellipse_box(x, y, mx, my, rx, ry) or (slice(0, 0), slice(0, 0))
+            dx = numpy.asarray(x[:, cols], dtype = numpy.float64) - mx
+            dy = numpy.asarray(y[rows], dtype = numpy.float64) - my
+            b = 1 - (dx/rx)**2 - (dy/ry)**2
+            numpy.maximum(b, 0, b)
+            numpy.sqrt(b, b)
+
+            J = numpy.empty((6,) + b.shape)
+            J[0] = (3.0*B/(rx**2)) * dx * b
+            J[1] = (3.0*B/(ry**2)) * dy * b
+            J[2] = 1
+            J[3] = b**3
+            J[4] = J[0] * (dx/rx)
+            J[5] = J[1] * (dy/ry)
+            J.shape = (6, -1)
+
+            w = ~masks[i][rows, cols].ravel()
+            d = data[i][rows, cols].ravel()
+            r = (B*J[3] + offs - d)*w
+            A[j] = numpy.dot(J*w, J.T)
+            g[j] = numpy.dot(J, r)
+            F[j] = numpy.dot(r, r)
+
+            #outside of box: offset only
+            nout = counts[i] - w.sum()
+            dsum = datasum[i] - d.sum()
+            dsq = datasq[i] - numpy.dot(d, d)
+            A[j, 2, 2] += nout
+            g[j, 2] += offs*nout - dsum
+            F[j] += offs**2*nout - 2*offs*dsum + dsq
+        return A, g, F, None
+
+    def fit_startpar_batch(self, x, y, stack, masks, startpar):
+        if use_minpack or self.fit_startpar.im_func is not ThomasFermi2d.fit_startpar.im_func:
+            return Fitting.fit_startpar_batch(self, x, y, stack, masks, startpar)
+
+        data, datasum, datasq, masked = gauss_batch_data(stack, masks)
+        masks = numpy.asarray(masks).reshape(data.shape)
+        counts = (~masks).sum(2).sum(1)
+        results = LM.LM_batch_normal(self.normal_batch,
+                                     numpy.tile(startpar, (len(stack), 1)),
+                                     args = (x, y, data, datasum, datasq, masks, counts),
+                                     kmax = 30,
+                                     eps1 = 1e-6,
+                                     eps2 = 1e-6,
+                                     verbose = self.verbose,
+                                     full_output = True,
+                                     )
+        return [(fitpar,) + LM.fitparerror_normal(fitpar, A, F, x.size*y.size)
+                for fitpar, A, F, state in results]
+
+    def fit_images(self, fitpar, x, y):
+        return [self.TF2d(fitpar, x, y),]
+
+    def check_fit(self, fitpar, roi):
+        return True
 
 class FitPars(object):
     """base class for representing fit results. Never used directly.
@@ -2085,7 +3137,72 @@ def test_fitting_gauss():
     print "nsum", img.sum()*fac
     print (fitpars.__str__()).encode('ascii', 'ignore')
 
+def test_fitting_batch(nimages = 20):
+
+    import roi
+    import imagingpars
+
+    ip = imagingpars.ImagingPars()
+
+    fit = Gauss2d(ip)
 
+    x = numpy.arange(501, dtype = imgtype).reshape((1,-1))
+    y = numpy.arange(301, dtype = imgtype).reshape((-1,1))
+
+    numpy.random.seed(0)
+    images = numpy.empty(shape = (nimages, 301, 501), dtype = imgtype)
+    for k in range(nimages):
+        #A, mx, my, sx, sy, offs
+        pars = [1, 250 + 5*numpy.random.randn(), 150, 40, 30, 0]
+        images[k] = fit.gauss2d(pars, x, y, 0)
+    images += numpy.random.standard_normal(images.shape)*0.2
+
+    r = roi.ROI(100, 400, 50, 250)
+
+    tic = time()
+    for img in images:
+        fit.do_fit(numpy.ma.array(img), r)
+    print "do_fit:       %.1f ms per image"%(1e3*(time() - tic)/nimages)
+
+    tic = time()
+    fitpar, fitparerr, imgfits, fitpars = fit.do_fit_batch(images, r)
+    print "do_fit_batch: %.1f ms per image"%(1e3*(time() - tic)/nimages)
+    print "mx:", fitpar[:,1]
+
+def test_result_cache():
+
+    import roi
+    import imagingpars
+
+    ip = imagingpars.ImagingPars()
+    fit = Gauss2d(ip)
+
+    x = numpy.arange(201, dtype = imgtype).reshape((1,-1))
+    y = numpy.arange(151, dtype = imgtype).reshape((-1,1))
+    numpy.random.seed(0)
+    img = fit.gauss2d([1, 100, 75, 20, 15, 0], x, y, 0)
+    img = numpy.ma.array(img + numpy.random.standard_normal(img.shape)*0.2)
+    r = roi.ROI(20, 180, 10, 140)
+
+    result_cache.clear()
+    imgfit, background, fitpars = fit.do_fit(img, r)
+    fitpars.invalidate()
+    imgfit[0][...] = 0
+    background += 1
+    hits = result_cache.hits
+    imgfit, background, fitpars = fit.do_fit(img, r)
+    assert result_cache.hits == hits + 1 and fitpars.valid, "cached result changed"
+    assert imgfit[0].any() and background[0] == imgtype(fitpars.offset), "cached images changed"
+
+    fit.precision = numpy.float32
+    fit.do_fit(img, r)
+    assert result_cache.hits == hits + 1, "result of other precision returned"
+
+    cache = ResultCache(maxbytes = 3*imgfit[0].nbytes)
+    for k in range(5):
+        cache.put(k, (imgfit, background, fitpars))
+    assert len(cache) == 2 and cache.nbytes <= cache.maxbytes
+    print cache
 
 if __name__ == '__main__':
     import profile
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+#-*- coding: latin-1 -*-
+"""Bounded queue for acquired images between acquisition threads
+(producers) and consumer threads, with policy for full queue:
+
+ - 'block': producer waits for free space (like Queue.Queue)
+ - 'drop-oldest': oldest queued image is dropped, e.g. for live
+   display of the most recent images
+ - 'drop-newest': new image is dropped. Images belong to sets of
+   setsize consecutive images (e.g. atoms/light/dark for absorption
+   imaging); a set is accepted only if there is room for all of its
+   images, otherwise the complete set is dropped.
+
+Puts never block with the drop policies, so a slow consumer can't
+stall the camera or make memory grow. Counters of produced,
+consumed and dropped images and the high-water mark of the queue are
+kept.
+
+Consumers group the images taken from the queue into complete sets
+with L{SetAssembler}."""
+
+from __future__ import with_statement
+
+import time
+import Queue
+
+#: policies for full queue
+policies = ('block', 'drop-oldest', 'drop-newest')
+
+class FrameQueue(Queue.Queue):
+    """Queue.Queue with policy for full queue, see module docstring.
+
+    @ivar produced: number of items put (including dropped ones)
+    @ivar consumed: number of items taken by L{get}
+    @ivar dropped: number of items dropped
+    @ivar highwater: maximum number of items queued"""
+
+    def __init__(self, maxsize = 3, policy = 'block', setsize = 1, discard = None):
+        """
+        @param maxsize: capacity of queue, must be positive for drop policies
+        @param policy: one of L{policies}
+        @param setsize: number of images in set, for 'drop-newest'
+        @param discard: called with each dropped item, e.g. to release
+        frame memory
+        """
+        Queue.Queue.__init__(self, maxsize)
+        self.discard = discard
+        self.set_policy(policy, setsize)
+        self.reset_counters()
+
+    def set_policy(self, policy, setsize = 1):
+        """set policy for full queue and size of image sets. Call
+        before acquisition starts (or after L{clear}), the first item
+        put after this starts a new set."""
+        if policy not in policies:
+            raise ValueError("unknown queue policy '%s'"%policy)
+        if policy != 'block' and not 0 < setsize <= self.maxsize:
+            raise ValueError("queue size %d too small for policy '%s' with sets of %d"%(
+                self.maxsize, policy, setsize))
+        with self.mutex:
+            self.policy = policy
+            self.setsize = setsize
+            self._setpos = 0
+            self._dropset = False
+
+    def reset_counters(self):
+        with self.mutex:
+            self.produced = 0
+            self.consumed = 0
+            self.dropped = 0
+            self.highwater = 0
+
+    def stats(self):
+        """@return: counters and current size of queue
+        @rtype: dict"""
+        with self.mutex:
+            return {'produced': self.produced,
+                    'consumed': self.consumed,
+                    'dropped': self.dropped,
+                    'highwater': self.highwater,
+                    'size': self._qsize()}
+
+    def put(self, item, block = True, timeout = None):
+        if self.policy == 'block':
+            Queue.Queue.put(self, item, block, timeout)
+            return
+
+        with self.not_full:
+            self.produced += 1
+            if self.policy == 'drop-oldest':
+                dropped = []
+                while self._qsize() >= self.maxsize:
+                    dropped.append(self.queue.popleft())
+                self._dropped(len(dropped))
+                accepted = True
+            else:
+                if self._setpos == 0:
+                    #first image of set: accept set if there is room for all images
+                    self._dropset = self.maxsize - self._qsize() < self.setsize
+                self._setpos = (self._setpos + 1)%self.setsize
+                accepted = not self._dropset
+                dropped = [] if accepted else [item]
+
+            if accepted:
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+            self.dropped += len(dropped)
+
+        for d in dropped:
+            if self.discard is not None:
+                self.discard(d)
+
+    def clear(self):
+        """drop all queued items and start new set. Not counted as
+        dropped."""
+        with self.mutex:
+            items = list(self.queue)
+            self.queue.clear()
+            self._dropped(len(items))
+            self._setpos = 0
+            self._dropset = False
+            self.not_full.notifyAll()
+        for item in items:
+            if self.discard is not None:
+                self.discard(item)
+
+    def _dropped(self, n):
+        #n queued items removed without get: no task_done expected for them
+        if n > 0:
+            self.unfinished_tasks -= n
+            if self.unfinished_tasks <= 0:
+                self.unfinished_tasks = 0
+                self.all_tasks_done.notifyAll()
+
+    def _put(self, item):
+        self.queue.append(item)
+        if self.policy == 'block':
+            self.produced += 1
+        self.highwater = max(self.highwater, len(self.queue))
+
+    def _get(self):
+        self.consumed += 1
+        return self.queue.popleft()
+
+class SetAssembler(object):
+    """Groups acquired images into complete sets, e.g. atoms, light
+    and dark image of absorption imaging. Images of a set must have
+    consecutive frame numbers and must be acquired within timeout
+    after the first image of the set. Otherwise the incomplete set is
+    discarded and the image breaking the sequence starts a new set,
+    so a lost image costs only its own set and later sets stay
+    aligned.
+
+    @ivar completed: number of complete sets
+    @ivar incomplete: number of discarded incomplete sets"""
+
+    def __init__(self, setsize = 3, timeout = 2.0, discard = None):
+        """
+        @param setsize: number of images in set
+        @param timeout: maximum time (s) between first and last image of set
+        @param discard: called with each item of discarded set, e.g. to
+        release frame memory
+        """
+        self.setsize = setsize
+        self.timeout = timeout
+        self.discard = discard
+        self.pending = []
+        self.completed = 0
+        self.incomplete = 0
+        self._started = 0
+
+    @staticmethod
+    def frame_number(item):
+        """frame number of queue item (nr, img, time): frame ID
+        assigned by camera if available, which also counts frames lost
+        before reaching the queue, else image number of acquisition
+        thread."""
+        return getattr(item[1], 'frameID', item[0])
+
+    def add(self, item):
+        """add image to current set
+
+        @param item: (nr, img, time) as put into queue by acquisition
+        thread, time of acquisition in s
+        @return: items of set if complete, else None
+        @rtype: list
+        """
+        if self.pending:
+            if (self.frame_number(item) != self.frame_number(self.pending[-1]) + 1
+                or item[2] - self.pending[0][2] > self.timeout):
+                self.drop_pending()
+        if not self.pending:
+            self._started = time.time()
+        self.pending.append(item)
+
+        if len(self.pending) < self.setsize:
+            return None
+        imgset, self.pending = self.pending, []
+        self.completed += 1
+        return imgset
+
+    def expire(self):
+        """discard incomplete set if its first image was added more
+        than timeout ago, call when no images arrive
+
+        @return: True if set was discarded"""
+        if self.pending and time.time() - self._started > self.timeout:
+            self.drop_pending()
+            return True
+        return False
+
+    def drop_pending(self):
+        """discard incomplete set"""
+        pending, self.pending = self.pending, []
+        if pending:
+            self.incomplete += 1
+        if self.discard is not None:
+            for item in pending:
+                self.discard(item)
+
+def test_policies():
+    q = FrameQueue(3, 'drop-oldest')
+    for k in range(5):
+        q.put(k)
+    assert [q.get(), q.get(), q.get()] == [2, 3, 4]
+    assert q.stats() == dict(produced = 5, consumed = 3, dropped = 2, highwater = 3, size = 0)
+
+    #sets of three: second set doesn't fit while first is queued
+    discarded = []
+    q = FrameQueue(4, 'drop-newest', setsize = 3, discard = discarded.append)
+    for k in range(6):
+        q.put(k)
+    assert discarded == [3, 4, 5]
+    q.get(); q.get(); q.get()
+    for k in range(6, 9):
+        q.put(k)
+    assert [q.get(), q.get(), q.get()] == [6, 7, 8]
+
+    #set dropped completely even if space becomes free while it arrives
+    q = FrameQueue(4, 'drop-newest', setsize = 3)
+    for k in range(4):
+        q.put(k)
+    q.get(); q.get(); q.get()
+    q.put(4); q.put(5)
+    assert q.empty()
+    q.put(6)
+    assert list(q.queue) == [6]
+    assert q.dropped == 3 and q.unfinished_tasks == 4
+    print "FrameQueue tests passed"
+
+def test_assembler():
+    discarded = []
+    a = SetAssembler(3, timeout = 1.0, discard = discarded.append)
+    #second image of second set lost, third set late
+    items = [(1, None, 0.0), (2, None, 0.1), (3, None, 0.2),
+             (4, None, 5.0), (6, None, 5.2),
+             (7, None, 10.0), (8, None, 10.1), (9, None, 12.0),
+             (10, None, 12.1), (11, None, 12.2)]
+    sets = [a.add(item) for item in items]
+    assert [[item[0] for item in s] for s in sets if s] == [[1, 2, 3], [9, 10, 11]]
+    assert [item[0] for item in discarded] == [4, 6, 7, 8]
+    assert a.completed == 2 and a.incomplete == 3
+
+    a.add((12, None, 20.0))
+    a._started -= 2
+    assert a.expire() and a.incomplete == 4 and not a.pending
+    print "SetAssembler tests passed"
+
+if __name__ == '__main__':
+    test_policies()
+    test_assembler()
@@ -1,7 +1,10 @@
 ﻿import numpy as np
 import readsis
 import readpng
+import rawimage
+import shotarchive
 from png_writer import PngWriter
+from absorption import optical_density
 import os.path
 
 def imagesplit(img):
@@ -26,26 +29,23 @@ def find_background(img, r = 10.0):
     return m, s
     
 def calc_img(img1, img2, img3):
+    """optical density and transmission of absorption image (see
+    L{absorption.optical_density}). In each half of the image, pixels
+    where the light image doesn't exceed the dark image by four
+    standard deviations of the background are masked."""
 
-    img_trans = np.true_divide(img1-img3, img2-img3)
-    imga,  imgb  = imagesplit(img_trans)
+    od = np.empty(shape = img1.shape, dtype = np.float32)
+    mask = np.empty(shape = img1.shape, dtype = np.bool_)
 
-    img2a, img2b = imagesplit(img2)
-    ma, sa = find_background(img2a)
-    mb, sb = find_background(img2b)
-
-    mask = np.empty(shape = img_trans.shape, dtype = np.bool_)
-    maska, maskb = imagesplit(mask)
-
-    maska[:], maskb[:] = img2a<ma+4*sa, img2b<mb+4*sb
-
-    img_trans = np.ma.array(data = img_trans, mask = mask, fill_value = np.NaN)
+    for a, l, d, o, m in zip(*[imagesplit(img) for img in (img1, img2, img3, od, mask)]):
+        mean, s = find_background(l)
+        optical_density(a, l, d, minlight = 4*s, out = o, mask = m)
 
     data = {'image1': img1,
             'image2': img2,
             'image3': img3,
-            'transmission': img_trans,
-            'optical_density': -np.log(img_trans)}
+            'transmission': np.ma.array(data = np.exp(-od), mask = mask, fill_value = np.NaN),
+            'optical_density': np.ma.array(data = od, mask = mask, fill_value = np.NaN)}
 
     return data
     
@@ -102,17 +102,17 @@ def load_image_png(filename):
         img = img.astype(np.float32)
         img = np.ma.masked_where(img==0, (1.0/scale) * img)
         img-= 1.0
-        return imgsplit(img)
+        return imagesplit(img)
 
     elif imagetype == 'transmission':
         scale = float(metadata['scale transmission'])
         img = img.astype(np.float32)
         img = np.ma.masked_where(img==0, -np.log((1.0/scale)*img))
-        return imgsplit(img)
+        return imagesplit(img)
 
     elif imagetype == 'raw':
         img = np.ma.array(img, dtype = np.float32)
-        return imgsplit(img)
+        return imagesplit(img)
 
     else:
         img = np.ma.array(img, dtype = np.float32)
@@ -122,6 +122,8 @@ def load_image_png(filename):
 
     
 def load_image(filename):
+    if shotarchive.split_path(filename):
+        return shotarchive.load_image(filename)
     root, ext = os.path.splitext(filename)
     if ext.lower() == '.sis':
         print "read sis"
@@ -129,8 +131,12 @@ def load_image(filename):
     elif ext.lower() == '.png':
         print "read png"
         return load_image_png(filename)
+    elif ext.lower() == '.raw':
+        return rawimage.load_image(filename)
 
 def load_image_giacomo(filename):
+    if shotarchive.split_path(filename):
+        return shotarchive.load_image(filename)
     root, ext = os.path.splitext(filename)
     if ext.lower() == '.sis':
         print "read sis"
@@ -140,6 +146,8 @@ def load_image_giacomo(filename):
         img, img = load_image_png(filename)
         img = -np.log(img)
         return img, img
+    elif ext.lower() == '.raw':
+        return rawimage.load_image(filename)
 
     
 
@@ -0,0 +1,400 @@
+#!/usr/bin/python
+#-*- coding: latin-1 -*-
+"""Rendering of camera images to RGB with colormap, for
+L{ImagePanel.CamImageDisplay}. Kept free of wx, so that it can be used
+and timed without GUI.
+
+Pixel values are mapped linearly from [vmin, vmax] to the 256 entries
+of the colormap (values outside are clipped, NaN gives the color of
+vmin), like the colormap scaling of matplotlib. The lookup table of a
+colormap is computed once and cached. Integer images (uint8, uint16)
+are mapped with a lookup table for all possible pixel values, built
+once per color scaling, in a single pass. Float images are mapped in
+blocks of rows, so that temporaries stay in the cache. The RGB output
+buffer is kept and reused for following frames of the same size.
+
+L{TileRenderer} renders the scaled image in tiles, on demand, so that
+only the visible part of a large image is colormapped and scaled.
+Rendered tiles are cached; a new image invalidates only tiles whose
+source pixels changed. For zoom < 1 the pixel values are averaged
+before colormapping, using a pyramid of images reduced by 2x2 block
+averages (see L{reduce_image})."""
+
+from __future__ import with_statement
+
+from collections import OrderedDict
+
+import numpy
+
+#: number of pixels processed at once for float images
+blocksize = 32768
+
+#lookup tables of colormaps, RGB (256x3, uint8)
+_luts = {}
+
+def colormap_lut(colormap):
+    """@return: RGB lookup table of colormap (cached)
+    @rtype: ndarray (256x3, uint8)"""
+    lut = _luts.get(colormap)
+    if lut is None:
+        lut = numpy.ascontiguousarray(colormap(numpy.arange(256), bytes = True)[:, :3])
+        _luts[colormap] = lut
+    return lut
+
+class ColormapRenderer(object):
+    """Maps images to RGB, reusing the output buffer.
+
+    @ivar colormap: matplotlib colormap (or callable with same interface)"""
+
+    def __init__(self, colormap):
+        self.colormap = colormap
+        self._out = None
+        self._intlut = (None, None) #key, lookup table for integer images
+
+    def _output(self, shape, out):
+        if out is not None:
+            return out
+        shape = shape + (3,)
+        if self._out is None or self._out.shape != shape:
+            self._out = numpy.empty(shape, numpy.uint8)
+        return self._out
+
+    def render(self, img, vmin, vmax, out = None):
+        """map image to RGB
+
+        @param img: image (2d), masked arrays are rendered with data
+        of masked pixels
+        @param out: output array (h x w x 3, uint8, C contiguous),
+        default: buffer of renderer, overwritten by next call
+        @return: RGB image
+        @rtype: ndarray (h x w x 3, uint8)
+        """
+        img = numpy.ma.getdata(img)
+        out = self._output(img.shape, out)
+        lut = colormap_lut(self.colormap)
+
+        if img.dtype in (numpy.uint8, numpy.uint16):
+            key = (self.colormap, img.dtype, vmin, vmax)
+            if self._intlut[0] != key:
+                values = numpy.arange(numpy.iinfo(img.dtype).max + 1)
+                self._intlut = (key, self.render(values, vmin, vmax,
+                                                 numpy.empty((len(values), 3), numpy.uint8)))
+            self._intlut[1].take(img, axis = 0, out = out, mode = 'clip')
+            return out
+
+        #index = (value - vmin)*scale, truncated to 0..255
+        scale = 255.0/(vmax - vmin)
+        src = img.reshape(-1)
+        dst = out.reshape(-1, 3)
+        n = min(blocksize, src.size)
+        t = numpy.empty(n, numpy.result_type(src.dtype, numpy.float32))
+        idx = numpy.empty(n, numpy.uint8)
+        nan = numpy.empty(n, numpy.bool_)
+        with numpy.errstate(invalid = 'ignore'):
+            for start in xrange(0, src.size, n):
+                s = slice(start, start + n)
+                k = len(src[s])
+                tb, ib, nb = t[:k], idx[:k], nan[:k]
+                numpy.subtract(src[s], vmin, tb, casting = 'unsafe')
+                tb *= scale
+                tb.clip(0, 255, tb)
+                ib[...] = tb
+                #NaN: color of vmin
+                numpy.isnan(tb, nb)
+                ib[nb] = 0
+                lut.take(ib, axis = 0, out = dst[s], mode = 'clip')
+        return out
+
+def _changed_blocks(old, new, blocksize):
+    """@return: True for blocks (blocksize x blocksize) of image with
+    changed pixels (compared bitwise, so unchanged NaN are unchanged)
+    @rtype: ndarray (bool)"""
+    if old.dtype.kind == 'f':
+        uint = numpy.dtype('u%d'%old.dtype.itemsize)
+        old, new = old.view(uint), new.view(uint)
+    diff = old != new
+    h, w = diff.shape
+    nby, nbx = -(-h//blocksize), -(-w//blocksize)
+    if (h, w) != (nby*blocksize, nbx*blocksize):
+        padded = numpy.zeros((nby*blocksize, nbx*blocksize), numpy.bool_)
+        padded[:h, :w] = diff
+        diff = padded
+    return diff.reshape(nby, blocksize, nbx, blocksize).any(axis = 3).any(axis = 1)
+
+def reduce_image(img):
+    """reduce image by averaging blocks of 2x2 pixels, ignoring NaN.
+    For odd sizes the last row (column) is averaged with itself.
+
+    @return: reduced image, (h+1)/2 x (w+1)/2
+    @rtype: ndarray (float32 or float64)
+    """
+    h, w = img.shape
+    if h%2 or w%2:
+        img = numpy.pad(img, ((0, h%2), (0, w%2)), 'edge')
+    dtype = numpy.result_type(img.dtype, numpy.float32)
+    quads = (img[0::2, 0::2], img[1::2, 0::2], img[0::2, 1::2], img[1::2, 1::2])
+    if img.dtype.kind != 'f':
+        out = quads[0].astype(dtype)
+        for q in quads[1:]:
+            out += q
+        out *= 0.25
+        return out
+
+    out = numpy.zeros(quads[0].shape, dtype)
+    n = numpy.zeros(quads[0].shape, dtype)
+    for q in quads:
+        valid = ~numpy.isnan(q)
+        numpy.add(out, q, out, where = valid)
+        n += valid
+    with numpy.errstate(invalid = 'ignore'):
+        out /= n #all NaN: 0/0 = NaN
+    return out
+
+class TileRenderer(object):
+    """Renders image scaled by zoom and colormapped in tiles of
+    tilesize x tilesize (display) pixels, on demand. Display pixel x
+    shows source pixel x*w/W (w, W: width of image and of scaled
+    image); for zoom < 1 a display pixel shows the average of the
+    source pixels x*w/W ... (x+1)*w/W - 1. Averages are taken from
+    the level of the image pyramid (L{reduce_image}) with the largest
+    reduction 2**k <= 1/zoom, the remaining reduction (for zoom not a
+    power of 2) is averaged per tile. Levels are built when first
+    needed for an image.
+
+    Tiles are cached for the current and previous settings of zoom,
+    color scaling and colormap. Images given to L{set_image} must not
+    be changed afterwards, they are compared to the next image to find
+    changed tiles.
+
+    @ivar rendered: number of tiles rendered"""
+
+    def __init__(self, colormap, vmin = 0.0, vmax = 1.0, zoom = 1,
+                 tilesize = 256, maxtiles = 128, convert = None):
+        """
+        @param maxtiles: maximum number of cached tiles
+        @param convert: called with rendered tile (RGB array), result
+        is cached and returned by L{tile}, e.g. to create bitmap
+        """
+        self.renderer = ColormapRenderer(colormap)
+        self.vmin = vmin
+        self.vmax = vmax
+        self.zoom = zoom
+        self.tilesize = tilesize
+        self.maxtiles = maxtiles
+        self.convert = convert
+        self.rendered = 0
+
+        #: source pixels per block for detecting changes
+        self.changeblock = 64
+        self._image = None
+        self._levels = []      #image pyramid, level k reduced by 2**k
+        self._gen = 0          #number of image
+        self._blockgen = None  #number of image in which block last changed
+        self._cache = OrderedDict()
+
+    def get_colormap(self):
+        return self.renderer.colormap
+
+    def set_colormap(self, colormap):
+        self.renderer.colormap = colormap
+
+    colormap = property(get_colormap, set_colormap)
+
+    @property
+    def image(self):
+        return self._image
+
+    def set_image(self, img):
+        """set image to render, invalidate tiles of changed pixels.
+        Masked arrays are rendered with data of masked pixels."""
+        img = numpy.ma.getdata(img)
+        old, self._image = self._image, img
+        self._levels = [img]
+        self._gen += 1
+        B = self.changeblock
+        if (old is None or old is img or old.shape != img.shape or old.dtype != img.dtype):
+            h, w = img.shape
+            self._blockgen = numpy.empty((-(-h//B), -(-w//B)), numpy.int_)
+            self._blockgen.fill(self._gen)
+            if old is None or old.shape != img.shape:
+                self._cache.clear()
+        else:
+            self._blockgen[_changed_blocks(old, img, B)] = self._gen
+
+    @property
+    def size(self):
+        """@return: width and height of scaled image"""
+        if self._image is None:
+            return 0, 0
+        h, w = self._image.shape
+        return int(w*self.zoom), int(h*self.zoom)
+
+    def visible(self, x, y, width, height):
+        """tiles (rendered if necessary) intersecting rectangle of
+        scaled image
+
+        @return: list of (left, top, tile)"""
+        W, H = self.size
+        T = self.tilesize
+        tiles = []
+        for ty in range(max(0, y//T), min(-(-H//T), -(-(y + height)//T))):
+            for tx in range(max(0, x//T), min(-(-W//T), -(-(x + width)//T))):
+                tiles.append((tx*T, ty*T, self.tile(tx, ty)))
+        return tiles
+
+    def _source(self, x0, x1, n, W):
+        #source pixel boundaries of display pixels x0..x1-1, and source range
+        edges = (numpy.arange(x0, x1 + 1)*n)//W
+        return edges, edges[0], min(n, max(edges[-1], edges[-2] + 1))
+
+    def _level(self):
+        """@return: number of pyramid level for zoom, level"""
+        k = 0
+        while 2**(k + 1)*self.zoom <= 1 and min(self._levels[k].shape) > 1:
+            k += 1
+            if len(self._levels) == k:
+                self._levels.append(reduce_image(self._levels[k - 1]))
+        return k, self._levels[k]
+
+    def tile(self, tx, ty):
+        """@return: tile tx, ty (RGB array, or result of convert)"""
+        W, H = self.size
+        T = self.tilesize
+        k, img = self._level()
+        h, w = img.shape
+        xs, c0, c1 = self._source(tx*T, min(tx*T + T, W), w, W)
+        ys, r0, r1 = self._source(ty*T, min(ty*T + T, H), h, H)
+
+        #source pixels of level k are blocks of 2**k image pixels
+        B = self.changeblock
+        changed = self._blockgen[(r0 << k)//B:((r1 << k) - 1)//B + 1,
+                                 (c0 << k)//B:((c1 << k) - 1)//B + 1].max()
+        key = (tx, ty, self.zoom, self.vmin, self.vmax, self.colormap)
+        entry = self._cache.pop(key, None)
+        if entry is None or entry[0] < changed:
+            entry = (self._gen, self._render(xs - c0, ys - r0, img[r0:r1, c0:c1]))
+        self._cache[key] = entry
+        while len(self._cache) > self.maxtiles:
+            self._cache.popitem(last = False)
+        return entry[1]
+
+    def _render(self, xs, ys, block):
+        self.rendered += 1
+        dx, dy = numpy.diff(xs), numpy.diff(ys)
+        if dx.min() == 0 or dy.min() == 0 or (dx.max() == 1 and dy.max() == 1):
+            #nearest neighbour
+            rgb = self.renderer.render(block, self.vmin, self.vmax,
+                                       numpy.empty(block.shape + (3,), numpy.uint8))
+            rgb = rgb[ys[:-1]][:, xs[:-1]]
+        else:
+            #average over source pixels, ignoring NaN
+            dtype = numpy.result_type(block.dtype, numpy.float32)
+            values = block.astype(dtype)
+            valid = numpy.ones(block.shape, dtype)
+            if block.dtype.kind == 'f':
+                nan = numpy.isnan(block)
+                values[nan] = 0
+                valid[nan] = 0
+            avg = numpy.add.reduceat(numpy.add.reduceat(values, ys[:-1], axis = 0), xs[:-1], axis = 1)
+            n = numpy.add.reduceat(numpy.add.reduceat(valid, ys[:-1], axis = 0), xs[:-1], axis = 1)
+            with numpy.errstate(invalid = 'ignore'):
+                avg /= n
+            rgb = self.renderer.render(avg, self.vmin, self.vmax,
+                                       numpy.empty(avg.shape + (3,), numpy.uint8))
+        if self.convert is not None:
+            return self.convert(numpy.ascontiguousarray(rgb))
+        return rgb
+
+def render_reference(img, colormap, vmin, vmax):
+    """colormap mapping as done by CamImageDisplay.render before, for
+    comparison"""
+    scale = (255.0/(vmax - vmin))
+    ci = numpy.empty_like(img)
+    numpy.subtract(img, vmin, ci)
+    numpy.multiply(ci, scale, ci)
+    ci.clip(0, 255, ci)
+    ci = ci.astype(numpy.uint8)
+    lut = colormap(numpy.arange(256), bytes = True)
+    lut = lut[:, :-1]
+    return lut.take(ci, axis = 0)
+
+def test_render(shape = (1040, 1392), repeat = 10):
+    import time
+
+    def colormap(x, bytes = False):
+        x = numpy.asarray(x)
+        return numpy.array([x, 255 - x, (3*x)%256, 255 + 0*x], numpy.uint8).T
+
+    rng = numpy.random.RandomState(0)
+    od = rng.normal(0.5, 0.5, shape).astype(numpy.float32)
+    raw = rng.randint(0, 4096, shape).astype(numpy.uint16)
+    renderer = ColormapRenderer(colormap)
+
+    for name, img, vmin, vmax in [('float32', od, -0.1, 1.5),
+                                  ('uint16', raw, 100, 3000)]:
+        #integer images had to be converted to float before
+        fimg = img.astype(numpy.float32)
+        expected = render_reference(fimg, colormap, vmin, vmax)
+        assert numpy.all(renderer.render(img, vmin, vmax) == expected), name
+
+        timings = []
+        for f in (lambda: render_reference(fimg, colormap, vmin, vmax),
+                  lambda: renderer.render(img, vmin, vmax)):
+            t = time.time()
+            for k in range(repeat):
+                f()
+            timings.append(1e3*(time.time() - t)/repeat)
+        print "%s %dx%d: before %.1f ms, now %.1f ms"%((name,) + shape + tuple(timings))
+
+    nan = od.copy()
+    nan[0, :10] = numpy.nan
+    assert numpy.all(renderer.render(nan, -0.1, 1.5)[0, :10] == colormap([0])[0, :3])
+
+def test_tiles():
+    import time
+
+    def colormap(x, bytes = False):
+        x = numpy.asarray(x)
+        return numpy.array([x, 255 - x, (3*x)%256, 255 + 0*x], numpy.uint8).T
+
+    rng = numpy.random.RandomState(0)
+    img = rng.normal(0.5, 0.5, (2080, 1392)).astype(numpy.float32)
+    tiles = TileRenderer(colormap, -0.1, 1.5, tilesize = 100, maxtiles = 10000)
+    tiles.set_image(img)
+    for zoom in (4, 2/3.0, 0.25, 1):
+        tiles.zoom = zoom
+        W, H = tiles.size
+        full = numpy.empty((H, W, 3), numpy.uint8)
+        for left, top, tile in tiles.visible(0, 0, W, H):
+            full[top:top + tile.shape[0], left:left + tile.shape[1]] = tile
+        #same as rendering in one tile
+        single = TileRenderer(colormap, -0.1, 1.5, zoom, tilesize = max(W, H))
+        single.set_image(img)
+        assert numpy.all(full == single.tile(0, 0)), zoom
+
+    #pyramid levels ignore NaN
+    assert numpy.all(reduce_image(numpy.array([[1, 3, 7], [numpy.nan, 5, 9]], numpy.float32))
+                     == [[3, 8]])
+
+    #only tiles of changed pixels are rendered again
+    img2 = img.copy()
+    img2[195:205, 1195:1205] = 0 #at corner of four tiles
+    tiles.set_image(img2)
+    n = tiles.rendered
+    tiles.visible(0, 0, 1392, 2080)
+    assert tiles.rendered - n == 4, tiles.rendered - n
+
+    #visible part at zoom 4: rendered on demand
+    tiles = TileRenderer(colormap, -0.1, 1.5, zoom = 4)
+    tiles.set_image(img)
+    t = time.time()
+    tiles.visible(2000, 3000, 1200, 900)
+    t1 = time.time()
+    tiles.visible(2000, 3000, 1200, 900)
+    t2 = time.time()
+    print "zoom 4, viewport 1200x900: %d tiles, %.1f ms, cached %.1f ms"%(
+        tiles.rendered, 1e3*(t1 - t), 1e3*(t2 - t1))
+
+if __name__ == '__main__':
+    test_render()
+    test_tiles()
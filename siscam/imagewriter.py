@@ -0,0 +1,195 @@
+#!/usr/bin/python
+#-*- coding: latin-1 -*-
+"""Asynchronous writing of PNG images. Images are encoded and written
+by a pool of worker processes, so that acquisition threads don't wait
+for the encoder or the disk. Files are written atomically: a worker
+writes a temporary file in the same directory, which then replaces
+the target file, so that a reader (e.g. L{filewatch.FileChangeNotifier}
+in cam) never sees a half-written image. If several images are
+written to the same file, the newest one wins."""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import traceback
+import multiprocessing
+from collections import deque
+
+import numpy
+
+from png_writer import PngWriter
+
+def replace(src, dst):
+    """rename file src to dst, replacing dst atomically"""
+    if os.name != 'nt':
+        os.rename(src, dst)
+        return
+
+    import ctypes
+    MOVEFILE_REPLACE_EXISTING = 0x1
+    MOVEFILE_WRITE_THROUGH = 0x8
+    for retry in range(5):
+        if ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst),
+                                              MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            return
+        #target may be opened by reader
+        time.sleep(0.05)
+    raise ctypes.WinError()
+
+def _encode(job):
+    """write image to temporary file next to target file
+
+    @param job: (filename, image, keyword arguments of L{PngWriter})
+    @return: (name of temporary file, None) or (None, error message)"""
+    filename, image, kwargs = job
+    directory, name = os.path.split(os.path.abspath(filename))
+    try:
+        fd, tmpname = tempfile.mkstemp(prefix = '.' + name + '.', suffix = '.tmp', dir = directory)
+        os.close(fd)
+        try:
+            PngWriter(tmpname, image, **kwargs)
+        except:
+            os.remove(tmpname)
+            raise
+    except Exception:
+        return None, "writing %s failed:\n%s"%(filename, traceback.format_exc())
+    return tmpname, None
+
+class ImageWriter(object):
+    """Writes PNG images in worker processes. At most maxpending
+    images are queued for writing, L{write} blocks if more are
+    pending. On Windows, worker processes import the main module of
+    the program again: it must not open cameras or files at import
+    (see L{acquire.init_cameras}) and has to call
+    multiprocessing.freeze_support().
+
+    @ivar written: number of images written
+    @ivar superseded: number of images not written since a newer
+    image for the same file was written first
+    @ivar failed: number of images which could not be written
+    @ivar latencies: time (s) from call of L{write} until file was
+    replaced, for recent images"""
+
+    def __init__(self, processes = 2, maxpending = 4):
+        """
+        @param processes: number of worker processes, 0: write in
+        calling thread (still atomically)
+        @param maxpending: maximum number of images queued for writing
+        """
+        self.pool = multiprocessing.Pool(processes) if processes > 0 else None
+        self.maxpending = maxpending
+        self._slots = threading.BoundedSemaphore(maxpending)
+        self._lock = threading.Lock()
+        self._submitted = {} #filename: number of last image queued for file
+        self._replaced = {}  #filename: number of image in file
+        self.written = 0
+        self.superseded = 0
+        self.failed = 0
+        self.latencies = deque(maxlen = 1000)
+
+    def write(self, filename, image, **kwargs):
+        """queue image for writing to PNG file. The image must not be
+        changed afterwards.
+
+        @param kwargs: keyword arguments of L{PngWriter}"""
+        self._slots.acquire()
+        with self._lock:
+            nr = self._submitted[filename] = self._submitted.get(filename, 0) + 1
+        submitted = time.time()
+
+        def done(result):
+            self._done(filename, nr, submitted, result)
+
+        if self.pool is None:
+            #no worker processes, compress in parallel threads instead
+            kwargs.setdefault('threads', multiprocessing.cpu_count())
+        job = (filename, numpy.asarray(image), kwargs)
+        if self.pool is None:
+            done(_encode(job))
+        else:
+            self.pool.apply_async(_encode, (job,), callback = done)
+
+    def _done(self, filename, nr, submitted, result):
+        #called in result handler thread of pool
+        tmpname, error = result
+        try:
+            if tmpname is None:
+                self.failed += 1
+                print >> sys.stderr, error
+                return
+
+            with self._lock:
+                superseded = self._replaced.get(filename, 0) > nr
+                if not superseded:
+                    try:
+                        replace(tmpname, filename)
+                    except OSError, e:
+                        self.failed += 1
+                        print >> sys.stderr, "writing %s failed: %s"%(filename, e)
+                        os.remove(tmpname)
+                        return
+                    self._replaced[filename] = nr
+
+            if superseded:
+                os.remove(tmpname)
+                self.superseded += 1
+            else:
+                self.written += 1
+                self.latencies.append(time.time() - submitted)
+        finally:
+            self._slots.release()
+
+    def latency_percentiles(self, percentiles = (50, 90, 99)):
+        """@return: percentiles of write latency (ms) of recent images,
+        empty if nothing written yet
+        @rtype: dict"""
+        latencies = list(self.latencies)
+        if not latencies:
+            return {}
+        values = numpy.percentile(latencies, percentiles)
+        return dict(zip(percentiles, 1e3*values))
+
+    def stats(self):
+        return "%d written, %d superseded, %d failed, latency %s"%(
+            self.written, self.superseded, self.failed,
+            ', '.join('%d%%: %.0f ms'%item for item in sorted(self.latency_percentiles().items())))
+
+    def flush(self):
+        """wait until all queued images are written"""
+        for k in range(self.maxpending):
+            self._slots.acquire()
+        for k in range(self.maxpending):
+            self._slots.release()
+
+    def close(self):
+        """write queued images, stop worker processes"""
+        self.flush()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def test_writer(n = 20, processes = 2):
+    import readpng
+
+    filename = os.path.join(tempfile.mkdtemp(), 'test.png')
+    writer = ImageWriter(processes)
+    rng = numpy.random.RandomState(0)
+    images = [rng.randint(0, 4096, (1040, 1392)).astype(numpy.uint16) for k in range(3)]
+    for k in range(n):
+        images[k%3][0, 0] = k
+        writer.write(filename, images[k%3].copy())
+    writer.close()
+
+    img, metadata = readpng.read(filename)
+    assert img[0, 0] == n - 1, "newest image not written"
+    assert os.listdir(os.path.dirname(filename)) == ['test.png'], "temporary files left"
+    print writer.stats()
+
+if __name__ == '__main__':
+    test_writer()
+    test_writer(processes = 0)
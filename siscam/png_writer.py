@@ -26,6 +26,41 @@ import math
 from array import array
 import numpy
 import operator
+import threading
+
+def compress(data, level=6, threads=1):
+    """
+    zlib stream of data. With several threads, data is split into
+    chunks which are compressed in parallel (zlib releases the GIL).
+    The chunks are raw deflate streams ended by a sync flush, they are
+    concatenated into a single zlib stream, readable by any decoder.
+    Compression is slightly worse, since matches don't cross chunks.
+    """
+    if threads <= 1:
+        return zlib.compress(data, level)
+
+    data = numpy.frombuffer(data, numpy.uint8)
+    size = -(-len(data) // threads)
+    parts = [''] * threads
+
+    def compress_chunk(k):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        last = k == threads - 1
+        parts[k] = (compressor.compress(data[k*size:(k+1)*size]) +
+                    compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH))
+
+    workers = [threading.Thread(target=compress_chunk, args=(k,)) for k in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    #zlib header: deflate with 32k window, compression level, check bits
+    cmf = 0x78
+    flg = (0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3) << 6
+    flg += 31 - (cmf*256 + flg) % 31
+    return (struct.pack("!2B", cmf, flg) + ''.join(parts) +
+            struct.pack("!I", zlib.adler32(data) & 0xffffffff))
 
 class PngWriter:
     """
@@ -42,7 +77,9 @@ class PngWriter:
                  significant_bits = None,
                  compression=1,
                  chunk_limit=2**20,
-                 metadata = {}):
+                 metadata = {},
+                 filter_type=0,
+                 threads=1):
 
         greyscale = True
 
@@ -64,6 +101,10 @@ class PngWriter:
         bitdepth - number of bits per sample
         compression - zlib compression level (1-9)
         chunk_limit - write multiple IDAT chunks to save memory
+        filter_type - PNG filter of all scanlines: 0 (None), 1 (Sub)
+        or 2 (Up). Sub and Up compress smooth images better, but
+        take longer.
+        threads - number of threads for compression
 
         If specified, the transparent and background parameters must
         be a tuple with three integer values for red, green, blue, or
@@ -93,6 +134,9 @@ class PngWriter:
         if significant_bits>bitdepth:
             raise ValueError('significant bits must be smaller than bitdepth of image')
 
+        if filter_type not in (0, 1, 2):
+            raise ValueError("filter type %s not supported"%filter_type)
+
         if transparent is not None:
             if greyscale:
                 if type(transparent) is not int:
@@ -201,85 +245,49 @@ class PngWriter:
                                  data)
 
             #IDAT
+            data = self.encode_image(image, filter_type)
             if self.compression is not None:
-                compressor = zlib.compressobj(self.compression)
-            else:
-                compressor = zlib.compressobj()
-
-
-
-            #write image data    
-
-            #check if sample scaling necessary
-            if self.significant_bits != self.bitdepth:
-                do_scale = True
-                shift_bits = self.bitdepth - self.significant_bits
-                clip_value = 2**self.significant_bits - 1
+                data_comp = compress(data, self.compression, threads)
             else:
-                do_scale = False
-
-            #choose proper data type TODO: correct only for greyscale
-            imgdtype = numpy.uint8 if self.bitdepth <= 8 else numpy.uint16
-
-            #ensure input array is C contiguous and has right data type
-            #TODO: contiguous not necessary if copy is done for scanline
-            image_array = numpy.ascontiguousarray(image, dtype = imgdtype)
-            #img_data = image_array.view(dtype = numpy.ubyte)
-
-            #list to collect compressed data
-            data_comp = []
-
-
-            scanline = numpy.empty(shape = (image_array.shape[1],), dtype = imgdtype)
-            #work = numpy.empty(shape = (img_data.shape[1] + imgdtype.itemsize,), dtype = numpy.ubyte) #idea: use this for everything, with some views for convenience
-            #b = numpy.zeros_like(work)
-
-            for line in image_array:
-                if do_scale:
-                    numpy.left_shift(line, shift_bits, scanline)
-                else:
-                    scanline[0:] = line[0:]
-                    #numpy.multiply(line, 1, scanline)
-                    
-
-                scanline.byteswap(True)
-
-                #no filter
-                s1 = compressor.compress(chr(0))
-                if s1: data_comp.append(s1)
-
-                ##Sub filter, poor compression
-                #work[0] = 1
-                #work[1:] = line[:]
-                #numpy.subtract(work[2:], work[1:-1], work[2:])
-
-                ##Up filter
-                #work[0] = 2
-                #numpy.subtract(line, b, work[1:])
-                #b = line
-
-                s2 = compressor.compress(scanline.data)
-                if s2:
-                    data_comp.append(s2)
-
-            data_comp.append(compressor.flush())
-
-            #total data length
-            l = reduce(operator.add, [len(s) for s in data_comp])
-            print "compressed size: %4.1f"%(100.0*l/(image_array.size*image_array.itemsize))
-
-            #write IDAT chunk
-            cs = zlib.crc32('IDAT')
-            outfile.write(struct.pack(">I", l))
-            outfile.write('IDAT')
-            for entry in data_comp:
-                outfile.write(entry)
-                cs = zlib.crc32(entry, cs)
-            outfile.write(struct.pack(">i", cs))
+                data_comp = compress(data, threads=threads)
+            print "compressed size: %4.1f"%(100.0*len(data_comp)/(self.width*self.height*self.psize))
+            self.write_chunk(outfile, 'IDAT', data_comp)
 
             self.write_chunk(outfile, 'IEND', '')
 
 
+    def encode_image(self, image, filter_type=0):
+        """
+        Filtered image data (before compression): scanlines with
+        leading filter type byte, samples big endian.
+        """
+        #choose proper data type TODO: correct only for greyscale
+        imgdtype = numpy.dtype('>u1') if self.bitdepth <= 8 else numpy.dtype('>u2')
+
+        rowbytes = self.width * self.psize
+        raw = numpy.empty(shape = (self.height, 1 + rowbytes), dtype = numpy.uint8)
+        raw[:, 0] = filter_type
+        samples = raw[:, 1:]
+
+        #convert data type and byte order in one step, via contiguous
+        #buffer since rows of raw are not aligned
+        buf = numpy.empty(shape = (self.height, self.width), dtype = imgdtype)
+        buf[...] = image
+        if self.significant_bits != self.bitdepth:
+            buf <<= self.bitdepth - self.significant_bits
+        samples[...] = buf.view(numpy.uint8)
+
+        #filters act on bytes, modulo 256
+        bpp = self.psize
+        if filter_type == 1:
+            #Sub: difference to corresponding byte of previous pixel
+            numpy.subtract(samples[:, bpp:], buf.view(numpy.uint8)[:, :-bpp], samples[:, bpp:])
+        elif filter_type == 2:
+            #Up: difference to byte of previous scanline
+            numpy.subtract(samples[1:], buf.view(numpy.uint8)[:-1], samples[1:])
+
+        return raw
+
     def write_chunk(self, outfile, tag, data):
         """
         Write a PNG chunk to the output file, including length and checksum.
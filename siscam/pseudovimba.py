@@ -0,0 +1,262 @@
+#!/usr/bin/python
+#-*- coding: latin-1 -*-
+"""Simulation of Vimba API with AVT camera, for testing acquisition
+without camera. Implements the parts of the pymba interface (Vimba,
+VimbaCamera, VimbaFrame) used by L{AVTcam}. After AcquisitionStart a
+timer thread fills queued frames with synthetic images at a given
+frame rate and calls their frame-done callbacks, like the Vimba DLL
+does.
+
+Use instead of L{AVTcam.VimbAcq}::
+
+    vimba = PseudoVimba().open()
+    cam = AVTcam.AVTcam(vimba.ID(), vimba)
+"""
+
+import threading
+import time
+import ctypes
+from collections import deque
+
+import numpy as np
+
+#: error code of waitFrameCapture on timeout (VmbErrorTimeout)
+VmbErrorTimeout = -12
+
+class PseudoFrameStructure(object):
+    """fields of Vimba frame structure, set when frame is filled"""
+    receiveStatus = 0
+    frameID = 0
+    timestamp = 0
+
+class PseudoFrame(object):
+    """frame of L{PseudoCamera}, see pymba.VimbaFrame"""
+
+    def __init__(self, camera):
+        self._camera = camera
+        self.width = camera.Width
+        self.height = camera.Height
+        self.pixel_bytes = 2 if camera.PixelFormat == 'Mono16' else 1
+        self.payloadSize = self.width*self.height*self.pixel_bytes
+        self._frame = PseudoFrameStructure()
+        self._filled = threading.Event()
+        self._frameCallback = None
+        self._buffer = None
+
+    def announceFrame(self):
+        self._buffer = (ctypes.c_ubyte*self.payloadSize)()
+        self._camera._announced.append(self)
+
+    def revokeFrame(self):
+        self._buffer = None
+
+    def queueFrameCapture(self, frameCallback = None):
+        self._frameCallback = frameCallback
+        self._filled.clear()
+        self._camera._queue(self)
+
+    def waitFrameCapture(self, timeout = 2000):
+        if self._filled.wait(timeout/1000.0):
+            return 0
+        return VmbErrorTimeout
+
+    def getBufferByteData(self):
+        return self._buffer
+
+class PseudoCamera(object):
+    """simulated AVT camera, see pymba.VimbaCamera. Features are plain
+    attributes.
+
+    @ivar delivered: number of frames filled
+    @ivar dropped: number of images lost since no frame was queued"""
+
+    Width = 656
+    Height = 492
+    PixelFormat = 'Mono8'
+    AcquisitionMode = 'SingleFrame'
+    ExposureMode = 'Timed'
+    ExposureTime = 40000
+    TriggerMode = 'Off'
+    TriggerSelector = 'ExposureActive'
+    TriggerActivation = 'LevelHigh'
+
+    #: frames per second delivered after AcquisitionStart
+    framerate = 20.0
+
+    def __init__(self, cameraID):
+        self.cameraID = cameraID
+        self._announced = []
+        self._queued = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._images = {}
+        self.delivered = 0
+        self.dropped = 0
+
+    def openCamera(self):
+        pass
+
+    def closeCamera(self):
+        self.runFeatureCommand('AcquisitionStop')
+
+    def getFrame(self):
+        return PseudoFrame(self)
+
+    def startCapture(self):
+        pass
+
+    def endCapture(self):
+        pass
+
+    def flushCaptureQueue(self):
+        with self._lock:
+            self._queued.clear()
+
+    def revokeAllFrames(self):
+        for frame in self._announced:
+            frame.revokeFrame()
+        self._announced = []
+
+    def runFeatureCommand(self, name):
+        if name == 'AcquisitionStart':
+            if self._thread is None:
+                self._running = True
+                self._thread = threading.Thread(target = self._run,
+                                                name = 'PseudoCamera')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        elif name == 'AcquisitionStop':
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._running = False
+                if thread is not threading.currentThread():
+                    thread.join()
+
+    def _queue(self, frame):
+        with self._lock:
+            self._queued.append(frame)
+
+    def _run(self):
+        #timer thread, fills queued frames
+        period = 1.0/self.framerate
+        tnext = time.time()
+        while self._running:
+            tnext += period
+            time.sleep(max(0, tnext - time.time()))
+            if not self._running:
+                break
+
+            with self._lock:
+                frame = self._queued.popleft() if self._queued else None
+            if frame is None:
+                self.dropped += 1
+                continue
+
+            self._fill(frame)
+            self.delivered += 1
+            if frame._frameCallback is not None:
+                frame._frameCallback(frame)
+            else:
+                frame._filled.set()
+
+            if self.AcquisitionMode == 'SingleFrame':
+                break
+        self._running = False
+
+    def _fill(self, frame):
+        dtype = np.uint16 if frame.pixel_bytes == 2 else np.uint8
+        img = np.ndarray(buffer = frame._buffer, dtype = dtype,
+                         shape = (frame.height, frame.width))
+        img[:] = self._image(frame.height, frame.width, dtype, self.delivered)
+        frame._frame.receiveStatus = 0
+        frame._frame.frameID = self.delivered
+        frame._frame.timestamp = int(time.time()*1e9)
+
+    def _image(self, height, width, dtype, nr):
+        #synthetic images: cloud in every first of three images,
+        #cycled from a few precomputed images
+        key = (height, width, dtype, nr%3 == 0, nr%4)
+        img = self._images.get(key)
+        if img is None:
+            rng = np.random.RandomState(nr%4)
+            y, x = np.ogrid[:height, :width]
+            vmax = np.iinfo(dtype).max
+            light = 0.6*vmax*np.exp(-((x - width/2.0)**2 + (y - height/2.0)**2)/(0.5*width)**2)
+            if nr%3 == 0:
+                light *= 1 - 0.8*np.exp(-((x - 0.5*width)**2/(0.05*width)**2 +
+                                          (y - 0.5*height)**2/(0.07*height)**2))
+            light += rng.normal(0, 0.01*vmax, light.shape)
+            img = np.clip(light, 0, vmax).astype(dtype)
+            self._images[key] = img
+        return img
+
+class PseudoVimba(object):
+    """simulated Vimba system with one L{PseudoCamera}, interface of
+    L{AVTcam.VimbAcq}"""
+
+    def __init__(self):
+        self._cameras = {}
+
+    def open(self):
+        print 'Opened pseudo Vimba'
+        return self
+
+    def close(self):
+        print 'Closed pseudo Vimba'
+
+    def getCameraIds(self):
+        return ['PseudoCamera']
+
+    def ID(self):
+        return self.getCameraIds()[0]
+
+    def getCamera(self, cameraID):
+        return self._cameras.setdefault(cameraID, PseudoCamera(cameraID))
+
+def test_callback_acquisition(duration = 2.0, framerate = 50.0, consume = 0.0):
+    """continuous acquisition with frame-done callbacks into a bounded
+    queue, consumed in separate thread which needs consume seconds
+    per image"""
+    import Queue
+    import AVTcam
+
+    vimba = PseudoVimba().open()
+    cam = AVTcam.AVTcam(vimba.ID(), vimba)
+    cam.camera0.framerate = framerate
+    queue = Queue.Queue(3)
+    counts = {'received': 0, 'queuefull': 0}
+
+    def frame_done(img):
+        try:
+            queue.put_nowait(img)
+        except Queue.Full:
+            counts['queuefull'] += 1
+            img.release()
+
+    def consumer():
+        while True:
+            img = queue.get()
+            if img is None:
+                break
+            time.sleep(consume)
+            counts['received'] += 1
+            img.release()
+
+    thread = threading.Thread(target = consumer)
+    thread.start()
+    cam.open('live')
+    cam.StartContinuousAcquisition(4, callback = frame_done)
+    time.sleep(duration)
+    cam.StopContinuousAcquisition()
+    queue.put(None)
+    thread.join()
+    cam.close()
+    vimba.close()
+
+    print "delivered %d, received %d, queue full %d, no frame queued %d"%(
+        cam.camera0.delivered, counts['received'], counts['queuefull'], cam.camera0.dropped)
+
+if __name__ == '__main__':
+    test_callback_acquisition()
+    test_callback_acquisition(consume = 0.05)
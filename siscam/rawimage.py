@@ -0,0 +1,239 @@
+#!/usr/bin/python
+#-*- coding: latin-1 -*-
+"""Raw image container for single and multi-shot files, read with
+numpy.memmap without copying.
+
+Layout (little endian)::
+
+    file header, one page: magic, version, dtype, height, width,
+        number of frames, size of frame slot, scale and offset of
+        values, creation time, imaging metadata (JSON)
+    frame slot 0: frame header page (index, timestamp, metadata as
+        JSON), pixel data padded to multiple of page size
+    frame slot 1: ...
+
+Pixel data of all frames is page aligned. Values are value = raw *
+scale + offset, e.g. scale 1e-3, offset -1 for optical densities
+saved as 1000*(OD + 1) in uint16 like L{readsis.loadimg}. Frames are
+appended by L{append}, the number of frames in the header is updated
+after the frame is written completely."""
+
+from __future__ import with_statement
+
+import os
+import time
+import json
+import struct
+
+import numpy
+
+MAGIC = 'SISCAMRW'
+VERSION = 1
+PAGE = 4096
+
+#: magic, version, dtype, height, width, frames, slot size, scale,
+#: offset, creation time, length of metadata
+HEADER = struct.Struct('<8s I 8s I I I Q d d d I')
+#: index, timestamp, length of metadata
+FRAMEHEADER = struct.Struct('<I d I')
+#: offset of number of frames in file header
+NFRAMES_OFFSET = struct.calcsize('<8s I 8s I I')
+
+def _pages(nbytes):
+    return -(-nbytes // PAGE)*PAGE
+
+def _metadata_json(metadata, size):
+    text = json.dumps(metadata or {}, sort_keys = True)
+    if len(text) > size:
+        raise ValueError("metadata too long (%d bytes, maximum %d)"%(len(text), size))
+    return text
+
+def create(filename, shape, dtype = numpy.uint16, scale = 1.0, offset = 0.0, metadata = None):
+    """create container without frames
+
+    @param shape: (height, width) of frames
+    @param metadata: imaging metadata, must be serializable as JSON
+    """
+    dtype = numpy.dtype(dtype).newbyteorder('<')
+    height, width = shape
+    text = _metadata_json(metadata, PAGE - HEADER.size)
+    slot = PAGE + _pages(height*width*dtype.itemsize)
+
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, dtype.str, height, width, 0, slot,
+                            scale, offset, time.time(), len(text)))
+        f.write(text)
+        f.write('\0'*(PAGE - HEADER.size - len(text)))
+
+def append(filename, img, timestamp = None, metadata = None):
+    """append frame to container
+
+    @param img: image, converted to data type of container
+    @param timestamp: acquisition time, default: now
+    @param metadata: metadata of frame (e.g. image number), must be
+    serializable as JSON
+    @return: index of frame
+    """
+    with open(filename, 'r+b') as f:
+        header = _read_header(f)
+        dtype = numpy.dtype(header['dtype'])
+        shape = (header['height'], header['width'])
+        data = numpy.ascontiguousarray(img, dtype = dtype)
+        if data.shape != shape:
+            raise ValueError("image has shape %s, container %s"%(data.shape, shape))
+
+        index = header['frames']
+        text = _metadata_json(metadata, PAGE - FRAMEHEADER.size)
+        if timestamp is None:
+            timestamp = time.time()
+
+        f.seek(PAGE + index*header['slot'])
+        f.write(FRAMEHEADER.pack(index, timestamp, len(text)))
+        f.write(text)
+        f.write('\0'*(PAGE - FRAMEHEADER.size - len(text)))
+        data.tofile(f)
+        f.write('\0'*(header['slot'] - PAGE - data.nbytes))
+        f.flush()
+
+        #publish frame
+        f.seek(NFRAMES_OFFSET)
+        f.write(struct.pack('<I', index + 1))
+    return index
+
+def write(filename, images, timestamps = None, scale = 1.0, offset = 0.0, metadata = None):
+    """create container with frames
+
+    @param images: image (2d) or sequence of images of same shape
+    """
+    images = numpy.asarray(images)
+    if images.ndim == 2:
+        images = images[numpy.newaxis]
+    create(filename, images.shape[1:], images.dtype, scale, offset, metadata)
+    for k, img in enumerate(images):
+        append(filename, img, None if timestamps is None else timestamps[k])
+
+def _read_header(f):
+    f.seek(0)
+    page = f.read(PAGE)
+    if len(page) < HEADER.size or page[:len(MAGIC)] != MAGIC:
+        raise IOError("not a raw image container")
+    (magic, version, dtype, height, width, frames, slot,
+     scale, offset, created, metalen) = HEADER.unpack_from(page)
+    if version > VERSION:
+        raise IOError("raw image container version %d not supported"%version)
+    return {'dtype': dtype.rstrip('\0'),
+            'height': height,
+            'width': width,
+            'frames': frames,
+            'slot': slot,
+            'scale': scale,
+            'offset': offset,
+            'created': created,
+            'metadata': json.loads(page[HEADER.size:HEADER.size + metalen]),
+            }
+
+class RawImageFile(object):
+    """Reader of raw image container. Frames are views of a memory
+    map of the file, not copies; they stay valid as long as they are
+    referenced.
+
+    @ivar frames: all frames, 3d array (frame, row, column)
+    @ivar metadata: imaging metadata of file"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.refresh()
+
+    def refresh(self):
+        """map file again, e.g. to see frames appended since opening"""
+        with open(self.filename, 'rb') as f:
+            header = _read_header(f)
+        self.__dict__.update(header)
+        self.dtype = numpy.dtype(header['dtype'])
+
+        #map complete slots only
+        size = PAGE + self.slot*self.frames
+        self._map = numpy.memmap(self.filename, numpy.uint8, 'r', shape = (size,))
+        if header['frames'] == 0:
+            #created, nothing appended yet
+            self.frames = numpy.empty((0, self.height, self.width), dtype = self.dtype)
+            return
+        self.frames = numpy.ndarray(shape = (header['frames'], self.height, self.width),
+                                    dtype = self.dtype,
+                                    buffer = self._map,
+                                    offset = 2*PAGE,
+                                    strides = (self.slot, self.width*self.dtype.itemsize,
+                                               self.dtype.itemsize))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        """@return: raw data of frame (view)"""
+        return self.frames[index]
+
+    def frame_info(self, index):
+        """@return: timestamp and metadata of frame
+        @rtype: float, dict"""
+        if index < 0:
+            index += len(self)
+        start = PAGE + index*self.slot
+        nr, timestamp, metalen = FRAMEHEADER.unpack_from(self._map, start)
+        start += FRAMEHEADER.size
+        return timestamp, json.loads(self._map[start:start + metalen].tostring())
+
+    @property
+    def timestamps(self):
+        return numpy.array([self.frame_info(k)[0] for k in range(len(self))])
+
+    def image(self, index, dtype = numpy.float32):
+        """@return: values (raw data scaled) of frame"""
+        img = numpy.multiply(self.frames[index], self.scale, dtype = dtype)
+        if self.offset:
+            img += self.offset
+        return img
+
+def load_image(filename, frame = -1):
+    """load frame of container, split into K and Rb half like
+    L{imagefile.load_image_png}; pixels with raw value 0 are masked
+
+    @return: K and Rb half of image
+    @rtype: masked arrays (float32)
+    """
+    f = RawImageFile(filename)
+    raw = f[frame]
+    img = numpy.ma.array(f.image(frame), mask = raw == 0)
+    h = img.shape[0]
+    return img[:h/2], img[h/2:]
+
+def test_container():
+    import tempfile
+    filename = os.path.join(tempfile.mkdtemp(), 'test.raw')
+    rng = numpy.random.RandomState(0)
+    images = rng.randint(0, 4000, (3, 104, 139)).astype(numpy.uint16)
+
+    create(filename, images.shape[1:], images.dtype, scale = 1e-3, offset = -1,
+           metadata = {'imaging': 'absorption'})
+    f = RawImageFile(filename)
+    assert len(f) == 0 and f.frames.shape == (0, 104, 139)
+    append(filename, images[0], timestamp = 1.0)
+    append(filename, images[1], timestamp = 2.0)
+    f.refresh()
+    assert len(f) == 2 and f.metadata == {'imaging': 'absorption'}
+    assert numpy.all(f.frames == images[:2])
+    assert f.frames[0].ctypes.data % PAGE == f._map.ctypes.data % PAGE, "frame not page aligned"
+
+    append(filename, images[2], metadata = {'nr': 3})
+    assert len(f) == 2
+    f.refresh()
+    assert len(f) == 3 and numpy.all(f[2] == images[2])
+    assert f.frame_info(2)[1] == {'nr': 3} and f.timestamps[1] == 2.0
+    assert numpy.allclose(f.image(1), images[1]*1e-3 - 1, atol = 1e-6)
+
+    filename = os.path.join(os.path.dirname(filename), 'test2.raw')
+    write(filename, images, timestamps = [1.0, 2.0, 3.0])
+    assert numpy.all(RawImageFile(filename).frames == images)
+    print "raw image container test passed"
+
+if __name__ == '__main__':
+    test_container()
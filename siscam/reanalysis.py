@@ -0,0 +1,200 @@
+#!/usr/bin/python
+#-*- coding: latin-1 -*-
+"""Re-analysis of saved images without GUI. The K and Rb halves of
+all images of a measurement are fitted in parallel by a pool of
+worker processes, results are delivered in file order."""
+
+from __future__ import with_statement
+
+import os.path
+import csv
+import types
+import multiprocessing
+
+import numpy
+
+import imagefile
+import absorption
+import resultcolumns
+
+#: names of species, in order of image halves as returned by image loader
+species = ('K', 'Rb')
+
+def prepare_image(img, imaging_pars):
+    """prepare image for fitting: compensate for finite optical
+    density, mask invalid entries.
+
+    @type imaging_pars: L{ImagingPars}
+    @return: masked image
+    """
+    ##compensate for finite optical density
+    ODmax = imaging_pars.ODmax
+    if ODmax > 0:
+        #saturated pixels set to NaN, masked below
+        img = numpy.ma.array(absorption.saturation_corrected(numpy.ma.getdata(img), ODmax),
+                             mask = numpy.ma.getmask(img))
+
+    img = numpy.ma.array(img, mask= ~ numpy.isfinite(img))
+    if ODmax > 0:
+        img.set_fill_value(ODmax)
+    else:
+        img.set_fill_value(3) #which to take?
+    return img
+
+#state of worker process, see _init_worker
+_worker = {}
+
+def _init_worker(fits, rois, loader):
+    #each image is fitted once, cached results would never be used
+    for fit in fits.itervalues():
+        fit.use_result_cache = False
+    _worker['fits'] = fits
+    _worker['rois'] = rois
+    _worker['loader'] = loader
+    _worker['image'] = (None, None)
+
+def _fit_task(task):
+    """fit one half of image.
+    @param task: (index, filename, name of species)
+    @return: (index, name of species, FitPars.valuedict() or None if
+    fit failed or invalid)"""
+    index, filename, name = task
+
+    #K and Rb half of same file often are processed by same worker
+    loadedfile, halves = _worker['image']
+    if loadedfile != filename:
+        halves = _worker['loader'](filename)
+        _worker['image'] = (filename, halves)
+
+    fit = _worker['fits'][name]
+    img = prepare_image(halves[species.index(name)], fit.imaging_pars)
+
+    try:
+        imgfit, background, fitpars = fit.do_fit(img, _worker['rois'][name])
+    except Exception, e:
+        print "fit of %s (%s) failed: %s"%(filename, name, e)
+        return index, name, None
+
+    if not fitpars.valid:
+        return index, name, None
+    return index, name, fitpars.valuedict()
+
+def reanalyze(images, fit, roi,
+              processes = None,
+              loader = imagefile.load_image_giacomo,
+              chunksize = 1):
+    """fit saved images in pool of worker processes.
+
+    @param images: image files, e.g. a measurement of
+    L{ImageTree.TreeModel} (list of entries with attribute path) or
+    list of filenames
+
+    @param fit: fit routine, or dict of fit routines with species as keys
+    @type fit: L{fitting.Fitting}
+
+    @param roi: region of interest, or dict of ROIs with species as keys
+    @type roi: L{roi.ROI}
+
+    @param processes: number of worker processes, default: number of CPUs
+
+    @param loader: function to load image, returning K and Rb half
+
+    @return: generator yielding (filename, {species: FitPars.valuedict()
+    or None}), in order of images
+    """
+    filenames = [getattr(entry, 'path', entry) for entry in images]
+
+    fits = fit if isinstance(fit, dict) else dict.fromkeys(species, fit)
+    rois = roi if isinstance(roi, dict) else dict.fromkeys(species, roi)
+    names = [name for name in species if name in fits]
+
+    tasks = [(k, filename, name) for k, filename in enumerate(filenames) for name in names]
+
+    pool = multiprocessing.Pool(processes, _init_worker, (fits, rois, loader))
+    try:
+        results = pool.imap(_fit_task, tasks, chunksize)
+        for filename in filenames:
+            row = {}
+            for name in names:
+                index, name, values = results.next()
+                row[name] = values
+            yield filename, row
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def save_csv(filename, rows, varfile = resultcolumns.varfile):
+    """save results of L{reanalyze} in comma separated format, with
+    same layout as L{FitResultTableGrid.FitResultDataTable.save_data_csv}
+    (for default settings of table). Variable columns are left empty.
+
+    @param rows: iterable of (image filename, {species: FitPars.valuedict() or None})
+    """
+    columns = resultcolumns.result_columns(varfile)
+    colLabels = columns[:,0].tolist()
+    dynamic_cols = list(numpy.where(columns[:,2]==1)[0])
+    colsel = list(columns[:,3].nonzero()[0])
+
+    fitparcols = {}
+    for col, name in enumerate(columns[:,4]):
+        if name:
+            fitparcols.setdefault(name, []).append(col)
+
+    fields = resultcolumns.csv_header(columns[:,0], dynamic_cols, colsel = colsel)
+
+    with open(filename, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        for row, (imagefilename, results) in enumerate(rows):
+            data = ['']*len(colLabels)
+            data[0] = row
+            data[1] = os.path.basename(imagefilename)
+            for col in dynamic_cols:
+                data[col] = None
+
+            for name, values in results.iteritems():
+                for col in fitparcols.get(name, []):
+                    data[col] = None
+                if values is None:
+                    continue
+                for key, val in values.iteritems():
+                    try:
+                        data[colLabels.index(key+' '+name)] = val
+                    except ValueError:
+                        pass
+
+            data.append(False) #masked
+            writer.writerow([entry.encode('latin_1') if type(entry) is types.UnicodeType else entry for entry in data])
+
+def main():
+    import argparse
+    import fitting
+    import imagingpars
+    from roi import ROI
+
+    parser = argparse.ArgumentParser(description = 'fit saved images without GUI')
+    parser.add_argument('output', help = 'file for results (csv)')
+    parser.add_argument('images', nargs = '+', help = 'image files')
+    parser.add_argument('--fit', default = 'Gauss2d',
+                        help = 'name of fit class in module fitting')
+    parser.add_argument('--roi', nargs = 4, type = int, default = [0, 1392, 0, 1040],
+                        metavar = ('XMIN', 'XMAX', 'YMIN', 'YMAX'))
+    parser.add_argument('--processes', type = int, default = None)
+    parser.add_argument('--pyramid', action = 'store_true',
+                        help = 'coarse-to-fine fitting, faster for large ROIs')
+    args = parser.parse_args()
+
+    fits = {}
+    for name, mass in zip(species, [41.0 * 1.66e-27, 87.0 * 1.66e-27]):
+        ip = imagingpars.ImagingParsVertical()
+        ip.mass = mass
+        fits[name] = getattr(fitting, args.fit)(ip)
+        fits[name].pyramid = args.pyramid
+
+    rows = reanalyze(sorted(args.images), fits, ROI(*args.roi),
+                     processes = args.processes)
+    save_csv(args.output, rows)
+
+if __name__ == '__main__':
+    main()
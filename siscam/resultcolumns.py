@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#-*- coding: latin-1 -*-
+"""Column layout of fit result tables. Kept free of wx, so that it
+can be used for writing results without GUI."""
+
+import numpy
+
+from settings import varfile
+
+def result_columns(varfile = varfile):
+    """create column definitions of fit result table. Besides a fixed
+    set of columns one column for each variable listed in varfile is
+    created.
+
+    @return: one row per column: name, type, dynamic, show, species
+    @rtype: ndarray of objects (Nx5)
+    """
+
+    varlist = []
+
+    var_array=numpy.loadtxt(varfile,skiprows = 1,dtype={'names':('variables','values'),'formats':('S15','f4')})
+    for line in var_array:
+        varlist.append(line[0])
+        varlist.append('double_empty:5,3')
+        varlist.append(2)
+        if line ==var_array[0]:
+            varlist.append(1)
+        else:
+            varlist.append(0)
+        varlist.append('')
+
+    rowlist=[
+        #name       type          dynamic show
+        'FileID',   'long',             0, 1, '',  #0
+        'Filename', 'string',           0, 0, '',  #1
+        #'N K',      'double_empty:4,1', 0, 1, 'K', #2
+        #'Nerr K',   'double_empty:4,2', 0, 0, 'K',
+        #'Nth K',    'double_empty:4,1', 0, 0, 'K', #3
+        #'Nbec K',   'double_empty:4,1', 0, 0, 'K', #4
+        #'OD K',     'double_empty:4,1', 0, 0, 'K', #5
+        #'sx K',     'double_empty:4,1', 0, 1, 'K', #6
+        #'sxerr K',  'double_empty:4,2', 0, 0, 'K', #7
+        #'sy K',     'double_empty:4,1', 0, 1, 'K', #8
+        #'syerr K',  'double_empty:4,2', 0, 0, 'K', #9
+        #'rx K',     'double_empty:4,1', 0, 0, 'K', #10
+        #'rxerr K',  'double_empty:4,2', 0, 0, 'K', #11
+        #'ry K',     'double_empty:4,1', 0, 0, 'K', #12
+        #'ryerr K',  'double_empty:4,2', 0, 0, 'K', #13
+        #'mx K',     'double_empty:4,1', 0, 0, 'K', #14
+        #'myerr K',  'double_empty:4,2', 0, 0, 'K', #15
+        #'my K',     'double_empty:4,1', 0, 0, 'K', #16
+        #'myerr K',  'double_empty:4,2', 0, 0, 'K', #17
+        #'T K',      'double_empty:4,3', 0, 1, 'K', #18
+        #'Terr K',   'double_empty:4,3', 0, 0, 'K', #19
+        #'sigma K',  'double_empty:4,3', 0, 0, 'K',
+        #'params K', 'string',           0, 0, 'K', #20
+        'N Rb',     'double_empty:4,1', 0, 1, 'Rb',#21
+        'Nerr Rb',  'double_empty:4,2', 0, 0, 'Rb',#21
+        'Nth Rb',   'double_empty:4,1', 0, 0, 'Rb',#22
+        'Nbec Rb',  'double_empty:4,1', 0, 0, 'Rb',#23
+        'OD Rb',    'double_empty:4,1', 0, 0, 'Rb',#24
+        'ODerr Rb', 'double_empty:4,1', 0, 0, 'Rb',#25
+        'sx Rb',    'double_empty:4,1', 0, 1, 'Rb',#26
+        'sxerr Rb', 'double_empty:4,2', 0, 0, 'Rb',#27
+        'sy Rb',    'double_empty:4,1', 0, 1, 'Rb',#28
+        'syerr Rb', 'double_empty:4,2', 0, 0, 'Rb',#29
+        'rx Rb',    'double_empty:4,1', 0, 0, 'Rb',#30
+        'rxerr Rb', 'double_empty:4,2', 0, 0, 'Rb',#31
+        'ry Rb',    'double_empty:4,1', 0, 0, 'Rb',#32
+        'ryerr Rb', 'double_empty:4,2', 0, 0, 'Rb',#33
+        'mx Rb',    'double_empty:4,1', 0, 0, 'Rb',#34
+        'mxerr Rb', 'double_empty:4,2', 0, 0, 'Rb',#35
+        'my Rb',    'double_empty:4,1', 0, 0, 'Rb',#36
+        'myerr Rb', 'double_empty:4,2', 0, 0, 'Rb',#37
+        'T Rb',     'double_empty:4,3', 0, 1, 'Rb',#38
+        'Terr Rb',  'double_empty:4,3', 0, 0, 'Rb',#39
+        'sigma Rb', 'double_empty:4,3', 0, 0, 'Rb',
+        'params Rb','string',           0, 0, 'Rb',#40
+        'dynamic',  'double_empty:5,3', 1, 1, '',  #41
+        'dynamic 2','double_empty:5,3', 1, 0, '',  #42
+        'dynamic 3','double_empty:5,3', 1, 0, '',  #43
+        'dynamic 4','double_empty:5,3', 1, 0, '',  #44
+        'user',     'double_empty:5,3', 0, 1, '',  #45
+        'user2',    'double_empty:5,3', 0, 0, '',  #45
+        'user3',    'double_empty:5,3', 0, 0, '',  #46
+        'Omit',     'bool_custom',      0, 1, '',  #47
+        #'Remark',   'string',           0, 1, '',  #48
+        ]
+    columns = numpy.array(rowlist+varlist+['Remark','string',0,1,''], dtype = numpy.object)
+    columns.shape = (-1, 5)
+    return columns
+
+def csv_header(colLabels, dynamic_cols, dynamic_expressions = None,
+               column_labels_custom = None, colsel = None):
+    """create header line for saving fit results in comma separated
+    format. Adds column 'masked', expressions of dynamic columns and
+    custom labels.
+
+    @return: field names
+    @rtype: ndarray of objects
+    """
+    if dynamic_expressions is None:
+        dynamic_expressions = ['']*len(dynamic_cols)
+    if column_labels_custom is None:
+        column_labels_custom = {}
+    if colsel is None:
+        colsel = []
+
+    #add masked entry as last column
+    fields = numpy.r_[colLabels, ['masked']]
+
+    #add dynamic expression to column headers
+    for k, col in enumerate(dynamic_cols):
+        fields[col] += " [%s]"%dynamic_expressions[k] if dynamic_expressions[k] else ''
+
+    #add custom labels to field names
+    for col, fieldname in enumerate(fields):
+        custom_label = column_labels_custom.get(col)
+        fields[col] += " (%s)"%custom_label if custom_label else ''
+
+        fields[col] += " {*}" if (col in colsel and (fieldname.find('user')==0 or col in dynamic_cols)) else ''
+
+    return fields
@@ -42,6 +42,34 @@ useBluefox = False
 useSony    = False
 useAVT     = True
 
+#capacity of queues between acquisition and consumer threads, and
+#policy if queue is full (see framequeue): 'block', 'drop-oldest',
+#or 'drop-newest' (drops complete sets of triggered images)
+acquirequeuesize = 3
+queuepolicy_live = 'drop-oldest'
+queuepolicy_triggered = 'drop-newest'
+
+#maximum time (s) between first and last image of a set of triggered
+#images, incomplete sets are discarded
+settimeout = 2.0
+
+#images saved during acquisition are written by writerprocesses
+#worker processes (0: by acquisition threads), at most
+#writerqueuesize images are queued for writing
+writerprocesses = 2
+writerqueuesize = 4
+
+#number of frames of ring buffer for continuous acquisition with AVT
+#camera, 0: acquire single frames (slower, copies each image)
+AVTringframes = 8
+
+#AVT camera delivers images by frame-done callbacks instead of
+#waiting acquisition thread
+AVTcapturecallback = True
+
+#simulated AVT camera (pseudovimba), for testing without camera
+usePseudoAVT = False
+
 ImagingControlProgID = "IC.ICImagingControl3"
 devicesettings = 'settings/cam bluefox device settings.txt'
 
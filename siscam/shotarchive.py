@@ -0,0 +1,309 @@
+#!/usr/bin/python
+#-*- coding: latin-1 -*-
+"""Archive of all shots of a measurement in a single file, instead of
+one PNG file per shot.
+
+The archive is a ZIP file (ZIP64) of numpy .npy arrays and JSON
+documents, readable with numpy.load or any zip tool::
+
+    archive.json                 format version, creation time,
+                                 metadata of measurement
+    00012/shot.json              shot number, acquisition time, source
+                                 file, sequence variables, fit
+                                 parameters by species
+    00012/raw.npy                raw images (e.g. atoms, light, dark), 3d
+    00012/optical_density.npy    absorption image, float32, NaN for
+                                 invalid pixels
+    fitpars-0001.json            fit parameters of a re-fit, by shot
+                                 number and species
+
+Each dataset of a shot is a separate member, i.e. one chunk per shot
+and dataset. Integer datasets (raw images) are deflate compressed;
+floating point datasets are stored uncompressed, since the noise in
+their mantissa hardly compresses and inflating would only cost time. The central directory of the zip file
+is the index: a dataset of a shot is read without reading other shots.
+Members are only appended, never rewritten; results of a re-fit are
+appended as new fitpars member, the newest one wins.
+
+Shots of an archive are addressed by paths 'archive.shots#12', which
+L{imagefile.load_image} and L{ImageTree.TreeModel} understand."""
+
+from __future__ import with_statement
+
+import os
+import re
+import time
+import json
+import zipfile
+from collections import OrderedDict
+from cStringIO import StringIO
+
+import numpy
+
+VERSION = 1
+#: extension of archive files
+extension = '.shots'
+
+def shot_path(filename, nr):
+    """@return: path of shot in archive"""
+    return '%s#%d'%(filename, nr)
+
+def split_path(path):
+    """@return: archive filename and shot number of path, or None if
+    path is not a shot in an archive"""
+    filename, sep, nr = path.rpartition('#')
+    if not sep or not filename.lower().endswith(extension) or not nr.isdigit():
+        return None
+    return filename, int(nr)
+
+def _shotdir(nr):
+    return '%05d/'%nr
+
+class ShotArchive(object):
+    """Reader and writer of shot archive, see module docstring.
+
+    Every L{add_shot} opens the file, appends and closes it again, so
+    that the archive is complete on disk after each shot. Appending
+    rewrites the central directory at the end of the file, an
+    interrupted append loses the index (zip -FF restores it). Readers
+    see new shots after L{refresh}.
+
+    @ivar metadata: metadata of measurement
+    @ivar shots: numbers of shots in archive, sorted"""
+
+    def __init__(self, filename, metadata = None):
+        """open archive, create it if it doesn't exist
+
+        @param metadata: metadata of measurement for new archive, must
+        be serializable as JSON
+        """
+        self.filename = filename
+        self._zip = None
+        self._mtime = None
+        if not os.path.exists(filename):
+            with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64 = True) as zf:
+                zf.writestr('archive.json', json.dumps({'version': VERSION,
+                                                        'created': time.time(),
+                                                        'metadata': metadata or {}}))
+        self.refresh()
+
+    def refresh(self):
+        """read index again if file changed"""
+        st = os.stat(self.filename)
+        mtime = (st.st_mtime, st.st_size)
+        if self._zip is not None and mtime == self._mtime:
+            return
+        self.close()
+        self._zip = zipfile.ZipFile(self.filename, 'r', allowZip64 = True)
+        self._mtime = mtime
+
+        info = json.loads(self._zip.read('archive.json'))
+        if info['version'] > VERSION:
+            raise IOError("shot archive version %d not supported"%info['version'])
+        self.metadata = info['metadata']
+        self._index(self._zip.namelist())
+
+    def _index(self, names):
+        self.shots = sorted(int(name[:-len('/shot.json')]) for name in names
+                            if name.endswith('/shot.json'))
+        self._fitpars = sorted(name for name in names if name.startswith('fitpars-'))
+        self._refits = None
+
+    def _reader(self):
+        if self._zip is None:
+            self.refresh()
+        return self._zip
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def __len__(self):
+        return len(self.shots)
+
+    def add_shot(self, nr, images = None, variables = None, fitpars = None,
+                 timestamp = None, source = None):
+        """append shot to archive
+
+        @param nr: shot number, unique in archive
+        @param images: datasets of shot, e.g. {'raw': frames,
+        'optical_density': od}; masked arrays are saved with masked
+        entries set to NaN
+        @param variables: sequence variables, {name: value}
+        @param fitpars: fit parameters, {species: FitPars.valuedict()}
+        @param timestamp: acquisition time, default: now
+        @param source: name of original image file
+        """
+        shot = {'nr': nr,
+                'time': time.time() if timestamp is None else timestamp,
+                'source': source,
+                'variables': variables or {},
+                'fitpars': fitpars or {},
+                'datasets': sorted((images or {}).keys())}
+
+        #reading the index is the main cost of appending to large
+        #archives: read it once, by the writer, reader is reopened
+        #when needed
+        self.close()
+        with zipfile.ZipFile(self.filename, 'a', zipfile.ZIP_DEFLATED, allowZip64 = True) as zf:
+            if _shotdir(nr) + 'shot.json' in zf.NameToInfo:
+                raise ValueError("shot %d already in archive %s"%(nr, self.filename))
+            for name, img in (images or {}).iteritems():
+                if numpy.ma.isMaskedArray(img):
+                    img = img.astype(numpy.result_type(img.dtype, numpy.float32)).filled(numpy.nan)
+                img = numpy.asarray(img)
+                buf = StringIO()
+                numpy.lib.format.write_array(buf, img)
+                zf.writestr(_shotdir(nr) + name + '.npy', buf.getvalue(),
+                            zipfile.ZIP_STORED if img.dtype.kind in 'fc' else zipfile.ZIP_DEFLATED)
+            zf.writestr(_shotdir(nr) + 'shot.json', json.dumps(shot))
+            self._index(zf.namelist())
+
+    def add_fitpars(self, results):
+        """append fit parameters of re-fit, e.g. of L{reanalysis.reanalyze}
+
+        @param results: {shot number: {species: FitPars.valuedict() or None}}
+        """
+        self.close()
+        with zipfile.ZipFile(self.filename, 'a', zipfile.ZIP_DEFLATED, allowZip64 = True) as zf:
+            names = zf.namelist()
+            name = 'fitpars-%04d.json'%(sum(1 for n in names if n.startswith('fitpars-')) + 1)
+            zf.writestr(name, json.dumps(dict((str(nr), row) for nr, row in results.iteritems())))
+            self._index(zf.namelist())
+
+    def shot(self, nr):
+        """@return: description of shot: nr, time, source, variables,
+        fitpars (of newest re-fit, if any) and names of datasets
+        @rtype: dict"""
+        shot = json.loads(self._reader().read(_shotdir(nr) + 'shot.json'))
+        if self._fitpars:
+            if self._refits is None:
+                self._refits = {}
+                for name in self._fitpars:
+                    self._refits.update(json.loads(self._reader().read(name)))
+            shot['fitpars'] = self._refits.get(str(nr), shot['fitpars'])
+        return shot
+
+    def image(self, nr, name = 'optical_density'):
+        """@return: dataset of shot
+        @rtype: ndarray"""
+        f = self._reader().open(_shotdir(nr) + name + '.npy')
+        try:
+            return numpy.lib.format.read_array(f)
+        finally:
+            f.close()
+
+    def table(self):
+        """sequence variables and fit parameters of all shots, e.g. for
+        browsing a measurement without loading images
+
+        @return: one row per shot: (nr, time, variables, fitpars)
+        @rtype: list"""
+        rows = []
+        for nr in self.shots:
+            shot = self.shot(nr)
+            rows.append((nr, shot['time'], shot['variables'], shot['fitpars']))
+        return rows
+
+    def paths(self):
+        """@return: paths of all shots, e.g. for L{reanalysis.reanalyze}"""
+        return [shot_path(self.filename, nr) for nr in self.shots]
+
+#archives opened by load_image, kept open for loading further
+#shots. Only the most recently used ones are kept, others are
+#closed, so that files are not locked (Windows) and file handles are
+#not exhausted.
+_open = OrderedDict()
+#: maximum number of archives kept open by L{open_archive}
+max_open = 4
+
+def open_archive(filename):
+    """@return: opened archive, shared by callers and up to date"""
+    archive = _open.pop(filename, None)
+    if archive is None:
+        archive = ShotArchive(filename)
+    else:
+        archive.refresh()
+    _open[filename] = archive
+    while len(_open) > max_open:
+        _open.popitem(last = False)[1].close()
+    return archive
+
+def close_archive(filename):
+    """close archive opened by L{open_archive}, if any"""
+    archive = _open.pop(filename, None)
+    if archive is not None:
+        archive.close()
+
+def load_image(path):
+    """load optical density of shot, split into K and Rb half like
+    L{imagefile.load_image_png}; invalid (NaN) pixels are masked
+
+    @param path: path of shot, see L{shot_path}
+    @return: K and Rb half of image
+    @rtype: masked arrays (float32)
+    """
+    filename, nr = split_path(path)
+    img = open_archive(filename).image(nr, 'optical_density')
+    img = numpy.ma.masked_invalid(img.astype(numpy.float32), copy = False)
+    h = img.shape[0]
+    return img[:h/2], img[h/2:]
+
+#shot number of image file, see ImageTree.TreeModel.imagefilematch
+_filenr = re.compile(r'-(?P<nr>\d{4})\.\w+$')
+
+def archive_images(filenames, archivename, metadata = None):
+    """copy saved images of a measurement (e.g. PNG files, shot
+    number from filename) into archive. Shots already in the archive
+    are skipped.
+
+    @return: archive
+    """
+    import imagefile
+
+    archive = ShotArchive(archivename, metadata)
+    for k, filename in enumerate(filenames):
+        m = _filenr.search(filename)
+        nr = int(m.group('nr')) if m else k
+        if nr in archive.shots:
+            continue
+        halves = imagefile.load_image(filename)
+        od = numpy.ma.concatenate(halves)
+        archive.add_shot(nr, {'optical_density': od},
+                         timestamp = os.path.getmtime(filename),
+                         source = os.path.basename(filename))
+    return archive
+
+def test_archive(nshots = 5):
+    import tempfile
+    filename = os.path.join(tempfile.mkdtemp(), '20240101-test' + extension)
+    rng = numpy.random.RandomState(0)
+    archive = ShotArchive(filename, {'imaging': 'absorption'})
+    images = {}
+    for nr in range(1, nshots + 1):
+        raw = rng.randint(0, 4000, (3, 104, 139)).astype(numpy.uint16)
+        od = numpy.ma.masked_greater(rng.normal(0, 1, (104, 139)).astype(numpy.float32), 2)
+        images[nr] = raw, od
+        archive.add_shot(nr, {'raw': raw, 'optical_density': od},
+                         variables = {'tof': 0.1*nr},
+                         fitpars = {'Rb': {'N': 1e5*nr}})
+
+    reader = ShotArchive(filename)
+    assert reader.shots == range(1, nshots + 1) and reader.metadata == {'imaging': 'absorption'}
+    assert numpy.all(reader.image(3, 'raw') == images[3][0])
+    K, Rb = load_image(shot_path(filename, 2))
+    od = images[2][1]
+    assert numpy.all(numpy.ma.concatenate((K, Rb)).mask == od.mask)
+    assert numpy.all(numpy.ma.concatenate((K, Rb)).compressed() == od.compressed())
+
+    archive.add_fitpars({2: {'Rb': {'N': 1.0}}})
+    reader.refresh()
+    table = reader.table()
+    assert [row[3]['Rb']['N'] for row in table[:3]] == [1e5, 1.0, 3e5]
+    assert table[4][2] == {'tof': 0.5}
+    assert numpy.load(filename)['00001/raw'].shape == (3, 104, 139)
+    print "shot archive test passed"
+
+if __name__ == '__main__':
+    test_archive()